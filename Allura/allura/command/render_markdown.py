@@ -0,0 +1,131 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import multiprocessing
+import traceback
+
+from pylons import tmpl_context as c
+
+from allura.tasks.index_tasks import render_markdown
+from allura.lib.exceptions import CompoundError
+from allura.lib import utils
+from . import base
+from .show_models import build_model_inheritance_graph, dfs
+
+
+class RenderMarkdownCommand(base.Command):
+    min_args = 1
+    max_args = 1
+    usage = '<ini file>'
+    summary = ('Render the markdown of all artifacts with a markdown cache (wiki pages, '
+               'tickets, posts, blog posts...) and store the html')
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('-p', '--project', dest='project', default=None,
+                      help='project to render')
+    parser.add_option('--project-regex', dest='project_regex', default='',
+                      help='Restrict rendering to projects for which the shortname matches '
+                      'the provided regex.')
+    parser.add_option(
+        '-n', '--neighborhood', dest='neighborhood', default=None,
+        help='neighborhood to render (e.g. p)')
+    parser.add_option('--tasks', action='store_true', dest='tasks',
+                      help='Post render_markdown tasks, so that the taskd workers do the rendering')
+    parser.add_option('--processes', dest='processes', type=int, default=1,
+                      help='Render in this many processes in parallel (not used with --tasks)')
+    parser.add_option('--chunk', dest='chunk', type=int, default=100,
+                      help='Number of artifacts to render per task, or per batch of a process')
+
+    def command(self):
+        from allura import model as M
+        self.basic_setup()
+        graph = build_model_inheritance_graph()
+        artifact_classes = [a_cls for _, a_cls in dfs(M.Artifact, graph)
+                            if a_cls.markdown_cache_fields()]
+        if self.options.project:
+            q_project = dict(shortname=self.options.project)
+        elif self.options.project_regex:
+            q_project = dict(shortname={'$regex': self.options.project_regex})
+        elif self.options.neighborhood:
+            neighborhood_id = M.Neighborhood.query.get(
+                url_prefix='/%s/' % self.options.neighborhood)._id
+            q_project = dict(neighborhood_id=neighborhood_id)
+        else:
+            q_project = {}
+
+        self.pool = None
+        if self.options.processes > 1 and not self.options.tasks:
+            self.pool = multiprocessing.Pool(self.options.processes)
+        self.pending = []
+
+        for projects in utils.chunked_find(M.Project, q_project):
+            for p in projects:
+                c.project = p
+                base.log.info('Render markdown of project %s', p.shortname)
+                app_config_ids = [ac._id for ac in p.app_configs]
+                for a_cls in artifact_classes:
+                    base.log.info('  %s', a_cls)
+                    ref_ids = [a.index_id() for a in a_cls.query.find(
+                        dict(app_config_id={'$in': app_config_ids}))]
+                    M.artifact_orm_session.clear()
+                    for chunk in utils.chunked_list(ref_ids, self.options.chunk):
+                        self._render(chunk)
+                self._wait_for_pending()
+                M.main_orm_session.clear()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        base.log.info('Render %s', 'queued' if self.options.tasks else 'done')
+
+    def _render(self, ref_ids):
+        if self.options.tasks:
+            utils.post_task_split(render_markdown, ref_ids)
+        elif self.pool:
+            self.pending.append(self.pool.apply_async(
+                _render_markdown_in_subprocess, (c.project._id, ref_ids)))
+        else:
+            try:
+                render_markdown(ref_ids)
+            except CompoundError, err:
+                base.log.exception('Error rendering artifacts:\n%r', err)
+                base.log.error('%s', err.format_error())
+            except Exception:
+                base.log.exception('Error rendering artifacts')
+
+    def _wait_for_pending(self):
+        for result in self.pending:
+            error = result.get()
+            if error:
+                base.log.error('Error rendering artifacts:\n%s', error)
+        self.pending = []
+
+
+def _render_markdown_in_subprocess(project_id, ref_ids):
+    '''Run by ``render-markdown --processes``.  Returns a formatted error, if
+    any, since exceptions with tracebacks can't be sent back to the parent.'''
+    from allura import model as M
+    M.main_orm_session.clear()
+    M.artifact_orm_session.clear()
+    c.project = M.Project.query.get(_id=project_id)
+    try:
+        render_markdown(ref_ids)
+    except CompoundError, err:
+        return err.format_error()
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        M.main_orm_session.clear()
+        M.artifact_orm_session.clear()
@@ -15,7 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import sys
+import traceback
+import multiprocessing
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import groupby
@@ -82,6 +85,12 @@ class ReindexCommand(base.Command):
         help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                       'Allura root) to .ini file defining ming configuration.')
+    parser.add_option('--processes', dest='processes', type=int, default=1,
+                      help='Solarize and index artifacts in this many processes in parallel '
+                           '(not used with --tasks)')
+    parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                      help='File to record the last fully reindexed project in.  If it exists, '
+                           'reindexing resumes after that project.')
 
     def command(self):
         from allura import model as M
@@ -102,6 +111,15 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
+        last_done = self._read_checkpoint()
+        if last_done:
+            base.log.info('Resuming reindex after project %s', last_done)
+            q_project['_id'] = {'$gt': last_done}
+        self.pool = None
+        if self.options.processes > 1 and not self.options.tasks:
+            self.pool = multiprocessing.Pool(self.options.processes)
+        self.pending = []
+
         for projects in utils.chunked_find(M.Project, q_project):
             for p in projects:
                 c.project = p
@@ -142,21 +160,60 @@ def command(self):
                         base.log.error('%s', err.format_error())
                     M.main_orm_session.flush()
                     M.main_orm_session.clear()
+                self._wait_for_pending()
+                self._write_checkpoint(p._id)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
 
+    def _read_checkpoint(self):
+        from bson import ObjectId
+        path = self.options.checkpoint
+        if path and os.path.exists(path):
+            with open(path) as f:
+                last_done = f.read().strip()
+            if last_done:
+                return ObjectId(last_done)
+
+    def _write_checkpoint(self, project_id):
+        path = self.options.checkpoint
+        if path:
+            with open(path + '.tmp', 'w') as f:
+                f.write(str(project_id))
+            os.rename(path + '.tmp', path)
+
+    def _wait_for_pending(self):
+        for result in self.pending:
+            error = result.get()
+            if error:
+                base.log.error('Error indexing artifacts:\n%s', error)
+        self.pending = []
+
     @property
     def add_artifact_kwargs(self):
         if self.options.solr_hosts:
             return {'solr_hosts': self.options.solr_hosts.split(',')}
-        return {}
+        # the solr index may have been cleared, so send whole docs
+        return {'atomic_updates': False}
 
     def _chunked_add_artifacts(self, ref_ids):
         # ref_ids contains solr index ids which can easily be over
         # 100 bytes. Here we allow for 160 bytes avg, plus
         # room for other document overhead.
-        for chunk in utils.chunked_list(ref_ids, self.options.max_chunk):
+        max_chunk = self.options.max_chunk
+        if getattr(self, 'pool', None):
+            # smaller chunks, so that they spread over the worker processes
+            max_chunk = min(max_chunk, 1000)
+        for chunk in utils.chunked_list(ref_ids, max_chunk):
             if self.options.tasks:
                 self._post_add_artifacts(chunk)
+            elif getattr(self, 'pool', None):
+                kw = dict(update_solr=self.options.solr,
+                          update_refs=self.options.refs,
+                          **self.add_artifact_kwargs)
+                self.pending.append(self.pool.apply_async(
+                    _add_artifacts_in_subprocess, (c.project._id, chunk, kw)))
             else:
                 add_artifacts(chunk,
                               update_solr=self.options.solr,
@@ -199,6 +256,25 @@ def noop_cm(*args):
         return contextmanager(noop_cm)
 
 
+def _add_artifacts_in_subprocess(project_id, ref_ids, kw):
+    '''Run by ``reindex --processes``.  Returns a formatted error, if any,
+    since exceptions with tracebacks can't be sent back to the parent.'''
+    from allura import model as M
+    M.main_orm_session.clear()
+    M.artifact_orm_session.clear()
+    c.project = M.Project.query.get(_id=project_id)
+    try:
+        add_artifacts(ref_ids, **kw)
+        M.main_orm_session.flush()
+    except CompoundError, err:
+        return err.format_error()
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        M.main_orm_session.clear()
+        M.artifact_orm_session.clear()
+
+
 class EnsureIndexCommand(base.Command):
     min_args = 1
     max_args = 1
@@ -16,6 +16,7 @@
 #       under the License.
 
 import logging
+import math
 import os
 import time
 import Queue
@@ -29,7 +30,7 @@
 from setproctitle import setproctitle, getproctitle
 import tg
 from paste.deploy import loadapp
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, aslist
 from webob import Request
 
 import base
@@ -54,13 +55,76 @@ def proctitle(title):
         raise
 
 
+class WorkerPool(object):
+
+    '''A set of forked taskd worker processes handling tasks that match
+    `only`, scaled between `min_workers` and `max_workers` based on how many
+    matching tasks are ready.  Used by ``taskd --supervisor``.
+
+    A pool configured without `only` takes every task the other pools don't.
+    '''
+
+    def __init__(self, name, only=None, min_workers=1, max_workers=1,
+                 tasks_per_worker=10):
+        self.name = name
+        self.only = only
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.tasks_per_worker = tasks_per_worker
+        self.children = {}  # pid -> start time
+        self.stopping = set()
+        self.last_crash = 0
+
+    def __repr__(self):
+        return '<WorkerPool %s only=%s %d-%d>' % (
+            self.name, self.only, self.min_workers, self.max_workers)
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build the pools listed in ``taskd.pools``, each configured with
+        ``taskd.pool.<name>.only`` (comma-separated task names, ``*``
+        wildcards allowed), ``.min``, ``.max`` and ``.tasks_per_worker``'''
+        pools = []
+        for name in aslist(config.get('taskd.pools'), ','):
+            prefix = 'taskd.pool.%s.' % name
+            min_workers = asint(config.get(prefix + 'min', 1))
+            pools.append(cls(
+                name,
+                only=aslist(config.get(prefix + 'only'), ',') or None,
+                min_workers=min_workers,
+                max_workers=asint(config.get(prefix + 'max', min_workers)),
+                tasks_per_worker=asint(config.get(prefix + 'tasks_per_worker', 10))))
+        claimed = [name for pool in pools for name in pool.only or []
+                   if not name.startswith('!')]
+        for pool in pools:
+            if pool.only is None and claimed:
+                pool.only = ['!' + name for name in claimed]
+        return pools
+
+    def wanted(self, queue_depth):
+        '''Number of workers this pool should have for `queue_depth` ready tasks'''
+        wanted = int(math.ceil(float(queue_depth) / self.tasks_per_worker))
+        return max(self.min_workers, min(self.max_workers, wanted))
+
+    def running(self):
+        '''pids of workers that haven't been asked to stop, oldest first'''
+        return sorted((pid for pid in self.children if pid not in self.stopping),
+                      key=self.children.get)
+
+
 class TaskdCommand(base.Command):
     summary = 'Task server'
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
-                      help='only handle tasks of the given name(s) (can be comma-separated list)')
+                      help='only handle tasks of the given name(s) (can be comma-separated list, '
+                           '"*" wildcards allowed, names prefixed with "!" are excluded)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=None,
+                      help='claim and run up to this many tasks at once, in one request (default: monq.batch_size or 1)')
+    parser.add_option('--supervisor', dest='supervisor', action='store_true', default=False,
+                      help='fork and supervise a pool of workers per taskd.pools entry in the config, instead of '
+                           'running a single worker')
 
     def command(self):
         setproctitle('taskd')
@@ -77,7 +141,10 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.supervisor:
+            self.supervise()
+        else:
+            self.worker()
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -107,6 +174,9 @@ def worker(self):
         only = self.options.only
         if only:
             only = only.split(',')
+        batch_size = self.options.batch_size or asint(
+            pylons.config.get('monq.batch_size', 1))
+        batch_max_time = asint(pylons.config.get('monq.batch_max_time', 30))
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,6 +187,9 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        def waitfunc_wakeup():
+            wakeup.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -125,11 +198,25 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if M.MonQWakeup.enabled():
+            wakeup = M.MonQWakeup(only=only)
+            waitfunc = waitfunc_wakeup
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
                 while self.keep_running:
+                    if batch_size > 1:
+                        self.task = M.MonQTask.get_batch(
+                            process=name,
+                            batch_size=batch_size,
+                            waitfunc=waitfunc,
+                            only=only)
+                        if self.task:
+                            self.run_batch(wsgi_app, start_response,
+                                           batch_max_time)
+                        continue
                     self.task = M.MonQTask.get(
                         process=name,
                         waitfunc=waitfunc,
@@ -161,6 +248,113 @@ def waitfunc_checks_running():
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def supervise(self):
+        from allura import model as M
+        pools = WorkerPool.from_config(tg.config)
+        if not pools:
+            base.log.error('taskd --supervisor needs taskd.pools set in the config')
+            return
+        interval = asint(tg.config.get('taskd.supervisor_interval', 5))
+        restart_delay = asint(tg.config.get('taskd.restart_delay', 10))
+        setproctitle('taskd:supervisor')
+        base.log.info('taskd supervisor pid %s managing %s' % (os.getpid(), pools))
+        while self.keep_running:
+            self.reap_children(pools)
+            for pool in pools:
+                try:
+                    depth = M.MonQTask.ready_count(pool.only)
+                except Exception:
+                    base.log.exception('Could not get queue depth for %s', pool)
+                    depth = 0
+                running = pool.running()
+                wanted = pool.wanted(depth)
+                if len(running) < wanted:
+                    # don't respawn in a tight loop if children keep crashing
+                    if time.time() - pool.last_crash > restart_delay:
+                        for i in range(wanted - len(running)):
+                            self.spawn_worker(pool)
+                elif len(running) > wanted:
+                    # scale down gently, one worker per check
+                    self.stop_worker(pool, running[-1])
+            time.sleep(interval)
+
+        base.log.info('taskd supervisor pid %s stopping workers' % os.getpid())
+        for pool in pools:
+            for pid in pool.running():
+                self.stop_worker(pool, pid)
+        while any(pool.children for pool in pools):
+            self.reap_children(pools)
+            time.sleep(1)
+        base.log.info('taskd supervisor pid %s stopping gracefully.' % os.getpid())
+
+        if self.restart_when_done:
+            base.log.info('taskd supervisor pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def spawn_worker(self, pool):
+        pid = os.fork()
+        if pid:
+            pool.children[pid] = time.time()
+            base.log.info('taskd supervisor started worker %s for %s', pid, pool)
+            return
+        status = 0
+        try:
+            # restarts are handled by the supervisor, which waits for its
+            # children to stop and then starts new ones
+            signal.signal(signal.SIGHUP, self.graceful_stop)
+            self.options.only = ','.join(pool.only) if pool.only else None
+            setproctitle('taskd:%s' % pool.name)
+            self.worker()
+        except Exception:
+            base.log.exception('taskd worker for %s failed', pool)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop_worker(self, pool, pid):
+        base.log.info('taskd supervisor stopping worker %s for %s', pid, pool)
+        pool.stopping.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass  # already gone, will be reaped
+
+    def reap_children(self, pools):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return  # no children left
+            if not pid:
+                return
+            for pool in pools:
+                if pid not in pool.children:
+                    continue
+                del pool.children[pid]
+                if pid in pool.stopping:
+                    pool.stopping.discard(pid)
+                elif status:
+                    base.log.error('taskd worker %s for %s exited with status %s; restarting',
+                                   pid, pool, status)
+                    pool.last_crash = time.time()
+
+    def run_batch(self, wsgi_app, start_response, max_time):
+        tasks = self.task
+        with(proctitle("taskd:batch:{0}:{1}".format(
+                len(tasks), tasks[0]._id))):
+            # Build one (fake) request for the whole batch
+            request_path = '/--batch--/%s/' % tasks[0]._id
+            r = Request.blank(request_path,
+                              base_url=tg.config['base_url'].rstrip(
+                                  '/') + request_path,
+                              environ={'task': tasks[0],
+                                       'tasks': tasks,
+                                       'batch_max_time': max_time,
+                                       'nocapture': self.options.nocapture,
+                                       })
+            list(wsgi_app(r.environ, start_response))
+            self.task = None
+
 
 class TaskCommand(base.Command):
     summary = 'Task command'
@@ -171,7 +365,7 @@ class TaskCommand(base.Command):
                       help='timeout (in seconds) for busy tasks')
     min_args = 2
     max_args = None
-    usage = '<ini file> [list|retry|purge|timeout|commit]'
+    usage = '<ini file> [list|retry|purge|timeout|commit|coalesced]'
 
     def command(self):
         self.basic_setup()
@@ -181,7 +375,8 @@ def command(self):
             retry=self._retry,
             purge=self._purge,
             timeout=self._timeout,
-            commit=self._commit)
+            commit=self._commit,
+            coalesced=self._coalesced)
         tab[cmd]()
 
     def _list(self):
@@ -219,6 +414,13 @@ def _timeout(self):
         cutoff = datetime.utcnow() - timedelta(seconds=self.options.timeout)
         M.MonQTask.timeout_tasks(cutoff)
 
+    def _coalesced(self):
+        '''Show how many task posts were merged into pending tasks'''
+        from allura import model as M
+        base.log.info('Posts coalesced into other tasks, by task name')
+        for name, count in sorted(M.MonQTask.coalesce_stats().items()):
+            print '%8d %s' % (count, name)
+
     def _commit(self):
         '''Schedule a SOLR commit'''
         from allura.tasks import index_tasks
@@ -183,7 +183,7 @@ def _lookup(self, id, *remainder):
 
     @with_trailing_slash
     @expose('jinja:allura:templates/discussion/thread.html')
-    def index(self, limit=None, page=0, count=0, **kw):
+    def index(self, limit=None, page=0, count=0, after=None, **kw):
         c.thread = self.W.thread
         c.thread_header = self.W.thread_header
         limit, page, start = g.handle_paging(limit, page)
@@ -197,6 +197,7 @@ def index(self, limit=None, page=0, count=0, **kw):
                     page=int(page),
                     count=int(count),
                     limit=int(limit),
+                    after=after or None,
                     show_moderate=kw.get('show_moderate'))
 
     def error_handler(self, *args, **kwargs):
@@ -492,16 +493,17 @@ def reply(self, **kw):
         require_access(self.thread, 'post')
         kw = self.W.edit_post.to_python(kw, None)
         post = self.thread.post(parent_id=self.post._id, **kw)
-        self.thread.num_replies += 1
         redirect(post.slug.split('/')[-1] + '/')
 
 
 class ThreadRestController(ThreadController):
 
     @expose('json:')
-    def index(self, limit=25, page=None, **kw):
+    def index(self, limit=25, page=None, after=None, **kw):
         limit, page = h.paging_sanitizer(limit, page)
-        return dict(thread=self.thread.__json__(limit=limit, page=page))
+        after = self.thread.parse_posts_cursor(after)
+        return dict(thread=self.thread.__json__(limit=limit, page=page,
+                                                after=after))
 
     @h.vardec
     @expose()
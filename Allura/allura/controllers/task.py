@@ -26,8 +26,15 @@ class TaskController(object):
     '''
 
     def __call__(self, environ, start_response):
-        task = environ['task']
         nocapture = environ['nocapture']
+        tasks = environ.get('tasks')
+        if tasks:
+            from allura import model as M
+            M.MonQTask.run_batch(tasks, nocapture=nocapture,
+                                 max_time=environ.get('batch_max_time'))
+            start_response('200 OK', [])
+            return []
+        task = environ['task']
         result = task(restore_context=False, nocapture=nocapture)
         start_response('200 OK', [])
         return [result]
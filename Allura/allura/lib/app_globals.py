@@ -88,6 +88,23 @@ def convert(self, source, render_limit=True):
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
 
+    cache_bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+
+    def get_cached(self, artifact, field_name):
+        """Return the cached html for ``artifact.field_name`` if there is a
+        valid cache for its current source, else None.  Never renders or
+        updates the cache.
+
+        """
+        source_text = getattr(artifact, field_name, None)
+        cache = getattr(artifact, field_name + '_cache', None)
+        if not source_text or not cache or cache.md5 is None or "[[" in source_text:
+            return None
+        md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+        if cache.md5 == md5 and getattr(cache, 'fix7528', False) == self.cache_bugfix_rev:
+            return h.html.literal(cache.html)
+        return None
+
     def cached_convert(self, artifact, field_name):
         """Convert ``artifact.field_name`` markdown source to html, caching
         the result if the render time is greater than the defined threshold.
@@ -105,7 +122,7 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 3  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+        bugfix_rev = self.cache_bugfix_rev
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
@@ -127,17 +144,39 @@ def cached_convert(self, artifact, field_name):
                      '"markdown_cache_threshold" must be a float.')
 
         if threshold is not None and render_time > threshold:
-            # Save the cache
-            if md5 is None:
-                md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            cache.md5, cache.html, cache.render_time = md5, html, render_time
-            cache.fix7528 = bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
-
-            # Prevent cache creation from updating the mod_date timestamp.
-            _session = artifact_orm_session._get()
-            _session.skip_mod_date = True
+            self._save_cache(cache, source_text, html, render_time, md5)
         return html
 
+    def fill_cache(self, artifact, field_name):
+        """Render ``artifact.field_name`` and store the html in its cache,
+        however long it takes, unless the cache is already valid.  This is
+        what the ``render_markdown`` task does ahead of :meth:`cached_convert`.
+
+        Returns True if the cache was (re)filled.
+
+        """
+        source_text = getattr(artifact, field_name, None)
+        cache = getattr(artifact, field_name + '_cache', None)
+        # macro output can change without the source changing, so is never cached
+        if not source_text or not cache or "[[" in source_text:
+            return False
+        if self.get_cached(artifact, field_name) is not None:
+            return False
+        start = time.time()
+        html = self.convert(source_text, render_limit=False)
+        self._save_cache(cache, source_text, html, time.time() - start)
+        return True
+
+    def _save_cache(self, cache, source_text, html, render_time, md5=None):
+        if md5 is None:
+            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+        cache.md5, cache.html, cache.render_time = md5, html, render_time
+        cache.fix7528 = self.cache_bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+
+        # Prevent cache creation from updating the mod_date timestamp.
+        _session = artifact_orm_session._get()
+        _session.skip_mod_date = True
+
 
 class Globals(object):
 
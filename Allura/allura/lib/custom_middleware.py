@@ -322,6 +322,8 @@ def timers(self):
             Timer('urlopen', urllib2, 'urlopen'),
             Timer('base_repo_tool.{method_name}',
                   allura.model.repository.RepositoryImplementation, 'last_commit_ids'),
+            Timer('base_repo_tool.{method_name}',
+                  allura.model.repository, 'run_lcd_job'),
         ] + [Timer('sidebar', ep.load(), 'sidebar_menu') for ep in tool_entry_points]
 
         try:
@@ -340,6 +342,13 @@ def timers(self):
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        try:
+            acl_stats = allura.credentials.acl_stats
+        except TypeError:
+            pass  # no credentials registered for this request
+        else:
+            stat_record.add('acl_cache_hits', acl_stats['hits'])
+            stat_record.add('acl_cache_misses', acl_stats['misses'])
         return stat_record
 
     def entry_point_timers(self):
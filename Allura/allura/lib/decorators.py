@@ -62,12 +62,14 @@ def myotherfunc():
     def task_(func):
         def post(*args, **kwargs):
             delay = kwargs.pop('delay', 0)
+            coalesce_key = kwargs.pop('coalesce_key', None)
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       coalesce_key=coalesce_key)
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
@@ -20,7 +20,6 @@
 from urlparse import urljoin
 
 from tg import config
-from bs4 import BeautifulSoup
 import html5lib
 import html5lib.serializer
 import html5lib.filters.alphabeticalattributes
@@ -250,6 +249,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['html_block'].markdown_in_raw = True
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('forge_links', ForgeLinkPreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -261,10 +261,9 @@ def extendMarkdown(self, md, md_globals):
         md.inlinePatterns.add('macro', ForgeMacroPattern(MACRO_PATTERN, md, ext=self), '<link')
         self.forge_link_tree_processor = ForgeLinkTreeProcessor(md)
         md.treeprocessors['links'] = self.forge_link_tree_processor
-        # Sanitize HTML
-        md.postprocessors['sanitize_html'] = HTMLSanitizer()
-        # Rewrite all relative links that don't start with . to have a '../' prefix
-        md.postprocessors['rewrite_relative_links'] = RelativeLinkRewriter(make_absolute=self._is_email)
+        # Sanitize HTML, and rewrite all relative links that don't start with .
+        # to have a '../' prefix
+        md.postprocessors['sanitize_html'] = RelativeLinkRewriter(make_absolute=self._is_email)
         # Put a class around markdown content for custom css
         md.postprocessors['add_custom_class'] = AddCustomClass()
         md.postprocessors['mark_safe'] = MarkAsSafe()
@@ -273,6 +272,33 @@ def reset(self):
         self.forge_link_tree_processor.reset()
 
 
+class ForgeLinkPreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''Finds everything that may be an artifact link, so that
+    :class:`ForgeLinkPattern` can look them up in one go rather than
+    one at a time.  Anything missed here is still looked up when it is
+    expanded.'''
+
+    link_re = re.compile(r'\[([^\[\]\n]+)\](?:\(\s*([^\s()]+))?')
+
+    def __init__(self, md, ext):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+
+    def run(self, lines):
+        links = set()
+        for m in self.link_re.finditer('\n'.join(lines)):
+            for link in m.groups():
+                if not link or link == 'TOC':
+                    continue
+                links.add(link)
+                attach_link = link.split('/attachment/')
+                if len(attach_link) == 2:
+                    links.add(attach_link[0])
+        self.ext.forge_link_tree_processor.prefetch(links)
+        return lines
+
+
 class ForgeLinkPattern(markdown.inlinepatterns.LinkPattern):
 
     artifact_re = re.compile(r'((.*?):)?((.*?):)?(.+)')
@@ -322,7 +348,7 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
+        shortlink = self.ext.forge_link_tree_processor.lookup(link)
         if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
             href = shortlink.url
             if getattr(shortlink.ref.artifact, 'is_closed', False):
@@ -333,7 +359,7 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
+            shortlink = self.ext.forge_link_tree_processor.lookup(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
                 for attach in shortlink.ref.artifact.attachments:
@@ -394,6 +420,7 @@ class ForgeLinkTreeProcessor(markdown.treeprocessors.Treeprocessor):
     def __init__(self, parent):
         self.parent = parent
         self.alinks = []
+        self.shortlinks = {}
 
     def run(self, root):
         for node in root.getiterator('a'):
@@ -403,6 +430,20 @@ def run(self, root):
 
     def reset(self):
         self.alinks = []
+        self.shortlinks = {}
+
+    def prefetch(self, links):
+        '''Resolve all the given links, and load their artifacts, up front'''
+        self.shortlinks = M.Shortlink.from_links(*links)
+        M.ArtifactReference.prefetch_artifacts(set(
+            sl.ref_id for sl in self.shortlinks.itervalues() if sl))
+
+    def lookup(self, link):
+        '''Return the Shortlink for a link, prefetched if possible'''
+        try:
+            return self.shortlinks[link]
+        except KeyError:
+            return M.Shortlink.lookup(link)
 
 
 class MarkAsSafe(markdown.postprocessors.Postprocessor):
@@ -417,40 +458,77 @@ def run(self, text):
         return '<div class="markdown_content">%s</div>' % text
 
 
-class RelativeLinkRewriter(markdown.postprocessors.Postprocessor):
+class HTMLSanitizer(markdown.postprocessors.Postprocessor):
+
+    def run(self, text):
+        parser = html5lib.HTMLParser(tokenizer=ForgeHTMLSanitizer)
+        parsed = parser.parse(text)
+        serializer = html5lib.serializer.HTMLSerializer()
+        walker = html5lib.getTreeWalker("etree")
+        stream = html5lib.filters.alphabeticalattributes.Filter(walker(parsed))
+        out = ''.join(serializer.serialize(stream))
+        return out
+
+
+class RelativeLinkRewriter(HTMLSanitizer):
+
+    '''Sanitizes the html like :class:`HTMLSanitizer`, and rewrites links
+    (relative ones to be relative to the parent page, or absolute for email,
+    and external ones with rel="nofollow") on the same token stream, so the
+    html is only parsed once.
+
+    The output is serialized the way BeautifulSoup did when links were
+    rewritten in a second pass.
+    '''
 
     def __init__(self, make_absolute=False):
         self._make_absolute = make_absolute
 
     def run(self, text):
-        soup = BeautifulSoup(text, 'html5lib')  # 'html.parser' parser gives weird </li> behaviour with test_macro_members
+        parser = html5lib.HTMLParser(tokenizer=ForgeHTMLSanitizer, namespaceHTMLElements=False)
+        body = next(parser.parse(text).iter('body'))
+        serializer = html5lib.serializer.HTMLSerializer(
+            quote_attr_values=True,
+            omit_optional_tags=False,
+            minimize_boolean_attributes=False,
+            use_trailing_solidus=True,
+            space_before_trailing_solidus=False,
+            escape_lt_in_attrs=True)
+        walker = html5lib.getTreeWalker("etree")
+        stream = html5lib.filters.alphabeticalattributes.Filter(
+            self._rewrite_links(walker(body)))
+        return u''.join(serializer.serialize(stream))
 
+    def _rewrite_links(self, stream):
         if self._make_absolute:
             rewrite = self._rewrite_abs
         else:
             rewrite = self._rewrite
-        for link in soup.findAll('a'):
-            rewrite(link, 'href')
-        for link in soup.findAll('img'):
-            rewrite(link, 'src')
-
-        # html5lib parser adds html/head/body tags, so output <body> without its own tags
-        return unicode(soup.body)[len('<body>'):-len('</body>')]
-
-    def _rewrite(self, tag, attr):
-        val = tag.get(attr)
+        for token in stream:
+            if token.get('name') == 'body':
+                # output the body's content without its own tags
+                continue
+            if token['type'] in ('StartTag', 'EmptyTag'):
+                if token['name'] == 'a':
+                    rewrite(token['data'], 'href')
+                elif token['name'] == 'img':
+                    rewrite(token['data'], 'src')
+            yield token
+
+    def _rewrite(self, attrs, attr):
+        val = attrs.get((None, attr))
         if val is None:
             return
         if ' ' in val:
             # Don't urllib.quote to avoid possible double-quoting
             # just make sure no spaces
             val = val.replace(' ', '%20')
-            tag[attr] = val
+            attrs[(None, attr)] = val
         if '://' in val:
             for domain in re.split(r'\s*,\s*', config.get('nofollow_exempt_domains', '')):
                 if domain and domain in val:
                     return
-            tag['rel'] = 'nofollow'
+            attrs[(None, 'rel')] = 'nofollow'
             return
         if val.startswith('/'):
             return
@@ -460,25 +538,13 @@ def _rewrite(self, tag, attr):
             return
         if val.startswith('#'):
             return
-        tag[attr] = '../' + val
+        attrs[(None, attr)] = '../' + val
 
-    def _rewrite_abs(self, tag, attr):
-        self._rewrite(tag, attr)
-        val = tag.get(attr)
+    def _rewrite_abs(self, attrs, attr):
+        self._rewrite(attrs, attr)
+        val = attrs.get((None, attr))
         val = urljoin(config['base_url'], val)
-        tag[attr] = val
-
-
-class HTMLSanitizer(markdown.postprocessors.Postprocessor):
-
-    def run(self, text):
-        parser = html5lib.HTMLParser(tokenizer=ForgeHTMLSanitizer)
-        parsed = parser.parse(text)
-        serializer = html5lib.serializer.HTMLSerializer()
-        walker = html5lib.getTreeWalker("etree")
-        stream = html5lib.filters.alphabeticalattributes.Filter(walker(parsed))
-        out = ''.join(serializer.serialize(stream))
-        return out
+        attrs[(None, attr)] = val
 
 
 class AutolinkPattern(markdown.inlinepatterns.Pattern):
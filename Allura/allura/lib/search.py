@@ -17,6 +17,7 @@
 
 import re
 import socket
+import hashlib
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
@@ -86,20 +87,45 @@ def should_update_index(self, old_doc, new_doc):
         """
         return old_doc != new_doc
 
+    # whether solr_text() adds the values of other fields to the text, so that
+    # an atomic update of those fields has to send the text as well
+    solr_text_has_fields = False
+
     def solarize(self):
         doc = self.index()
         if doc is None:
             return None
+        doc['text'] = self.solr_text(doc)
+        return doc
+
+    def solr_text(self, doc):
+        """Plain text to send to solr as the ``text`` of :meth:`index`
+        document `doc`."""
         # if index() returned doc without text, assume empty text
         text = doc.get('text')
         if text is None:
-            text = doc['text'] = ''
+            text = ''
 
         # Convert text to plain text (It usually contains markdown markup).
         # To do so, we convert markdown into html, and then strip all html tags.
-        text = g.markdown.convert(text)
-        doc['text'] = jinja2.Markup.escape(text).striptags()
-        return doc
+        # If the text is a markdown field with a valid html cache, use that
+        # instead of rendering it again.
+        html = None
+        field_name = self._markdown_cache_field(text)
+        if field_name:
+            html = g.markdown.get_cached(self, field_name)
+        if html is None:
+            html = g.markdown.convert(text)
+        return jinja2.Markup.escape(html).striptags()
+
+    def _markdown_cache_field(self, text):
+        """Name of the markdown field (with a ``<name>_cache``) that `text`
+        came from, if any."""
+        for field_name in ('text', 'description'):
+            if (getattr(self, field_name + '_cache', None) is not None and
+                    getattr(self, field_name, None) == text):
+                return field_name
+        return None
 
     @classmethod
     def translate_query(cls, q, fields):
@@ -124,6 +150,38 @@ class SearchError(SolrError):
     pass
 
 
+def solr_field_hashes(doc):
+    '''Return {field: hash of value} for an :meth:`SearchIndexable.index`
+    document, to tell later which fields of it changed.'''
+    return dict((k, hashlib.md5(repr(v)).hexdigest())
+                for k, v in doc.iteritems() if k != 'id')
+
+
+# Fields that solr_config's schema copies into other fields with copyField.
+# An atomic update re-applies the copy on top of the stored destination field,
+# which then accumulates old and new values, so these need whole documents.
+SOLR_COPY_FIELD_SOURCES = ('labels_t',)
+
+
+def changed_solr_fields(old_hashes, new_hashes, doc):
+    '''Return the fields of `doc` whose values changed since `old_hashes`
+    were taken, if the change can be sent to solr as an atomic update of just
+    those fields.  Returns None if the whole document has to be re-added:
+    when there are no old hashes, the text (which needs markdown rendering)
+    changed, or fields were added or removed.'''
+    if not old_hashes or set(old_hashes) != set(new_hashes):
+        return None
+    changed = [k for k, v in new_hashes.iteritems() if old_hashes[k] != v]
+    if 'text' in changed:
+        return None
+    if any(k in SOLR_COPY_FIELD_SOURCES for k in changed):
+        return None
+    if any(doc[k] is None or doc[k] == '' or doc[k] == [] for k in changed):
+        # solr clients drop empty values, so these can't be 'set'
+        return None
+    return changed
+
+
 def inject_user(q, user=None):
     '''Replace $USER with current user's name.'''
     if user is None:
@@ -146,9 +204,14 @@ def search(q, short_timeout=False, ignore_errors=True, **kw):
                               (match.group(1) if match else e))
 
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None,
+                    facet_queries=None, **kw):
     """Performs SOLR search.
 
+    `facet_queries` may be a dict of {key: query}; each query is translated
+    like `q` and sent as a ``facet.query``, so its count is returned under
+    ``facets['facet_queries'][key]`` of the result.
+
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
@@ -176,6 +239,11 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
         fq.append(' OR '.join(parts))
     if not history:
         fq.append('is_history_b:False')
+    if facet_queries:
+        kw['facet'] = 'true'
+        kw['facet.query'] = [
+            u'{!key=%s}%s' % (key, atype.translate_query(fq_, fields))
+            for key, fq_ in facet_queries.iteritems()]
     return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
 
 
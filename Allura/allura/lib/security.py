@@ -19,23 +19,97 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, OrderedDict
+from threading import Lock
 
 from pylons import tmpl_context as c
 from pylons import request
 from webob import exc
 from itertools import chain
 from ming.utils import LazyProperty
+from paste.deploy.converters import asint
+import tg
 
 from allura.lib.utils import TruthyCallable
 
 log = logging.getLogger(__name__)
 
 
+class SharedRoleCache(object):
+
+    '''
+    Process-wide LRU cache of project role documents, shared between
+    requests.  Keys include the project's role stamp, which changes
+    whenever one of its roles does (see
+    :func:`~allura.model.auth.bump_role_stamp`), so outdated entries are
+    simply never looked up again.  Entries also expire after `ttl` seconds,
+    as a bound on how long a missed bump can go unnoticed.
+    '''
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._roles = OrderedDict()  # key -> (expiry, roles), LRU first
+        self._lock = Lock()
+
+    def get(self, key):
+        '''Return a copy of the role docs cached for key (whose second item
+        is always a project id), or None'''
+        with self._lock:
+            entry = self._roles.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._roles[key] = entry
+            self.hits += 1
+        return [dict(r) for r in entry[1]]
+
+    def set(self, key, roles):
+        with self._lock:
+            self._roles.pop(key, None)
+            self._roles[key] = (time.time() + self.ttl, [dict(r) for r in roles])
+            while len(self._roles) > self.max_entries:
+                self._roles.popitem(last=False)
+
+    def invalidate(self, project_id):
+        with self._lock:
+            for key in [k for k in self._roles if k[1] == project_id]:
+                del self._roles[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, count=len(self._roles))
+
+
+_shared_role_cache = None
+_shared_role_cache_lock = Lock()
+
+
+def shared_role_cache():
+    '''Return the process-wide :class:`SharedRoleCache`, holding up to
+    security.role_cache_size entries (default 10000) for
+    security.role_cache_ttl seconds (default 60), or None if either is 0'''
+    global _shared_role_cache
+    with _shared_role_cache_lock:
+        if _shared_role_cache is None:
+            max_entries = asint(tg.config.get('security.role_cache_size', 10000))
+            ttl = asint(tg.config.get('security.role_cache_ttl', 60))
+            if not max_entries or not ttl:
+                return None
+            _shared_role_cache = SharedRoleCache(max_entries, ttl)
+        return _shared_role_cache
+
+
 class Credentials(object):
 
     '''
     Role graph logic & caching
+
+    Roles are cached for the request, and across requests in the
+    :class:`SharedRoleCache`.
     '''
 
     def __init__(self):
@@ -62,6 +136,12 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.groups = {}
+        self.stamps = {}
+        self.acls = {}
+        self.acl_version = 0
+        self.acl_decisions = {}
+        self.acl_stats = dict(hits=0, misses=0)
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -71,13 +151,56 @@ def clear_user(self, user_id, project_id=None):
             to_remove = [(user_id, project_id)]
         for uid, pid in to_remove:
             self.projects.pop(pid, None)
+            self.groups.pop(pid, None)
+            self.stamps.pop(pid, None)
             self.users.pop((uid, pid), None)
 
+    def role_stamp(self, project_id):
+        '''
+        :returns: the role stamp of the given (root) project, as of the
+                  first time it's needed in this request
+        '''
+        if project_id not in self.stamps:
+            from allura import model as M
+            db = M.session.main_doc_session.db
+            doc = db[M.project_role_stamp.__mongometa__.name].find_one(
+                {'_id': project_id})
+            self.stamps[project_id] = doc and doc.get('stamp')
+        return self.stamps[project_id]
+
+    def _load_shared(self, kind, project_ids, loaded, extra=()):
+        '''Fill `loaded` (keyed by project id) with role docs from the
+        :class:`SharedRoleCache`, and return the project ids not found there'''
+        shared = shared_role_cache()
+        if shared is None:
+            return project_ids
+        missing = []
+        for pid in project_ids:
+            # the stamp must be read before querying any roles that miss,
+            # so they are never cached under a newer stamp than their own
+            roles = shared.get((kind, pid, self.role_stamp(pid)) + extra)
+            if roles is None:
+                missing.append(pid)
+            else:
+                loaded[pid] = roles
+        return missing
+
+    def _save_shared(self, kind, roles_by_project, extra=()):
+        shared = shared_role_cache()
+        if shared is None:
+            return
+        for pid, roles in roles_by_project.iteritems():
+            shared.set((kind, pid, self.role_stamp(pid)) + extra, roles)
+
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
         # Don't reload roles
         project_ids = [
             pid for pid in project_ids if self.users.get((user_id, pid)) is None]
+        cached = {}
+        project_ids = self._load_shared('user', project_ids, cached, (user_id,))
+        for pid, roles in cached.iteritems():
+            self.users[user_id, pid] = RoleCache(self, roles)
         if not project_ids:
             return
         if user_id is None:
@@ -98,6 +221,7 @@ def load_user_roles(self, user_id, *project_ids):
         roles_by_project = dict((pid, []) for pid in project_ids)
         for role in q:
             roles_by_project[role['project_id']].append(role)
+        self._save_shared('user', roles_by_project, (user_id,))
         for pid, roles in roles_by_project.iteritems():
             self.users[user_id, pid] = RoleCache(self, roles)
 
@@ -106,6 +230,10 @@ def load_project_roles(self, *project_ids):
         # Don't reload roles
         project_ids = [
             pid for pid in project_ids if self.projects.get(pid) is None]
+        cached = {}
+        project_ids = self._load_shared('project', project_ids, cached)
+        for pid, roles in cached.iteritems():
+            self.projects[pid] = RoleCache(self, roles)
         if not project_ids:
             return
         q = self.project_role.find({
@@ -113,9 +241,29 @@ def load_project_roles(self, *project_ids):
         roles_by_project = dict((pid, []) for pid in project_ids)
         for role in q:
             roles_by_project[role['project_id']].append(role)
+        self._save_shared('project', roles_by_project)
         for pid, roles in roles_by_project.iteritems():
             self.projects[pid] = RoleCache(self, roles)
 
+    def group_roles(self, *project_ids):
+        '''
+        :returns: a dict of the roles of the given projects which aren't a
+                  single user's (named roles, ``*anonymous``,
+                  ``*authenticated``), by _id
+        '''
+        missing = [pid for pid in project_ids if pid not in self.groups]
+        missing = self._load_shared('groups', missing, self.groups)
+        if missing:
+            q = self.project_role.find({
+                'project_id': {'$in': missing},
+                'user_id': None})
+            roles_by_project = dict((pid, []) for pid in missing)
+            for role in q:
+                roles_by_project[role['project_id']].append(role)
+            self._save_shared('groups', roles_by_project)
+            self.groups.update(roles_by_project)
+        return dict((r['_id'], r) for pid in project_ids for r in self.groups[pid])
+
     def project_roles(self, project_id):
         '''
         :returns: a :class:`RoleCache` of :class:`ProjectRoles <allura.model.auth.ProjectRole>` for project_id
@@ -144,6 +292,48 @@ def user_roles(self, user_id, project_id=None):
             self.users[user_id, project_id] = roles
         return roles
 
+    def compiled_acl(self, acl):
+        '''
+        :returns: a (version, :class:`CompiledACL`) pair for acl, where version
+                  identifies this compilation of it
+
+        ACLs are looked up by identity, and compiled again if any of their
+        entries changed since, however they were edited.  The entries are
+        only compared when the length is unchanged.
+        '''
+        entry = self.acls.get(id(acl))
+        # the entry keeps a reference to the acl, so its id can't be reused
+        if entry is None or entry[0] is not acl or len(entry[1]) != len(acl) \
+                or entry[1] != self._acl_signature(acl):
+            self.acl_version += 1
+            entry = (acl, self._acl_signature(acl), self.acl_version, CompiledACL(acl))
+            self.acls[id(acl)] = entry
+        return entry[2], entry[3]
+
+    @staticmethod
+    def _acl_signature(acl):
+        return [(ace.access, ace.role_id, ace.permission) for ace in acl]
+
+    def acl_decision(self, acl, user, project_id, permission, roles):
+        '''
+        Check permission against a single ACL for a user and their roles
+        (see :func:`has_access`), memoized for the rest of the request.
+
+        :returns: True or False if the ACL decides, else the tuple of role ids
+                  which have to be checked against the parent context
+        '''
+        version, compiled = self.compiled_acl(acl)
+        roles = tuple(roles)
+        key = (version, user._id, project_id, permission, roles)
+        result = self.acl_decisions.get(key)
+        if result is not None:
+            self.acl_stats['hits'] += 1
+            return result
+        self.acl_stats['misses'] += 1
+        result = self.acl_decisions[key] = compiled.decide(
+            self, user, project_id, permission, roles)
+        return result
+
     def user_has_any_role(self, user_id, project_id, role_ids):
         user_roles = self.user_roles(user_id=user_id, project_id=project_id)
         return bool(set(role_ids) & user_roles.reaching_ids_set)
@@ -158,6 +348,55 @@ def userids_with_named_role(self, project_id, name):
         return role.userids_that_reach
 
 
+class CompiledACL(object):
+    '''
+    An ACL indexed by (role_id, permission), so a role's first matching ACE
+    is found without scanning the whole list
+    '''
+
+    def __init__(self, acl):
+        from allura import model as M
+        self.first = {}  # (role_id, permission) -> (position, access)
+        self.denies = set()  # (role_id, permission) of DENY entries
+        for i, ace in enumerate(acl):
+            key = (ace.role_id, ace.permission)
+            self.first.setdefault(key, (i, ace.access))
+            if ace.access == M.ACE.DENY:
+                self.denies.add(key)
+
+    def access(self, role_id, permission):
+        '''Return the access of the first ACE matching role_id and permission
+        (as :meth:`ACE.match <allura.model.types.ACE.match>` does), or None'''
+        from allura import model as M
+        found = None
+        for key in ((role_id, permission),
+                    (role_id, M.ALL_PERMISSIONS),
+                    (M.EVERYONE, permission),
+                    (M.EVERYONE, M.ALL_PERMISSIONS)):
+            entry = self.first.get(key)
+            if entry is not None and (found is None or entry[0] < found[0]):
+                found = entry
+        return found and found[1]
+
+    def decide(self, cred, user, project_id, permission, roles):
+        '''Uncached version of :meth:`Credentials.acl_decision`'''
+        from allura import model as M
+        # TODO: move deny logic into loop below; see ticket [#6715]
+        if self.denies and user != M.User.anonymous():
+            for r in cred.user_roles(user_id=user._id, project_id=project_id):
+                if (r['_id'], permission) in self.denies:
+                    return False
+        chainable_roles = []
+        for rid in roles:
+            access = self.access(rid, permission)
+            if access == M.ACE.ALLOW:
+                return True
+            elif access is None:
+                # access neither allowed or denied, may chain to parent context
+                chainable_roles.append(rid)
+        return tuple(chainable_roles)
+
+
 class RoleCache(object):
     '''
     An iterable collection of :class:`ProjectRoles <allura.model.auth.ProjectRole>` that is cached after first use
@@ -247,10 +486,7 @@ def reaching_roles(self):
         def _iter():
             to_visit = self.index.items()
             project_ids = set([r['project_id'] for _id, r in to_visit])
-            pr_index = {r['_id']: r for r in self.cred.project_role.find({
-                'project_id': {'$in': list(project_ids)},
-                'user_id': None,
-            })}
+            pr_index = self.cred.group_roles(*project_ids)
             visited = set()
             while to_visit:
                 (rid, role) = to_visit.pop()
@@ -334,29 +570,11 @@ def predicate(obj=obj, user=user, project=project, roles=None):
             roles = cred.user_roles(
                 user_id=user._id, project_id=project._id).reaching_ids
 
-        # TODO: move deny logic into loop below; see ticket [#6715]
-        if user != M.User.anonymous():
-            user_roles = Credentials.get().user_roles(user_id=user._id,
-                                                      project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
-
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
+        decision = Credentials.get().acl_decision(
+            obj.acl, user, project.root_project._id, permission, roles)
+        if decision is True or decision is False:
+            return decision
+        chainable_roles = decision
         parent = obj.parent_security_context()
         if parent and chainable_roles:
             result = has_access(parent, permission, user=user, project=project)(
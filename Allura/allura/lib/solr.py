@@ -16,11 +16,16 @@
 #       under the License.
 
 import shlex
+import logging
+import threading
+import Queue
 
 from tg import config
 from paste.deploy.converters import asbool
 import pysolr
 
+log = logging.getLogger(__name__)
+
 escape_rules = {'+': r'\+',
                 '-': r'\-',
                 '&': r'\&',
@@ -97,6 +102,65 @@ def add(self, *args, **kw):
             responses.append(solr.add(*args, **kw))
         return responses
 
+    def add_pipelined(self, chunks, max_pending=2, on_done=None, **kw):
+        """Add each list of docs produced by the `chunks` iterable, posting
+        to all push servers in parallel with producing the next chunks.
+
+        `chunks` is typically a generator that solarizes artifacts as it goes,
+        so that at most `max_pending` chunks per server are held in memory
+        while waiting to be posted; producing blocks when servers fall behind.
+
+        `on_done(n)` is called (from the calling thread) once the first `n`
+        non-empty chunks have been posted to every server, e.g. to save a checkpoint.
+        The first error from any server is raised after all chunks are
+        produced.
+        """
+        if 'commit' not in kw:
+            kw['commit'] = self._commit
+        if self.commitWithin and 'commitWithin' not in kw:
+            kw['commitWithin'] = self.commitWithin
+        queues = [Queue.Queue(maxsize=max_pending) for s in self.push_pool]
+        posted = [0] * len(self.push_pool)
+        errors = []
+
+        def post(i, solr, queue):
+            while True:
+                docs = queue.get()
+                if docs is None:
+                    return
+                if not errors:
+                    try:
+                        solr.add(docs, **kw)
+                    except Exception as e:
+                        log.exception('Error adding %s docs to %s', len(docs), solr.url)
+                        errors.append(e)
+                posted[i] += 1
+
+        threads = [threading.Thread(target=post, args=(i, solr, queue))
+                   for i, (solr, queue) in enumerate(zip(self.push_pool, queues))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        done = 0
+        try:
+            for docs in chunks:
+                if not docs:
+                    continue
+                for queue in queues:
+                    queue.put(docs)
+                if on_done and min(posted) > done and not errors:
+                    done = min(posted)
+                    on_done(done)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+        if on_done and min(posted) > done:
+            on_done(min(posted))
+
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
@@ -134,11 +198,20 @@ def facets(self):
     def __init__(self):
         self.db = {}
 
-    def add(self, objects):
+    def add(self, objects, fieldUpdates=None, **kw):
         for o in objects:
+            if fieldUpdates:
+                self.db[o['id']].update(o)
+                continue
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
 
+    def add_pipelined(self, chunks, on_done=None, **kw):
+        for i, docs in enumerate(c for c in chunks if c):
+            self.add(docs)
+            if on_done:
+                on_done(i + 1)
+
     def commit(self):
         pass
 
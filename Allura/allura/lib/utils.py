@@ -38,6 +38,7 @@
 
 import tg
 import pylons
+import pymongo
 import json
 from formencode import Invalid
 from tg.decorators import before_validate
@@ -239,6 +240,23 @@ def chunked_iter(iterable, max_size):
         yield (x for i, x in chunk)
 
 
+def post_task_split(task_func, items):
+    """
+    Post ``task_func(items)``, recursively splitting `items` in half and
+    re-posting if the resulting mongo document is too large.
+    """
+    try:
+        task_func.post(items)
+    except pymongo.errors.InvalidDocument as e:
+        # there are many types of InvalidDocument, only recurse if its
+        # expected to help
+        if e.args[0].startswith('BSON document too large') and len(items) > 1:
+            post_task_split(task_func, items[:len(items) // 2])
+            post_task_split(task_func, items[len(items) // 2:])
+        else:
+            raise
+
+
 class AntiSpam(object):
 
     '''Helper class for bot-protecting forms'''
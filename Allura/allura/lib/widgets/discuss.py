@@ -452,6 +452,7 @@ class Thread(HierWidget):
         page=None,
         limit=50,
         count=None,
+        after=None,
         show_subject=False,
         new_post_text='+ New Comment')
     widgets = dict(
@@ -34,6 +34,7 @@
 from allura.lib import utils
 from allura.lib import plugin
 from allura.lib import exceptions as forge_exc
+from allura.lib.decorators import memoize
 
 from allura.lib.search import SearchIndexable
 from .session import main_orm_session
@@ -322,6 +323,28 @@ def index(self):
             snippet_s='',
             deleted_b=self.deleted)
 
+    @classmethod
+    @memoize
+    def markdown_cache_fields(cls):
+        """Return the names of the markdown fields of this Artifact class
+        that have a ``<name>_cache`` :class:`MarkdownCache` field.  Computed
+        once per class, since it is checked on every flush.
+
+        """
+        return tuple(sorted(
+            name[:-len('_cache')] for name in dir(cls)
+            if name.endswith('_cache') and
+            isinstance(getattr(cls, name, None), FieldProperty)))
+
+    def fill_markdown_cache(self):
+        """Render each of the :meth:`markdown_cache_fields` into its cache,
+        unless that is already valid.  Subclasses rendered with a different
+        markdown converter should override this.
+
+        """
+        for field_name in self.markdown_cache_fields():
+            g.markdown.fill_cache(self, field_name)
+
     def url(self):
         """Return the URL for this Artifact.
 
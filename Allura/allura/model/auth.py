@@ -32,7 +32,7 @@
 from pylons import request
 from ming import schema as S
 from ming import Field, collection
-from ming.orm import session, state
+from ming.orm import session, state, MapperExtension
 from ming.orm import FieldProperty, RelationProperty, ForeignIdProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -42,6 +42,7 @@
 import allura.tasks.mail_tasks
 from allura.lib import helpers as h
 from allura.lib import plugin
+from allura.lib import security
 from allura.lib import utils
 from allura.lib.decorators import memoize
 from allura.lib.search import SearchIndexable
@@ -829,6 +830,34 @@ class __mongometa__:
         unique_indexes = [('user_id', 'project_id', 'name')]
 
 
+# Kept apart from the project document, and only ever changed with $inc, so
+# that saving a project loaded before one of its roles changed can't put an
+# old stamp back.
+project_role_stamp = collection(
+    'project_role_stamp', main_doc_session,
+    Field('_id', S.ObjectId()),  # the project's _id
+    Field('stamp', int, if_missing=0))
+
+
+def bump_role_stamp(project_id):
+    '''Give the project a new role stamp, so role graphs cached by
+    :class:`~allura.lib.security.Credentials` in any process are reloaded.
+    Called whenever one of the project's roles is saved or deleted.'''
+    project_role_stamp.m.update_partial(
+        {'_id': project_id}, {'$inc': {'stamp': 1}}, upsert=True)
+    shared = security.shared_role_cache()
+    if shared is not None:
+        shared.invalidate(project_id)
+
+
+class ProjectRoleMapperExtension(MapperExtension):
+
+    def after_insert(self, obj, state, sess):
+        if obj.project_id:
+            bump_role_stamp(obj.project_id)
+    after_update = after_delete = after_insert
+
+
 class ProjectRole(MappedClass):
     """
     Per-project roles, called "Groups" in the UI.
@@ -844,6 +873,7 @@ class ProjectRole(MappedClass):
     class __mongometa__:
         session = main_orm_session
         name = 'project_role'
+        extensions = [ProjectRoleMapperExtension]
         unique_indexes = [('user_id', 'project_id', 'name')]
         indexes = [
             ('user_id',),
@@ -26,7 +26,7 @@
 import tg
 
 from ming import schema
-from ming.orm.base import session
+from ming.orm.base import session, state
 from ming.orm.property import (FieldProperty, RelationProperty,
                                ForeignIdProperty)
 from ming.utils import LazyProperty
@@ -45,6 +45,26 @@
 log = logging.getLogger(__name__)
 
 
+def _inc_counter(cls, _id, field, delta):
+    '''Atomically add `delta` to the `field` counter of the `cls` document
+    with `_id`, and refresh the copy loaded in this session, if any.'''
+    obj = session(cls).imap.get(cls, _id)
+    if obj is not None and state(obj).status == state(obj).new:
+        # not inserted yet, so its insert stores the count
+        setattr(obj, field, getattr(obj, field) + delta)
+        return
+    coll = session(cls).impl.db[cls.__mongometa__.name]
+    doc = coll.find_and_modify({'_id': _id}, {'$inc': {field: delta}},
+                               new=True, fields=[field])
+    if obj is not None and doc is not None:
+        st = state(obj)
+        clean = st.status == st.clean
+        setattr(obj, field, doc[field])
+        if clean:
+            # it's already saved, don't write the whole document again
+            st.status = st.clean
+
+
 class Discussion(Artifact, ActivityObject):
 
     class __mongometa__:
@@ -89,9 +109,14 @@ def post_class(cls):
     def attachment_class(cls):
         return DiscussionAttachment
 
-    def update_stats(self):
+    def update_topic_count(self):
         self.num_topics = self.thread_class().query.find(
             dict(discussion_id=self._id)).count()
+
+    def update_stats(self):
+        '''Recount num_topics and num_posts.  num_posts is otherwise kept
+        up to date by :meth:`Thread.inc_post_count`.'''
+        self.update_topic_count()
         self.num_posts = self.post_class().query.find(
             dict(discussion_id=self._id, status='ok', deleted=False)).count()
 
@@ -186,13 +211,20 @@ def attachments_for_json(self, page):
         return [dict(bytes=attach.length,
                      url=h.absurl(attach.url())) for attach in page.attachments]
 
-    def __json__(self, limit=None, page=None, is_export=False):
+    def __json__(self, limit=None, page=None, is_export=False, after=None):
+        posts = self.query_posts(status='ok', style='chronological', limit=limit, page=page,
+                                 after=after).all()
+        # pass as `after` to get the next page, if there may be one
+        next_after = None
+        if limit and len(posts) == limit:
+            next_after = self.posts_cursor(posts[-1])
         return dict(
             _id=self._id,
             discussion_id=str(self.discussion_id),
             subject=self.subject,
             limit=limit,
             page=page,
+            next_after=next_after,
             posts=[dict(slug=p.slug,
                         text=p.text,
                         subject=p.subject,
@@ -201,7 +233,7 @@ def __json__(self, limit=None, page=None, is_export=False):
                         timestamp=p.timestamp,
                         last_edited=p.last_edit_date,
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p))
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in posts
                    ]
         )
 
@@ -278,7 +310,6 @@ def add_post(self, **kw):
         p = self.post(**kw)
         p.commit(update_stats=False)
         session(self).flush(self)
-        self.update_stats()
         if not self.first_post:
             self.first_post_id = p._id
         self.post_to_feed(p)
@@ -366,9 +397,17 @@ def notify_moderators(self, post):
                     n.send_direct(str(u._id))
 
     def update_stats(self):
+        '''Recount num_replies, which is otherwise kept up to date by
+        :meth:`inc_post_count`.'''
         self.num_replies = self.post_class().query.find(
             dict(thread_id=self._id, status='ok', deleted=False)).count()
 
+    def inc_post_count(self, delta):
+        '''Add `delta` to num_replies and to the num_posts of the discussion,
+        when a post starts or stops being an approved, undeleted post.'''
+        _inc_counter(type(self), self._id, 'num_replies', delta)
+        _inc_counter(self.discussion_class(), self.discussion_id, 'num_posts', delta)
+
     @property
     def last_post(self):
         q = self.post_class().query.find(dict(
@@ -389,8 +428,7 @@ def create_post_threads(self, posts):
                 result.append(pi)
         return result
 
-    def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded', status=None):
+    def _posts_terms(self, timestamp=None, status=None):
         if timestamp:
             terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
                          status={'$in': ['ok', 'pending']}, timestamp=timestamp)
@@ -400,22 +438,73 @@ def query_posts(self, page=None, limit=None,
         if status:
             terms['status'] = status
         terms['deleted'] = False
-        q = self.post_class().query.find(terms)
+        return terms
+
+    def query_posts(self, page=None, limit=None,
+                    timestamp=None, style='threaded', status=None, after=None):
+        '''Query the posts of this thread in display order.
+
+        Pass the full_slug (threaded style) or (timestamp, _id) pair (other
+        styles) of the last post of the previous page as `after` to start the
+        page right after it instead of skipping `page * limit` posts, which
+        keeps deep pages of large threads cheap.  Posts can share a timestamp,
+        so the _id breaks ties.
+        '''
+        terms = self._posts_terms(timestamp=timestamp, status=status)
         if style == 'threaded':
-            q = q.sort('full_slug')
+            sort = [('full_slug', pymongo.ASCENDING)]
+            if after is not None:
+                terms['full_slug'] = {'$gt': after}
         else:
-            q = q.sort('timestamp')
+            sort = [('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+            if after is not None:
+                after_timestamp, after_id = after
+                terms['$or'] = [
+                    {'timestamp': {'$gt': after_timestamp}},
+                    {'timestamp': after_timestamp, '_id': {'$gt': after_id}}]
+        q = self.post_class().query.find(terms).sort(sort)
         if limit is not None:
             limit = int(limit)
-            if page is not None:
+            if page is not None and after is None:
                 q = q.skip(page * limit)
             q = q.limit(limit)
         return q
 
     def find_posts(self, page=None, limit=None, timestamp=None,
-                   style='threaded'):
-        return self.query_posts(page=page, limit=limit,
-                                timestamp=timestamp, style=style).all()
+                   style='threaded', after=None):
+        return self.query_posts(page=page, limit=limit, timestamp=timestamp,
+                                style=style, after=after).all()
+
+    @staticmethod
+    def posts_cursor(post):
+        '''Return the REST `after` parameter for the page after `post`, see
+        :meth:`parse_posts_cursor`.'''
+        return '%s,%s' % (post.timestamp.isoformat(), post._id)
+
+    @staticmethod
+    def parse_posts_cursor(cursor):
+        '''Return the (timestamp, _id) pair for :meth:`query_posts` from a
+        :meth:`posts_cursor`, or None if it isn't one.'''
+        timestamp, sep, post_id = (cursor or '').partition(',')
+        timestamp = h.DateTimeConverter(if_invalid=None).to_python(timestamp)
+        if timestamp is None or not sep:
+            return None
+        return timestamp, post_id
+
+    def post_position(self, post, style='threaded'):
+        """Return the index of `post` in the order :meth:`query_posts` displays
+        the posts of this thread.
+
+        A reply's full_slug extends its parent's, so sorting by full_slug is
+        the same as walking the post tree depth-first and the position is
+        a count of the posts sorting before this one.
+        """
+        terms = self._posts_terms()
+        if style == 'threaded':
+            terms['full_slug'] = {'$lt': post.full_slug}
+        else:
+            terms['timestamp'] = {'$lt': post.timestamp}
+        return self.post_class().query.find(terms).count()
 
     def url(self):
         # Can't use self.discussion because it might change during the req
@@ -489,7 +578,9 @@ class __mongometa__:
         indexes = [
             # used in general lookups, last_post, etc
             ('discussion_id', 'status', 'timestamp'),
-            'thread_id'
+            # display order of a thread's posts, see Thread.post_position
+            ('thread_id', 'full_slug'),
+            ('thread_id', 'timestamp'),
         ]
     type_s = 'Post'
 
@@ -674,24 +765,7 @@ def url_paginated(self):
             # all posts in a single page
             page = 0
         else:
-            posts = self.thread.find_posts()
-            posts = self.thread.create_post_threads(posts)
-
-            def find_i(posts):
-                '''Find the index number of this post in the display order'''
-                q = []
-
-                def traverse(posts):
-                    for p in posts:
-                        if p['post']._id == self._id:
-                            return True  # found
-                        q.append(p)
-                        if traverse(p['children']):
-                            return True
-                traverse(posts)
-                return len(q)
-
-            page = find_i(posts) / limit
+            page = self.thread.post_position(self) / limit
 
         slug = h.urlquote(self.slug)
         url = self.main_url()
@@ -714,14 +788,26 @@ def reply_subject(self):
         else:
             return 'Re: ' + (self.subject or '(no subject)')
 
+    @property
+    def counted(self):
+        '''Whether this post counts towards the thread's num_replies'''
+        return self.status == 'ok' and not self.deleted
+
+    def _update_post_count(self, counted):
+        delta = int(self.counted) - int(counted)
+        if delta:
+            self.thread.inc_post_count(delta)
+
     def delete(self):
+        counted = self.counted
         self.deleted = True
         session(self).flush(self)
-        self.thread.update_stats()
+        self._update_post_count(counted)
 
     def approve(self, file_info=None, notify=True, notification_text=None):
         if self.status == 'ok':
             return
+        counted = self.counted
         self.status = 'ok'
         author = self.author()
         author_role = ProjectRole.by_user(
@@ -740,9 +826,13 @@ def approve(self, file_info=None, notify=True, notification_text=None):
         self.thread.last_post_date = max(
             self.thread.last_post_date,
             self.mod_date)
-        self.thread.update_stats()
-        if hasattr(artifact, 'update_stats'):
-            artifact.update_stats()
+        self._update_post_count(counted)
+        # a topic's first post may be approved before or after the topic
+        # records it as its first post
+        if (hasattr(artifact, 'update_topic_count') and self.counted and not counted
+                and self.thread.first_post_id in (None, self._id)):
+            # first post of a new topic
+            artifact.update_topic_count()
         if self.text and not self.is_meta:
             g.director.create_activity(author, 'posted', self, target=artifact,
                                        related_nodes=[self.app_config.project],
@@ -786,16 +876,18 @@ def notify(self, file_info=None, notification_text=None):
                 n.send_simple(artifact.monitoring_email)
 
     def spam(self):
+        counted = self.counted
         self.status = 'spam'
         g.spam_checker.submit_spam(self.text, artifact=self, user=self.author())
         session(self).flush(self)
-        self.thread.update_stats()
+        self._update_post_count(counted)
 
     def undo(self, prev_status):
         if prev_status in ('ok', 'pending'):
+            counted = self.counted
             self.status = prev_status
             session(self).flush(self)
-            self.thread.update_stats()
+            self._update_post_count(counted)
 
 
 class DiscussionAttachment(BaseAttachment):
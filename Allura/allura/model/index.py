@@ -17,7 +17,6 @@
 
 import re
 import logging
-from itertools import groupby
 from cPickle import dumps, loads
 from collections import defaultdict
 from urllib import unquote
@@ -35,7 +34,7 @@
 from allura.lib import helpers as h
 
 from .session import main_doc_session, main_orm_session
-from .project import Project
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -49,6 +48,8 @@
         app_config_id=S.ObjectId(),
         artifact_id=S.Anything(if_missing=None))),
     Field('references', [str], index=True),
+    # hashes of the indexed fields, for partial solr updates (solr.atomic_updates)
+    Field('solr_hashes', {str: str}),
     Index('artifact_reference.project_id'),  # used in ReindexCommand
 )
 
@@ -91,6 +92,34 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def prefetch_artifacts(cls, ref_ids):
+        '''Load the references with the given ids, and their artifacts with a
+        query per artifact class and project, so that the :attr:`artifact` of
+        each is ready without a query of its own.  Returns the references.'''
+        if not ref_ids:
+            return []
+        refs = cls.query.find(dict(_id={'$in': list(ref_ids)})).all()
+        by_class = defaultdict(list)
+        for ref in refs:
+            if 'artifact' not in ref.__dict__:
+                aref = ref.artifact_reference
+                by_class[str(aref.cls), aref.project_id].append(ref)
+        for (pickled_cls, project_id), class_refs in by_class.iteritems():
+            try:
+                artifact_cls = loads(pickled_cls)
+                with h.push_context(project_id):
+                    artifacts = dict((a._id, a) for a in artifact_cls.query.find(dict(
+                        _id={'$in': [r.artifact_reference.artifact_id for r in class_refs]})))
+            except:
+                # leave them to be looked up (and logged) one at a time
+                log.exception('Error loading artifacts of %r', class_refs)
+                continue
+            for ref in class_refs:
+                ref.__dict__['artifact'] = artifacts.get(
+                    ref.artifact_reference.artifact_id)
+        return refs
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -168,9 +197,17 @@ def from_links(cls, *links):
                 link={'$in': links_by_artifact.keys()},
                 project_id={'$in': list(project_ids)}
             ), validate=False)
-            matches_by_artifact = dict(
-                (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+            matches_by_artifact = defaultdict(list)
+            for m in q:
+                matches_by_artifact[unquote(m.link)].append(m)
+            cls._prefetch_matches(matches_by_artifact.values())
+            app_instances = {}
+
+            def has_app(m):
+                key = m.project_id, m.app_config.options.mount_point
+                if key not in app_instances:
+                    app_instances[key] = m.project.app_instance(key[1]) is not None
+                return app_instances[key]
             for link, d in parsed_links.iteritems():
                 matches = matches_by_artifact.get(unquote(d['artifact']), [])
                 matches = (
@@ -178,7 +215,7 @@ def from_links(cls, *links):
                     if m.project.shortname == d['project'] and
                     m.project.neighborhood_id == d['nbhd'] and
                     m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
+                    has_app(m))
                 if d['app']:
                     matches = (
                         m for m in matches
@@ -188,6 +225,18 @@ def from_links(cls, *links):
         else:
             return {}
 
+    @classmethod
+    def _prefetch_matches(cls, matches):
+        '''Load the projects and tools of candidate shortlinks with one query
+        each, so the identity map has them when the matches are checked'''
+        matches = [m for ms in matches for m in ms]
+        if not matches:
+            return
+        Project.query.find(dict(
+            _id={'$in': list(set(m.project_id for m in matches))})).all()
+        AppConfig.query.find(dict(
+            _id={'$in': list(set(m.app_config_id for m in matches))})).all()
+
     @classmethod
     def _get_correct_match(cls, link, matches):
         result = None
@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
 import sys
 import time
 import traceback
@@ -24,7 +25,7 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
@@ -33,11 +34,54 @@
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
+from allura.lib.security import Credentials
 from .session import task_orm_session
 
 log = logging.getLogger(__name__)
 
 
+def _only_pattern(name):
+    if '*' not in name:
+        return name
+    return re.compile('^%s$' % re.escape(name).replace(r'\*', '.*'))
+
+
+def _split_only(only):
+    include = [name for name in only if not name.startswith('!')]
+    exclude = [name[1:] for name in only if name.startswith('!')]
+    return include, exclude
+
+
+def task_name_filter(only):
+    '''Mongo query on task_name for a list of task names, which may contain
+    ``*`` wildcards (e.g. ``allura.tasks.repo_tasks.*``).  Names prefixed
+    with ``!`` are excluded instead.'''
+    include, exclude = _split_only(only)
+    query = {}
+    if include:
+        query['$in'] = [_only_pattern(name) for name in include]
+    if exclude:
+        query['$nin'] = [_only_pattern(name) for name in exclude]
+    return query
+
+
+def _name_matches(task_name, names):
+    for name in names:
+        pattern = _only_pattern(name)
+        if task_name == pattern or (
+                not isinstance(pattern, basestring) and pattern.match(task_name or '')):
+            return True
+    return False
+
+
+def task_name_matches(task_name, only):
+    '''Python equivalent of :func:`task_name_filter`'''
+    include, exclude = _split_only(only)
+    if _name_matches(task_name, exclude):
+        return False
+    return not include or _name_matches(task_name, include)
+
+
 class MonQTask(MappedClass):
 
     '''Task to be executed by the taskd daemon.
@@ -58,6 +102,9 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - if set, later posts of the same task with the same key
+          may be merged into this one while it is still ready (see :meth:`post`)
+        - coalesced - how many later posts were merged into this task
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -97,6 +144,8 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
+    coalesced = FieldProperty(int, if_missing=0)
 
     def __repr__(self):
         from allura import model as M
@@ -110,7 +159,7 @@ def __repr__(self):
         project_url = project and project.url() or None
         app_mount = app and app.config.options.mount_point or None
         username = user and user.username or None
-        return '<%s %s (%s) P:%d %s %s project:%s app:%s user:%s>' % (
+        return '<%s %s (%s) P:%d %s %s project:%s app:%s user:%s%s>' % (
             self.__class__.__name__,
             self._id,
             self.state,
@@ -119,7 +168,8 @@ def __repr__(self):
             self.process,
             project_url,
             app_mount,
-            username)
+            username,
+            ' coalesced:%d' % self.coalesced if self.coalesced else '')
 
     @LazyProperty
     def function(self):
@@ -135,8 +185,16 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             coalesce_key=None):
+        '''Create a new task object based on the current context.
+
+        If `coalesce_key` is given, and a task for the same function, context,
+        priority and key is still waiting to run, the new work is merged into
+        that task instead of queueing another one.  This is only supported for
+        tasks that take a single list argument (like the indexing tasks); the
+        lists are merged without duplicates.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -157,6 +215,15 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        if coalesce_key is not None:
+            if len(args) != 1 or not isinstance(args[0], (list, tuple)) or kwargs:
+                raise ValueError(
+                    'Only tasks with a single list argument can be coalesced')
+            if not delay:
+                obj = cls._coalesce(task_name, coalesce_key, priority, context,
+                                    args[0])
+                if obj is not None:
+                    return obj
         obj = cls(
             state='ready',
             priority=priority,
@@ -167,10 +234,68 @@ def post(cls,
             process=None,
             result=None,
             context=context,
+            coalesce_key=coalesce_key,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         session(obj).flush(obj)
+        if not delay:
+            MonQWakeup.signal(task_name)
         return obj
 
+    # cap on the size of a coalesced list argument, to stay well below the max
+    # BSON document size
+    coalesce_max_items = 10000
+
+    @classmethod
+    def _coalesce(cls, task_name, coalesce_key, priority, context, items):
+        '''Merge `items` into a matching ready task, and return it.  Returns
+        None if there's no such task.
+
+        Only the newest ready task for `coalesce_key` is merged into, and only
+        if it has the same name and exactly the same context, so work posted
+        under one key keeps its order: an add posted after a delete is never
+        merged into an add queued before the delete.
+        '''
+        if len(items) >= cls.coalesce_max_items:
+            return None
+        query = {
+            'state': 'ready',
+            'coalesce_key': coalesce_key,
+            'priority': priority,
+            'time_queue': {'$lte': datetime.utcnow()},
+        }
+        newest = cls._collection().find(query, fields=['_id', 'task_name', 'context']).sort(
+            [('time_queue', ming.DESCENDING), ('_id', ming.DESCENDING)]).limit(1)
+        newest = list(newest)
+        if (not newest or newest[0]['task_name'] != task_name
+                or dict(newest[0].get('context') or {}) != context):
+            return None
+        query['_id'] = newest[0]['_id']
+        query['args.0.%d' % (cls.coalesce_max_items - len(items))] = {'$exists': False}
+        try:
+            obj = cls.query.find_and_modify(
+                query=query,
+                update={
+                    '$addToSet': {'args.0': {'$each': list(items)}},
+                    '$inc': {'coalesced': 1},
+                },
+                new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+            obj = None
+        if obj is not None:
+            log.debug('Coalesced %s items into %r', len(items), obj)
+        return obj
+
+    @classmethod
+    def coalesce_stats(cls):
+        '''Return {task_name: number of posts merged into other tasks}, for the
+        tasks that haven't been purged yet.'''
+        stats = {}
+        for t in cls.query.find(dict(coalesced={'$gt': 0})):
+            stats[t.task_name] = stats.get(t.task_name, 0) + t.coalesced
+        return stats
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
@@ -187,7 +312,7 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
                 if only:
-                    query['task_name'] = {'$in': only}
+                    query['task_name'] = task_name_filter(only)
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -209,6 +334,119 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, process='worker', batch_size=10, state='ready',
+                  waitfunc=None, only=None):
+        '''Like :meth:`get`, but claim up to `batch_size` of the
+        highest-priority, oldest ready tasks at once.
+
+        Returns the claimed tasks in the same priority/time order :meth:`get`
+        uses, or an empty list under the same conditions :meth:`get` returns
+        None.  Claimed tasks get ``time_start`` set right away, so that
+        :meth:`timeout_tasks` can recover them if this worker dies before
+        getting to them.
+        '''
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        while True:
+            now = datetime.utcnow()
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': now}
+            if only:
+                query['task_name'] = task_name_filter(only)
+            coll = cls._collection()
+            cursor = coll.find(query, fields=['_id'])
+            ids = [t['_id'] for t in cursor.sort(sort).limit(batch_size)]
+            if ids:
+                # tasks grabbed by another worker in the meantime no longer
+                # match the state and are simply left out of this batch
+                query['_id'] = {'$in': ids}
+                coll.update(query, {'$set': dict(
+                    state='busy',
+                    process=process,
+                    time_start=now)}, multi=True)
+                tasks = cls.query.find(dict(
+                    _id={'$in': ids},
+                    state='busy',
+                    process=process,
+                    time_start=now)).sort(sort).all()
+                if tasks:
+                    return tasks
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def run_batch(cls, tasks, nocapture=False, max_time=None):
+        '''Run claimed `tasks` in order, then write their results back with a
+        single bulk update.
+
+        If `max_time` seconds pass, the remaining tasks are not started and
+        are released back to the 'ready' state instead, so a long batch never
+        looks stuck to :meth:`timeout_tasks` while tasks are still queued in it.
+        '''
+        deadline = max_time and time.time() + max_time
+        done = []
+        try:
+            for task in tasks:
+                if deadline and done and time.time() > deadline:
+                    break
+                done.append(task)
+                # the batch runs in one request, but each task should see
+                # roles and ACLs as they are when it starts, like a task run
+                # on its own
+                Credentials.get().clear()
+                task(restore_context=False, nocapture=nocapture, flush=False)
+        finally:
+            cls._save_results(done)
+            unstarted = [t._id for t in tasks[len(done):]]
+            if unstarted:
+                log.info('Releasing %s unstarted tasks from batch', len(unstarted))
+                cls._collection().update(
+                    dict(_id={'$in': unstarted}, state='busy'),
+                    {'$set': dict(state='ready', process=None, time_start=None)},
+                    multi=True)
+            for task in tasks:
+                session(task).expunge(task)
+
+    @classmethod
+    def _save_results(cls, tasks):
+        if not tasks:
+            return
+        coll = cls._collection()
+        updates = [({'_id': task._id}, {'$set': dict(
+            state=task.state,
+            result=task.result,
+            time_start=task.time_start,
+            time_stop=task.time_stop)}) for task in tasks]
+        if not hasattr(coll, 'initialize_unordered_bulk_op'):
+            # mim (used in tests) has no bulk api
+            for spec, update in updates:
+                coll.update(spec, update)
+            return
+        bulk = coll.initialize_unordered_bulk_op()
+        for spec, update in updates:
+            bulk.find(spec).update_one(update)
+        bulk.execute()
+
+    @classmethod
+    def _collection(cls):
+        return session(cls).impl.db[cls.__mongometa__.name]
+
+    @classmethod
+    def ready_count(cls, only=None):
+        '''Number of tasks that are ready to run now, optionally limited to
+        the given task names (see :func:`task_name_filter`)'''
+        query = dict(state='ready')
+        query['time_queue'] = {'$lte': datetime.utcnow()}
+        if only:
+            query['task_name'] = task_name_filter(only)
+        return cls.query.find(query).count()
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -232,14 +470,16 @@ def run_ready(cls, worker=None):
             task()
         return i
 
-    def __call__(self, restore_context=True, nocapture=False):
+    def __call__(self, restore_context=True, nocapture=False, flush=True):
         '''Call the task function with its context.  If restore_context is True,
         c.project/app/user will be restored to the values they had before this
-        function was called.
+        function was called.  If flush is False, the task's state is not saved
+        before and after running it (see :meth:`run_batch`).
         '''
         from allura import model as M
         self.time_start = datetime.utcnow()
-        session(self).flush(self)
+        if flush:
+            session(self).flush(self)
         log.info('starting %r', self)
         old_cproject = getattr(c, 'project', None)
         old_capp = getattr(c, 'app', None)
@@ -273,7 +513,8 @@ def __call__(self, restore_context=True, nocapture=False):
                     self.result = traceback.format_exc()
         finally:
             self.time_stop = datetime.utcnow()
-            session(self).flush(self)
+            if flush:
+                session(self).flush(self)
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
@@ -291,3 +532,92 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQWakeup(object):
+
+    '''Wakeup channel for idle taskd workers, enabled with ``monq.wakeup``.
+
+    :meth:`MonQTask.post` appends a small document to a capped collection in
+    the task database, and idle workers block on a tailable cursor over that
+    collection instead of sleeping for ``monq.poll_interval``.  The poll
+    interval is still used as an upper bound on the wait, so a missed or
+    dropped signal only costs the old polling latency.
+    '''
+
+    collection_name = 'monq_task_wakeup'
+    # names of the databases the capped collection is known to exist in
+    _created = set()
+
+    def __init__(self, only=None):
+        self.only = only
+        self.cursor = None
+        self.last_id = None
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.wakeup', False))
+
+    @classmethod
+    def collection(cls):
+        db = session(MonQTask).impl.db
+        if db.name in cls._created:
+            return db[cls.collection_name]
+        if cls.collection_name not in db.collection_names():
+            size = asint(config.get('monq.wakeup_collection_size', 1024 * 1024))
+            try:
+                coll = db.create_collection(
+                    cls.collection_name, capped=True, size=size)
+                # a tailable cursor over an empty capped collection dies
+                # immediately, so always keep one document in it
+                coll.insert(dict(task_name=None, time=datetime.utcnow()))
+            except pymongo.errors.CollectionInvalid:
+                pass  # created concurrently by another process
+        cls._created.add(db.name)
+        return db[cls.collection_name]
+
+    @classmethod
+    def signal(cls, task_name):
+        '''Notify waiting workers that a task named `task_name` is ready'''
+        if not cls.enabled():
+            return
+        try:
+            cls.collection().insert(
+                dict(task_name=task_name, time=datetime.utcnow()))
+        except pymongo.errors.PyMongoError:
+            log.exception('Could not signal taskd workers for %s', task_name)
+
+    def _open_cursor(self):
+        coll = self.collection()
+        if self.last_id is None:
+            latest = list(coll.find().sort('$natural', -1).limit(1))
+            self.last_id = latest[0]['_id'] if latest else None
+        # no filter: a tailable query that matches nothing returns a dead
+        # cursor, so tail the whole collection and let wait() skip the
+        # documents already seen
+        return coll.find(tailable=True, await_data=True)
+
+    def wait(self, timeout):
+        '''Block until a matching task is posted or `timeout` seconds pass.
+
+        Returns True if woken up by a signal, False on timeout.
+        '''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.cursor is None or not self.cursor.alive:
+                self.cursor = self._open_cursor()
+            try:
+                for doc in self.cursor:
+                    if self.last_id is not None and doc['_id'] <= self.last_id:
+                        continue
+                    self.last_id = doc['_id']
+                    if self.only and not task_name_matches(doc['task_name'], self.only):
+                        continue
+                    return True
+            except pymongo.errors.OperationFailure:
+                log.exception('Error tailing %s', self.collection_name)
+                self.cursor = None
+            if self.cursor is None or not self.cursor.alive:
+                # avoid a hot loop if the cursor can't be kept open
+                time.sleep(min(1, max(0, deadline - time.time())))
+        return False
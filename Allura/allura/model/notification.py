@@ -35,15 +35,17 @@
 '''
 
 import logging
+import sys
 from bson import ObjectId
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import islice
 
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool, aslist
+from paste.deploy.converters import asbool, aslist, asint
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -51,7 +53,7 @@
 
 from allura.lib import helpers as h
 from allura.lib import security
-from allura.lib.utils import take_while_true
+from allura.lib.utils import take_while_true, post_task_split
 import allura.tasks.mail_tasks
 
 from .session import main_orm_session
@@ -280,7 +282,16 @@ def send_simple(self, toaddr):
             references=self.references,
             text=(self.text or '') + self.footer(toaddr))
 
-    def send_direct(self, user_id):
+    @staticmethod
+    def _sendmail(messages, **kw):
+        '''Post a sendmail task, or add its arguments to `messages` so they
+        can be sent with others by one sendmail_batch task'''
+        if messages is None:
+            allura.tasks.mail_tasks.sendmail.post(**kw)
+        else:
+            messages.append(kw)
+
+    def send_direct(self, user_id, messages=None):
         user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
         artifact = self.ref.artifact
         log.debug('Sending direct notification %s to user %s',
@@ -301,7 +312,8 @@ def send_direct(self, user_id):
                       ', '.join([str(a) for a in artifact.acl]),
                       ', '.join([str(a) for a in artifact.parent_security_context().acl]))
             return
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(
+            messages,
             destinations=[str(user_id)],
             fromaddr=self.from_address,
             reply_to=self.reply_to_address,
@@ -315,7 +327,7 @@ def send_direct(self, user_id):
 
     @classmethod
     def send_digest(self, user_id, from_address, subject, notifications,
-                    reply_to_address=None):
+                    reply_to_address=None, messages=None):
         if not notifications:
             return
         user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
@@ -345,7 +357,8 @@ def perm_check(notification):
             text.append(n.text or '-no text-')
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(
+            messages,
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=reply_to_address,
@@ -354,7 +367,8 @@ def perm_check(notification):
             text=text)
 
     @classmethod
-    def send_summary(self, user_id, from_address, subject, notifications):
+    def send_summary(self, user_id, from_address, subject, notifications,
+                     messages=None):
         if not notifications:
             return
         log.debug('Sending summary of notifications [%s] to user %s', ', '.join(
@@ -368,7 +382,8 @@ def send_summary(self, user_id, from_address, subject, notifications):
             text.append(h.text.truncate(n.text or '-no text-', 128))
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(
+            messages,
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=from_address,
@@ -533,7 +548,7 @@ def subscribed(
     def deliver(cls, nid, artifact_index_ids, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, with a single multi-document update.
         '''
 
         artifact_index_ids.append(None)  # get tool-wide ("None") and specific artifact subscriptions
@@ -543,24 +558,35 @@ def deliver(cls, nid, artifact_index_ids, topic):
             'artifact_index_id': {'$in': artifact_index_ids},
             'topic': {'$in': [None, topic]}
         }
-        mboxes = cls.query.find(d).all()
-        log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
-        for mbox in mboxes:
+        update = {
+            '$push': dict(queue=nid),
+            '$set': dict(last_modified=datetime.utcnow(), queue_empty=False),
+        }
+        # skip mailboxes which already have it, so delivery can be retried
+        d['queue'] = {'$ne': nid}
+        try:
+            result = cls.query.update(d, update, multi=True)
+        except:
+            # a multi update stops at the first mailbox it fails on (e.g. one
+            # whose queue has grown too big), so fall back to updating them
+            # one by one
+            log.exception('Error delivering notification %s in bulk, '
+                          'retrying mailbox by mailbox', nid)
+        else:
+            log.debug('Delivered notification %s: %s', nid, result)
+            return
+        for mbox in cls.query.find(d).all():
             try:
-                mbox.query.update(
-                    # _id is automatically specified by ming's "query", so this matches the current mbox
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
+                cls.query.update({'_id': mbox._id}, update)
             except:
                 # log error but try to keep processing, lest all the other eligible
                 # mboxes for this notification get skipped and lost forever
                 log.exception(
                     'Error adding notification: %s for artifact %s on project %s to user %s',
                     nid, artifact_index_ids, c.project._id, mbox.user_id)
+            finally:
+                # Make sure the mbox doesn't stick around to be flush()ed
+                session(mbox).expunge(mbox)
 
     @classmethod
     def fire_ready(cls):
@@ -589,15 +615,20 @@ def find_and_modify_direct_mbox():
                 )},
                 new=False)
 
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            try:
-                mbox.fire(now)
-            except:
-                log.exception(
-                    'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
+        batch_size = asint(config.get('notifications.fire_batch_size', 0))
+        if batch_size > 1:
+            cls._fire_direct_batches(
+                now, take_while_true(find_and_modify_direct_mbox), batch_size)
+        else:
+            for mbox in take_while_true(find_and_modify_direct_mbox):
+                try:
+                    mbox.fire(now)
+                except:
+                    log.exception(
+                        'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                    # re-raise so we don't keep (destructively) trying to process
+                    # mboxes
+                    raise
 
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
@@ -617,24 +648,64 @@ def find_and_modify_direct_mbox():
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _fire_direct_batches(cls, now, mboxes, batch_size):
+        '''Fire already claimed direct mailboxes `batch_size` at a time: the
+        notifications of a batch are loaded with one query, and its emails
+        are all sent by a single sendmail_batch task.'''
+        mboxes = iter(mboxes)
+        while True:
+            batch = list(islice(mboxes, batch_size))
+            if not batch:
+                break
+            nids = list(set(nid for mbox in batch for nid in mbox.queue))
+            notifications = dict(
+                (n._id, n) for n in Notification.query.find(dict(_id={'$in': nids})))
+            messages = []
+            error = None
+            for mbox in batch:
+                # the batch's mboxes are already cleared, so fire all of them
+                # even if one fails
+                try:
+                    mbox.fire(now, notifications, messages)
+                except:
+                    log.exception(
+                        'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                    error = error or sys.exc_info()
+            if messages:
+                post_task_split(allura.tasks.mail_tasks.sendmail_batch, messages)
+            if error:
+                # re-raise so we don't keep (destructively) trying to process
+                # mboxes
+                raise error[0], error[1], error[2]
+
+    def fire(self, now, notifications=None, messages=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        `notifications` may be a dict of already loaded notifications by _id,
+        and if `messages` is a list, the emails are added to it (see
+        :meth:`Notification._sendmail`) instead of each being posted as a task.
         '''
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
+        else:
+            notifications = [notifications[nid] for nid in self.queue
+                             if nid in notifications]
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
         else:
             log.debug('Firing mailbox %s notifications [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
+        send_kw = {} if messages is None else dict(messages=messages)
         if self.type == 'direct':
             ngroups = defaultdict(list)
             for n in notifications:
                 try:
                     if n.topic == 'message':
-                        n.send_direct(self.user_id)
+                        n.send_direct(self.user_id, **send_kw)
                         # Messages must be sent individually so they can be replied
                         # to individually
                     else:
@@ -652,10 +723,11 @@ def fire(self, now):
             for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
                 try:
                     if len(ns) == 1:
-                        ns[0].send_direct(self.user_id)
+                        ns[0].send_direct(self.user_id, **send_kw)
                     else:
                         Notification.send_digest(
-                            self.user_id, from_address, subject, ns, reply_to_address)
+                            self.user_id, from_address, subject, ns, reply_to_address,
+                            **send_kw)
                 except:
                     # log error but keep trying to deliver other notifications,
                     # lest the other notifications (which have already been removed
@@ -666,11 +738,11 @@ def fire(self, now):
         elif self.type == 'digest':
             Notification.send_digest(
                 self.user_id, g.noreply, 'Digest Email',
-                notifications)
+                notifications, **send_kw)
         elif self.type == 'summary':
             Notification.send_summary(
                 self.user_id, g.noreply, 'Digest Email',
-                notifications)
+                notifications, **send_kw)
 
 
 class MailFooter(object):
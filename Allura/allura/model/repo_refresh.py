@@ -64,23 +64,13 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
 
     # Refresh commits
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    repo.refresh_commits_info(commit_ids, seen, not all_commits)
 
     refresh_commit_repos(all_commit_ids, repo)
 
-    # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
-
+    # Refresh child references, commit runs and trees, in one pass over
+    # the new commit docs
     if repo._refresh_precompute:
-        # Refresh commit runs
         commit_run_ids = commit_ids
         # Check if the CommitRuns for the repo are in a good state by checking for
         # a CommitRunDoc that contains the last known commit. If there isn't one,
@@ -94,23 +84,33 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
                 commit_run_ids = all_commit_ids
         log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
         rb = CommitRunBuilder(commit_run_ids)
-        rb.run()
-        rb.cleanup()
-        log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
+        if commit_run_ids is not commit_ids:
+            # rebuilding covers more than the new commits, so it can't share
+            # their docs
+            rb.run()
 
-    # Refresh trees
     # Like diffs below, pre-computing trees for some SCMs is too expensive,
     # so we skip it here, then do it on-demand later.
+    tree_cache = {}
+    count = 0
+    for cis in commit_doc_batches(commit_ids):
+        refresh_children_bulk(cis)
+        if repo._refresh_precompute:
+            if commit_run_ids is commit_ids:
+                rb.add_commits(cis)
+            for ci in cis:
+                tree_cache = refresh_commit_trees(ci, tree_cache)
+        count += len(cis)
+        log.info('Refresh child info and commit trees %d: %s',
+                 count, cis[-1]._id)
+
     if repo._refresh_precompute:
-        cache = {}
-        for i, oid in enumerate(commit_ids):
-            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            cache = refresh_commit_trees(ci, cache)
-            if (i + 1) % 100 == 0:
-                log.info('Refresh commit trees %d: %s', (i + 1), ci._id)
+        if commit_run_ids is commit_ids:
+            rb.save()
+        rb.cleanup()
+        log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
 
     # Compute diffs
-    cache = {}
     # For some SCMs, we don't want to pre-compute the LCDs because that
     # would be too expensive, so we skip them here and do them on-demand
     # with caching.
@@ -233,6 +233,43 @@ def refresh_children(ci):
         multi=True)
 
 
+def refresh_children_bulk(cis):
+    '''Refresh the lists of children of the parents of all the given
+    commits, with one bulk write'''
+    children = OrderedDict()
+    for ci in cis:
+        for parent_id in ci.parent_ids:
+            children.setdefault(parent_id, []).append(ci._id)
+    if not children:
+        return
+    collection = CommitDoc.m.collection
+    if not hasattr(collection, 'initialize_unordered_bulk_op'):
+        # mim (used in tests) has no bulk api
+        for parent_id, child_ids in children.iteritems():
+            collection.update(
+                {'_id': parent_id},
+                {'$addToSet': {'child_ids': {'$each': child_ids}}})
+        return
+    bulk = collection.initialize_unordered_bulk_op()
+    for parent_id, child_ids in children.iteritems():
+        bulk.find({'_id': parent_id}).update_one(
+            {'$addToSet': {'child_ids': {'$each': child_ids}}})
+    bulk.execute()
+
+
+def commit_doc_batches(commit_ids, batch_size=QSIZE):
+    '''Yield lists of the CommitDocs for `commit_ids`, in order, fetching
+    one batch at a time'''
+    for oids in utils.chunked_iter(commit_ids, batch_size):
+        oids = list(oids)
+        docs = dict(
+            (ci._id, ci)
+            for ci in CommitDoc.m.find(dict(_id={'$in': oids}), validate=False))
+        cis = [docs[oid] for oid in oids if oid in docs]
+        if cis:
+            yield cis
+
+
 class CommitRunBuilder(object):
 
     '''Class used to build up linear runs of single-parent commits'''
@@ -245,18 +282,25 @@ def __init__(self, commit_ids):
 
     def run(self):
         '''Build up the runs'''
-        for oids in utils.chunked_iter(self.commit_ids, QSIZE):
-            oids = list(oids)
-            for ci in CommitDoc.m.find(dict(_id={'$in': oids})):
-                if ci._id in self.run_index:
-                    continue
-                self.run_index[ci._id] = ci._id
-                self.runs[ci._id] = CommitRunDoc(dict(
-                    _id=ci._id,
-                    parent_commit_ids=ci.parent_ids,
-                    commit_ids=[ci._id],
-                    commit_times=[ci.authored['date']]))
-            self.merge_runs()
+        for cis in commit_doc_batches(self.commit_ids):
+            self.add_commits(cis)
+        return self.save()
+
+    def add_commits(self, cis):
+        '''Add a batch of this builder's CommitDocs to the runs'''
+        for ci in cis:
+            if ci._id in self.run_index:
+                continue
+            self.run_index[ci._id] = ci._id
+            self.runs[ci._id] = CommitRunDoc(dict(
+                _id=ci._id,
+                parent_commit_ids=ci.parent_ids,
+                commit_ids=[ci._id],
+                commit_times=[ci.authored['date']]))
+        self.merge_runs()
+
+    def save(self):
+        '''Save the runs built so far'''
         log.info('%d runs', len(self.runs))
         for rid, run in sorted(self.runs.items()):
             log.info('%32s: %r', self.reasons.get(rid, 'none'), run._id)
@@ -27,8 +27,8 @@
 from time import time
 from collections import defaultdict, OrderedDict
 from urlparse import urljoin
-from threading import Thread
-from Queue import Queue
+from threading import Lock, BoundedSemaphore
+from multiprocessing.pool import ThreadPool
 from itertools import chain, islice
 from difflib import SequenceMatcher
 
@@ -43,7 +43,7 @@
 from ming import schema as S
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
-from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.orm import FieldProperty, session, state, Mapper, mapper
 from ming.base import Object
 
 from allura.lib import helpers as h
@@ -131,6 +131,14 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        '''Refresh the data in the commits with ids oids.  Implementations can
+        override this to refresh them in bulk.'''
+        for i, oid in enumerate(oids):
+            self.refresh_commit_info(oid, seen, lazy)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -250,64 +258,32 @@ def last_commit_ids(self, commit, paths):
         Return a mapping {path: commit_id} of the _id of the last
         commit to touch each path, starting from the given commit.
 
-        Chunks the set of paths based on lcd_thread_chunk_size and
-        runs each chunk (if more than one) in a separate thread.
-
-        Each thread will call :meth:`_get_last_commit` to get the
-        commit ID and list of changed files for the last commit
-        to touch any file in a given chunk.
+        Repeatedly calls :meth:`_get_last_commit` to get the commit ID
+        and list of changed files for the last commit to touch any of
+        the remaining paths.  This runs on the shared pool of LCD
+        threads (see :func:`run_lcd_job`), so a slow SCM gives up
+        after lcd_timeout seconds with the paths found so far.
         '''
         if not paths:
             return {}
-        timeout = float(tg.config.get('lcd_timeout', 60))
-        start_time = time()
-        paths = list(set(paths))  # remove dupes
-        result = {}  # will be appended to from each thread
-        chunks = Queue()
-        lcd_chunk_size = asint(tg.config.get('lcd_thread_chunk_size', 10))
-        num_threads = 0
-        for s in range(0, len(paths), lcd_chunk_size):
-            chunks.put(paths[s:s + lcd_chunk_size])
-            num_threads += 1
-
-        def get_ids():
-            paths = set(chunks.get())
-            try:
-                commit_id = commit._id
-                while paths and commit_id:
-                    if time() - start_time >= timeout:
-                        log.error('last_commit_ids timeout for %s on %s',
-                                  commit._id, ', '.join(paths))
-                        break
-                    commit_id, changes = self._get_last_commit(
-                        commit._id, paths)
-                    if commit_id is None:
-                        break
-                    changed = prefix_paths_union(paths, changes)
-                    for path in changed:
-                        result[path] = commit_id
-                    paths -= changed
-            except Exception as e:
-                log.exception('Error in SCM thread: %s', e)
-            finally:
-                chunks.task_done()
-        if num_threads == 1:
-            get_ids()
-        else:
-            for i in range(num_threads):
-                t = Thread(target=get_ids)
-                t.start()
-            # reimplement chunks.join() but with a timeout
-            # see: http://bugs.python.org/issue9634
-            # (giving threads a bit of extra cleanup time in case they timeout)
-            chunks.all_tasks_done.acquire()
-            try:
-                endtime = time() + timeout + 0.5
-                while chunks.unfinished_tasks and endtime > time():
-                    chunks.all_tasks_done.wait(endtime - time())
-            finally:
-                chunks.all_tasks_done.release()
-        return result
+
+        def get_ids(result, deadline):
+            remaining = set(paths)
+            commit_id = commit._id
+            while remaining and commit_id:
+                if time() >= deadline:
+                    log.error('last_commit_ids timeout for %s on %s',
+                              commit._id, ', '.join(remaining))
+                    break
+                commit_id, changes = self._get_last_commit(
+                    commit._id, remaining)
+                if commit_id is None:
+                    break
+                changed = prefix_paths_union(remaining, changes)
+                for path in changed:
+                    result[path] = commit_id
+                remaining -= changed
+        return run_lcd_job(get_ids)
 
     def _get_last_commit(self, commit_id, paths):
         """
@@ -445,6 +421,9 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        return self._impl.refresh_commits_info(oids, seen, lazy)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -1661,6 +1640,102 @@ def by_name(self):
         return {n.name: n.commit_id for n in self.entries}
 
 
+class SharedModelCache(object):
+
+    '''
+    Process-wide LRU cache of immutable repo objects, shared by every
+    :class:`ModelCache` (so by all requests and task threads) in a process.
+
+    Only classes whose docs never change once saved are kept, keyed by _id,
+    so entries never need invalidating.  Docs are stored BSON encoded, which
+    gives every caller its own copy and bounds the cache by actual size.
+    '''
+
+    # fields kept for each cacheable class.  Commits aren't included: their
+    # child_ids and repo_ids change as repos are pushed to and forked.
+    fields = {
+        Tree: ('_id', 'tree_ids', 'blob_ids', 'other_ids'),
+        TreesDoc: ('_id', 'tree_ids'),
+    }
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._docs = OrderedDict()  # by (cls, _id), least recently used first
+        self._lock = Lock()
+
+    def cacheable(self, cls, query):
+        return (cls in self.fields and query.keys() == ['_id']
+                and isinstance(query['_id'], basestring))
+
+    def get(self, cls, _id):
+        '''Return a new, session-less instance of `cls` with the given _id,
+        or None if it isn't cached'''
+        key = (cls, _id)
+        with self._lock:
+            data = self._docs.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._docs[key] = data
+            self.hits += 1
+        doc = bson.BSON(data).decode()
+        if hasattr(cls, 'query'):
+            obj = cls(**doc)
+            # keep it out of the unit of work, and don't let a flush of it
+            # (e.g. by ModelCache._try_flush) insert it again
+            session(obj).expunge(obj)
+            state(obj).status = state(obj).clean
+            return obj
+        return cls.make(doc)
+
+    def set(self, cls, val):
+        data = bson.BSON.encode(
+            dict((field, getattr(val, field)) for field in self.fields[cls]))
+        if len(data) > self.max_size:
+            return
+        key = (cls, val._id)
+        with self._lock:
+            old = self._docs.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._docs[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                key, data = self._docs.popitem(last=False)
+                self.size -= len(data)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=self.size,
+                count=len(self._docs))
+
+
+_shared_model_cache = None
+_shared_model_cache_lock = Lock()
+
+
+def shared_model_cache():
+    '''Return the process-wide :class:`SharedModelCache`, holding up to
+    scm.model_cache.shared_size bytes (default 64MB), or None if that's 0'''
+    global _shared_model_cache
+    with _shared_model_cache_lock:
+        if _shared_model_cache is None:
+            max_size = asint(tg.config.get('scm.model_cache.shared_size', 64 * 1024 * 1024))
+            if not max_size:
+                return None
+            _shared_model_cache = SharedModelCache(max_size)
+        return _shared_model_cache
+
+
 class ModelCache(object):
 
     '''
@@ -1673,7 +1748,7 @@ class ModelCache(object):
     for a series of several new commits.
     '''
 
-    def __init__(self, max_instances=None, max_queries=None):
+    def __init__(self, max_instances=None, max_queries=None, shared=None):
         '''
         By default, each model type can have 2000 instances and
         8000 queries.  You can override these for specific model
@@ -1684,7 +1759,14 @@ def __init__(self, max_instances=None, max_queries=None):
 
         If you pass in a number instead of a dict, that value will
         be used as the max for all classes.
+
+        Lookups by _id of immutable objects fall back to `shared`, a
+        :class:`SharedModelCache`, before going to mongo.  By default
+        that's the process-wide one; pass False to not use one.
         '''
+        if shared is None:
+            shared = shared_model_cache()
+        self._shared = shared or None
         max_instances_default = 2000
         max_queries_default = 8000
         if isinstance(max_instances, int):
@@ -1723,18 +1805,29 @@ def get(self, cls, query):
         _query = self._normalize_query(query)
         self._touch(cls, _query)
         if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         _id = self._query_cache[cls][_query]
         if _id is None:
             return None
         if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         return self._instance_cache[cls][_id]
 
+    def _fetch(self, cls, query):
+        shared = self._shared
+        if not (shared and shared.cacheable(cls, query)):
+            return self._model_query(cls).get(**query)
+        val = shared.get(cls, query['_id'])
+        if val is None:
+            val = self._model_query(cls).get(**query)
+            if val is not None:
+                shared.set(cls, val)
+        return val
+
     def set(self, cls, query, val):
         _query = self._normalize_query(query)
         if val is not None:
@@ -1840,9 +1933,25 @@ def batch_load(self, cls, query, attrs=None):
         '''
         if attrs is None:
             attrs = query.keys()
+        shared = self._shared if self._shared and cls in self._shared.fields else None
+        if shared and attrs == ['_id'] and query.keys() == ['_id'] \
+                and isinstance(query['_id'], dict) and query['_id'].keys() == ['$in']:
+            # only ask mongo for the ones not in the shared cache
+            missing = []
+            for _id in query['_id']['$in']:
+                val = shared.get(cls, _id)
+                if val is None:
+                    missing.append(_id)
+                else:
+                    self.set(cls, {'_id': _id}, val)
+            if not missing:
+                return
+            query = {'_id': {'$in': missing}}
         for result in self._model_query(cls).find(query):
             keys = {a: getattr(result, a) for a in attrs}
             self.set(cls, keys, result)
+            if shared:
+                shared.set(cls, result)
 
 
 class GitLikeTree(object):
@@ -1952,6 +2061,56 @@ def topological_sort(graph):
     assert not graph, 'Cycle detected'
 
 
+_lcd_pool = None
+_lcd_slots = None
+_lcd_pool_lock = Lock()
+
+
+def lcd_pool():
+    global _lcd_pool, _lcd_slots
+    with _lcd_pool_lock:
+        if _lcd_pool is None:
+            size = asint(tg.config.get('lcd_pool_size', 10))
+            _lcd_pool = ThreadPool(size)
+            _lcd_slots = BoundedSemaphore(size)
+        return _lcd_pool
+
+
+def run_lcd_job(func):
+    '''
+    Call ``func(result, deadline)`` on the :func:`lcd_pool` and return the
+    {path: commit_id} mapping it fills in `result`.
+
+    `func` should stop once ``time()`` passes `deadline`, which is
+    lcd_timeout seconds after it starts; this waits no longer than that for
+    it and returns whatever has been found by then.  When every pool thread
+    is already busy the job runs in the calling thread instead of queueing
+    behind (possibly stuck) jobs and timing out before it ever starts.
+    '''
+    timeout = float(tg.config.get('lcd_timeout', 60))
+    result = {}
+
+    def job():
+        try:
+            func(result, time() + timeout)
+        except Exception as e:
+            log.exception('Error in SCM thread: %s', e)
+
+    pool = lcd_pool()
+    if not _lcd_slots.acquire(False):
+        job()
+        return dict(result)
+
+    def pooled_job():
+        try:
+            job()
+        finally:
+            _lcd_slots.release()
+    # (giving the job a bit of extra cleanup time in case it times out)
+    pool.apply_async(pooled_job).wait(timeout + 0.5)
+    return dict(result)
+
+
 def prefix_paths_union(a, b):
     """
     Given two sets of paths, a and b, find the items from a that
@@ -16,15 +16,16 @@
 #       under the License.
 
 import logging
-import pymongo
 from collections import defaultdict
 
+from tg import config
+from paste.deploy.converters import asbool
 from ming import Session
 from ming.orm.base import state
 from ming.orm.ormsession import ThreadLocalORMSession, SessionExtension
 from contextlib import contextmanager
 
-from allura.lib.utils import chunked_list
+from allura.lib.utils import chunked_list, post_task_split
 from allura.tasks import index_tasks
 
 log = logging.getLogger(__name__)
@@ -36,6 +37,17 @@ def _needs_update(o):
     return o.should_update_index(old, new)
 
 
+def _markdown_changed(o):
+    # not everything in the artifact session is an Artifact
+    cache_fields = getattr(o, 'markdown_cache_fields', None)
+    fields = cache_fields() if cache_fields else []
+    if not fields:
+        return False
+    old = state(o).original_document
+    new = state(o).document
+    return any(old.get(f) != new.get(f) for f in fields)
+
+
 class ManagedSessionExtension(SessionExtension):
 
     def __init__(self, session):
@@ -121,10 +133,9 @@ def after_flush(self, obj=None):
             # Ensure artifact references & shortlinks exist for new objects
             arefs = []
             try:
-                arefs = [
-                    ArtifactReference.from_artifact(o)
-                    for o in self.objects_added + self.objects_modified
-                    if _needs_update(o)]
+                changed = [o for o in self.objects_added + self.objects_modified
+                           if _needs_update(o)]
+                arefs = [ArtifactReference.from_artifact(o) for o in changed]
                 for obj in self.objects_added + self.objects_modified:
                     Shortlink.from_artifact(obj)
                 # Flush shortlinks
@@ -133,15 +144,29 @@ def after_flush(self, obj=None):
                 log.exception(
                     "Failed to update artifact references. Is this a borked project migration?")
             self.update_index(self.objects_deleted, arefs)
+            # With markdown_cache.prerender, render edited markdown in the
+            # background, so that viewing it right after doesn't have to
+            if asbool(config.get('markdown_cache.prerender', False)):
+                self.render_markdown([o for o in self.objects_added + self.objects_modified
+                                      if _markdown_changed(o)])
         super(ArtifactSessionExtension, self).after_flush(obj)
 
+    def render_markdown(self, objects):
+        if objects:
+            index_tasks.render_markdown.post(
+                [obj.index_id() for obj in objects], coalesce_key='markdown')
+
     def update_index(self, objects_deleted, arefs):
         # Post delete and add indexing operations
+        # Merge into still-pending index tasks where possible, so that an
+        # artifact edited many times in a row is only re-indexed once
         if objects_deleted:
             index_tasks.del_artifacts.post(
-                [obj.index_id() for obj in objects_deleted])
+                [obj.index_id() for obj in objects_deleted],
+                coalesce_key='session')
         if arefs:
-            index_tasks.add_artifacts.post([aref._id for aref in arefs])
+            index_tasks.add_artifacts.post([aref._id for aref in arefs],
+                                           coalesce_key='session')
 
 
 class BatchIndexer(ArtifactSessionExtension):
@@ -208,16 +233,7 @@ def _post(cls, task_func, chunk):
         Post task, recursively splitting and re-posting if the resulting
         mongo document is too large.
         """
-        try:
-            task_func.post(chunk)
-        except pymongo.errors.InvalidDocument as e:
-            # there are many types of InvalidDocument, only recurse if its
-            # expected to help
-            if e.args[0].startswith('BSON document too large'):
-                cls._post(task_func, chunk[:len(chunk) // 2])
-                cls._post(task_func, chunk[len(chunk) // 2:])
-            else:
-                raise
+        post_task_split(task_func, chunk)
 
 
 @contextmanager
@@ -17,13 +17,18 @@
 
 import sys
 import logging
+from collections import defaultdict
 from contextlib import contextmanager
 
 from pylons import app_globals as g
+from tg import config
+from ming.orm import session
+from paste.deploy.converters import asint, asbool
 
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
 from allura.lib.solr import make_solr_from_config
+from allura.lib.utils import chunked_iter
 
 
 log = logging.getLogger(__name__)
@@ -69,41 +74,138 @@ def del_users(user_solr_ids):
 
 
 @task
-def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
+def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None,
+                  atomic_updates=True):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    If ``solr.atomic_updates`` is enabled, artifacts whose text didn't change
+    since they were last indexed are updated with a solr atomic update of
+    just the changed fields, instead of re-rendering and re-sending the whole
+    document.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
+    :param atomic_updates: set to False to always send whole documents, e.g.
+      when the solr index has been cleared
+    '''
+    from allura import model as M
+    from allura.lib.search import find_shortlinks, solr_field_hashes, changed_solr_fields
+
+    exceptions = []
+    chunk_size = asint(config.get('solr.index_chunk_size', 500))
+    track_fields = (update_solr and not solr_hosts and
+                    asbool(config.get('solr.atomic_updates', False)))
+    atomic_updates = track_fields and atomic_updates
+    partial_docs = defaultdict(list)  # changed fields -> partial docs
+    new_hashes = []
+
+    def solarized_chunks():
+        # Solarize in bounded chunks, so that posting one chunk to solr
+        # overlaps with rendering the next, and memory use doesn't grow with
+        # the number of artifacts
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}))
+        for chunk in chunked_iter(refs, chunk_size):
+            solr_updates = []
+            for ref in chunk:
+                try:
+                    artifact = ref.artifact
+                    if artifact is None:
+                        continue
+                    if track_fields:
+                        doc = artifact.index()
+                        if doc is None:
+                            continue
+                        hashes = solr_field_hashes(doc)
+                        changed = None
+                        if atomic_updates:
+                            changed = changed_solr_fields(ref.solr_hashes, hashes, doc)
+                        if changed is not None:
+                            # text is unchanged, so no need to render it or
+                            # to update shortlinks either
+                            if changed:
+                                partial = dict((k, doc[k]) for k in changed)
+                                if artifact.solr_text_has_fields:
+                                    partial['text'] = artifact.solr_text(doc)
+                                    changed = changed + ['text']
+                                partial['id'] = doc['id']
+                                partial_docs[tuple(sorted(changed))].append(partial)
+                            new_hashes.append((ref._id, hashes))
+                            continue
+                    if track_fields:
+                        s = dict(doc, text=artifact.solr_text(doc))
+                    else:
+                        s = artifact.solarize()
+                    if s is None:
+                        continue
+                    if update_solr:
+                        solr_updates.append(s)
+                    if track_fields:
+                        # only now that the whole document is queued
+                        new_hashes.append((ref._id, hashes))
+                    if update_refs:
+                        if isinstance(artifact, M.Snapshot):
+                            continue
+                        # Find shortlinks in the raw text, not the escaped html
+                        # created by the `solarize()`.
+                        link_text = artifact.index().get('text') or ''
+                        shortlinks = find_shortlinks(link_text)
+                        ref.references = [link.ref_id for link in shortlinks]
+                except Exception:
+                    log.error('Error indexing artifact %s', ref._id)
+                    exceptions.append(sys.exc_info())
+            yield solr_updates
+            # the chunk has been sent, so save its references and drop it
+            # (and its artifacts) from the identity map, to keep memory use
+            # bounded by the chunk size
+            for ref in chunk:
+                artifact = ref.__dict__.get('artifact')
+                if artifact is not None and session(artifact) is not None:
+                    session(artifact).expunge(artifact)
+                session(ref).flush(ref)
+                session(ref).expunge(ref)
+
+    with _indexing_disabled(M.session.artifact_orm_session._get()):
+        solr = __get_solr(solr_hosts)
+        solr.add_pipelined(solarized_chunks())
+        for fields, docs in partial_docs.iteritems():
+            solr.add(docs, fieldUpdates=dict((f, 'set') for f in fields))
+        # only once solr has them, so a failed add isn't mistaken for indexed
+        for ref_id, hashes in new_hashes:
+            M.ArtifactReference.query.update(
+                {'_id': ref_id}, {'$set': {'solr_hashes': hashes}})
+
+    if len(exceptions) == 1:
+        raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
+    if exceptions:
+        raise CompoundError(*exceptions)
+
+
+@task
+def render_markdown(ref_ids):
+    '''
+    Render the markdown of the referenced artifacts into their ``_cache``
+    fields (see :meth:`~allura.model.artifact.Artifact.fill_markdown_cache`),
+    so that viewing them doesn't have to.  Each is rendered in the context of
+    its own project and tool.
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
+    from allura.lib import helpers as h
 
     exceptions = []
-    solr_updates = []
+    # storing the html must neither re-index the artifacts nor bump mod_date
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        for ref in M.ArtifactReference.prefetch_artifacts(ref_ids):
             try:
                 artifact = ref.artifact
-                if artifact is None:
+                if artifact is None or not artifact.markdown_cache_fields():
                     continue
-                s = artifact.solarize()
-                if s is None:
-                    continue
-                if update_solr:
-                    solr_updates.append(s)
-                if update_refs:
-                    if isinstance(artifact, M.Snapshot):
-                        continue
-                    # Find shortlinks in the raw text, not the escaped html
-                    # created by the `solarize()`.
-                    link_text = artifact.index().get('text') or ''
-                    shortlinks = find_shortlinks(link_text)
-                    ref.references = [link.ref_id for link in shortlinks]
+                with h.push_context(artifact.project_id, app_config_id=artifact.app_config_id):
+                    artifact.fill_markdown_cache()
             except Exception:
-                log.error('Error indexing artifact %s', ref._id)
+                log.error('Error rendering artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+        M.session.artifact_orm_session.flush()
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
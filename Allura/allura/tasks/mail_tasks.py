@@ -18,10 +18,13 @@
 import logging
 import HTMLParser
 import re
+import threading
+from multiprocessing.pool import ThreadPool
 
 from pylons import tmpl_context as c, app_globals as g, config
 from bson import ObjectId
 import markupsafe
+from paste.deploy.converters import asint
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
@@ -137,17 +140,22 @@ def replace_html(matchobj):
     return multi_msg, html_msg, plain_msg
 
 
-@task
-def sendmail(fromaddr, destinations, text, reply_to, subject,
-             message_id, in_reply_to=None, sender=None, references=None, metalink=None):
-    '''
-    Send an email to the specified list of destinations with respect to the preferred email format specified by user.
-    It is best for broadcast messages.
+def _find_user(user_id, users=None):
+    '''Look up an enabled user by id, in `users` (by str id) if given'''
+    from allura import model as M
+    if users is not None:
+        return users.get(str(user_id))
+    return M.User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
 
-    :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
 
+def _sendmail_calls(fromaddr, destinations, text, reply_to, subject,
+                    message_id, in_reply_to=None, sender=None, references=None,
+                    metalink=None, users=None):
+    '''
+    Return the (args, kwargs) of the :meth:`SMTPClient.sendmail
+    <allura.lib.mail_util.SMTPClient.sendmail>` calls that send a
+    :func:`sendmail` message, one per email format.
     '''
-    from allura import model as M
     addrs_plain = []
     addrs_html = []
     addrs_multi = []
@@ -155,7 +163,7 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         fromaddr = g.noreply
     elif not isinstance(fromaddr, basestring) or '@' not in fromaddr:
         log.warning('Looking up user with fromaddr: %s', fromaddr)
-        user = M.User.query.get(_id=ObjectId(fromaddr), disabled=False, pending=False)
+        user = _find_user(fromaddr, users)
         if not user:
             log.warning('Cannot find user with ID: %s', fromaddr)
             fromaddr = g.noreply
@@ -167,7 +175,7 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             addrs_plain.append(addr)
         else:
             try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
+                user = _find_user(addr, users)
                 if not user:
                     log.warning('Cannot find user with ID: %s', addr)
                     continue
@@ -193,15 +201,87 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
                 addrs_multi.append(addr)
 
     multi_msg, html_msg, plain_msg = create_multipart_msg(text, metalink)
-    smtp_client.sendmail(
-        addrs_multi, fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_plain, fromaddr, reply_to, subject, message_id,
-        in_reply_to, plain_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_html, fromaddr, reply_to, subject, message_id,
-        in_reply_to, html_msg, sender=sender, references=references)
+    kw = dict(sender=sender, references=references)
+    return [
+        ((addrs, fromaddr, reply_to, subject, message_id, in_reply_to, msg), kw)
+        for addrs, msg in [(addrs_multi, multi_msg),
+                           (addrs_plain, plain_msg),
+                           (addrs_html, html_msg)]]
+
+
+@task
+def sendmail(fromaddr, destinations, text, reply_to, subject,
+             message_id, in_reply_to=None, sender=None, references=None, metalink=None):
+    '''
+    Send an email to the specified list of destinations with respect to the preferred email format specified by user.
+    It is best for broadcast messages.
+
+    :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
+
+    '''
+    for args, kw in _sendmail_calls(
+            fromaddr, destinations, text, reply_to, subject, message_id,
+            in_reply_to=in_reply_to, sender=sender, references=references,
+            metalink=metalink):
+        smtp_client.sendmail(*args, **kw)
+
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+_smtp_local = threading.local()
+
+
+def smtp_pool():
+    '''Return the process-wide pool of threads sending mail for
+    :func:`sendmail_batch`, with smtp_pool_size (default 4) threads'''
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            _smtp_pool = ThreadPool(asint(config.get('smtp_pool_size', 4)))
+        return _smtp_pool
+
+
+def _thread_smtp_client():
+    '''Each pool thread keeps its own SMTP connection open between messages'''
+    client = getattr(_smtp_local, 'client', None)
+    if client is None:
+        client = _smtp_local.client = mail_util.SMTPClient()
+    return client
+
+
+@task
+def sendmail_batch(messages):
+    '''
+    Send several :func:`sendmail` messages, each given as a dict of its
+    arguments.  Users are looked up with one query, and the messages are
+    sent in parallel by the :func:`smtp_pool` threads.  A message that
+    fails is logged without stopping the others.
+    '''
+    from allura import model as M
+    user_ids = set()
+    for m in messages:
+        for addr in [m.get('fromaddr')] + list(m['destinations']):
+            if addr is not None and ObjectId.is_valid(addr):
+                user_ids.add(ObjectId(addr))
+    users = dict((str(u._id), u) for u in M.User.query.find({
+        '_id': {'$in': list(user_ids)}, 'disabled': False, 'pending': False}))
+    # messages are rendered here, since markdown needs the request globals
+    jobs = []
+    for m in messages:
+        try:
+            jobs.append((m['message_id'], _sendmail_calls(users=users, **m)))
+        except:
+            log.exception('Error preparing message %s', m.get('message_id'))
+
+    def send(job):
+        message_id, calls = job
+        client = _thread_smtp_client()
+        try:
+            for args, kw in calls:
+                client.sendmail(*args, **kw)
+        except:
+            log.exception('Error sending message %s', message_id)
+    smtp_pool().map(send, jobs)
 
 
 @task
@@ -400,6 +400,95 @@ def test_post_url_paginated():
         assert _p.url_paginated() == url, _p.url_paginated()
 
 
+@with_setup(setUp, tearDown)
+def test_query_posts_after():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    p0 = t.post('post #0', timestamp=ts)
+    p1 = t.post('post #1', timestamp=ts + timedelta(minutes=1))
+    r0 = t.post('reply to post #0', parent_id=p0._id,
+                timestamp=ts + timedelta(minutes=2))
+    ThreadLocalORMSession.flush_all()
+    page = t.find_posts(limit=2)
+    assert_equals(page, [p0, r0])
+    assert_equals(t.find_posts(limit=2, after=page[-1].full_slug), [p1])
+    assert_equals(t.find_posts(page=5, limit=2, after=p0.full_slug), [r0, p1])
+    page = t.find_posts(limit=2, style='chronological')
+    assert_equals(page, [p0, p1])
+    assert_equals(t.find_posts(limit=2, style='chronological',
+                               after=(page[-1].timestamp, page[-1]._id)), [r0])
+
+
+@with_setup(setUp, tearDown)
+def test_query_posts_after_same_timestamp():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow().replace(microsecond=0)
+    posts = [t.post('post #%s' % i, message_id='%s@test' % i, timestamp=ts)
+             for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    page = t.find_posts(limit=2, style='chronological')
+    assert_equals(page, posts[:2])
+    cursor = t.posts_cursor(page[-1])
+    assert_equals(t.parse_posts_cursor(cursor), (ts, '1@test'))
+    assert_equals(t.find_posts(limit=2, style='chronological',
+                               after=t.parse_posts_cursor(cursor)), posts[2:])
+    assert_equals(t.__json__(limit=2)['next_after'], cursor)
+    assert_equals(t.parse_posts_cursor('not a cursor'), None)
+
+
+@with_setup(setUp, tearDown)
+def test_post_counters():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    p0 = t.post('post #0')
+    p1 = t.post('post #1')
+    ThreadLocalORMSession.flush_all()
+    assert_equals((t.num_replies, d.num_posts), (2, 2))
+    p0.spam()
+    assert_equals((t.num_replies, d.num_posts), (1, 1))
+    p0.undo('ok')
+    assert_equals((t.num_replies, d.num_posts), (2, 2))
+    p0.delete()
+    assert_equals((t.num_replies, d.num_posts), (1, 1))
+    # counters can still be recounted from scratch
+    t.num_replies = d.num_posts = 5
+    t.update_stats()
+    d.update_stats()
+    assert_equals((t.num_replies, d.num_posts), (1, 1))
+    ThreadLocalORMSession.flush_all()
+    # a change made by another process isn't overwritten, and is seen here
+    M.Thread.query.update({'_id': t._id}, {'$inc': {'num_replies': 1}})
+    p1.spam()
+    assert_equals((t.num_replies, d.num_posts), (1, 0))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert_equals(M.Thread.query.get(_id=t._id).num_replies, 1)
+
+
+@with_setup(setUp, tearDown)
+def test_post_position():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    p0 = t.post('post #0', timestamp=ts)
+    p1 = t.post('post #1', timestamp=ts + timedelta(minutes=1))
+    r0 = t.post('reply to post #0', parent_id=p0._id,
+                timestamp=ts + timedelta(minutes=2))
+    spam = t.post('spam', timestamp=ts + timedelta(seconds=30))
+    spam.status = 'spam'
+    ThreadLocalORMSession.flush_all()
+    assert_equals([t.post_position(p) for p in (p0, r0, p1)], [0, 1, 2])
+    assert_equals([t.post_position(p, style='flat') for p in (p0, p1, r0)],
+                  [0, 1, 2])
+    c.user.set_pref('results_per_page', 2)
+    with patch.object(M.Thread, 'find_posts') as find_posts:
+        assert_equals(p1.url_paginated(),
+                      t.url() + '?limit=2&page=1#' + p1.slug)
+    assert not find_posts.called
+
+
 @with_setup(setUp, tearDown)
 def test_post_url_paginated_with_artifact():
     """Post.url_paginated should return link to attached artifact, if any"""
@@ -532,7 +621,10 @@ def test_spam_num_replies(spam_checker):
     t = M.Thread(discussion_id=d._id, subject='Test Thread', num_replies=2)
     M.Post(discussion_id=d._id, thread_id=t._id, status='ok')
     ThreadLocalORMSession.flush_all()
-    p1 = M.Post(discussion_id=d._id, thread_id=t._id, status='spam')
+    p1 = M.Post(discussion_id=d._id, thread_id=t._id, status='ok')
+    p1.spam()
+    assert_equal(t.num_replies, 1)
+    # already spam, doesn't count again
     p1.spam()
     assert_equal(t.num_replies, 1)
 
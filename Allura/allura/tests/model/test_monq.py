@@ -16,12 +16,17 @@
 #       under the License.
 
 import pprint
+
+from bson import ObjectId
+from mock import patch, ANY, MagicMock
 from nose.tools import with_setup
 
+import tg
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.model.monq_model import task_name_matches
 
 
 def setUp():
@@ -40,3 +45,156 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_post_signals_wakeup():
+    with patch.object(M.MonQWakeup, 'enabled', return_value=True), \
+            patch.object(M.MonQWakeup, 'collection') as collection:
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    collection.return_value.insert.assert_called_once_with(
+        dict(task_name='pprint.pformat', time=ANY))
+
+
+def test_wakeup_skips_seen_signals():
+    old, new = ObjectId(), ObjectId()
+    wakeup = M.MonQWakeup()
+    wakeup.last_id = old
+    cursor = MagicMock(alive=True)
+    cursor.__iter__.return_value = iter([dict(_id=old, task_name='a'),
+                                         dict(_id=new, task_name='b')])
+    with patch.object(M.MonQWakeup, 'collection') as collection:
+        collection.return_value.find.return_value = cursor
+        assert wakeup.wait(1)
+    collection.return_value.find.assert_called_once_with(
+        tailable=True, await_data=True)
+    assert wakeup.last_id == new
+
+
+@with_setup(setUp)
+def test_get_batch():
+    low = M.MonQTask.post(pprint.pformat, ([1],), priority=5)
+    first = M.MonQTask.post(pprint.pformat, ([2],))
+    second = M.MonQTask.post(pprint.pformat, ([3],))
+    M.MonQTask.post(pprint.pformat, ([4],), delay=60)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', batch_size=2)
+    assert [t._id for t in tasks] == [first._id, second._id], tasks
+    assert all(t.state == 'busy' and t.time_start for t in tasks)
+    tasks = M.MonQTask.get_batch(process='test', batch_size=2)
+    assert [t._id for t in tasks] == [low._id], tasks
+    assert M.MonQTask.get_batch(process='test', batch_size=2) == []
+
+
+def _fail(*args):
+    raise ValueError('boom')
+
+
+@with_setup(setUp)
+def test_run_batch():
+    ok = M.MonQTask.post(pprint.pformat, ([1],))
+    bad = M.MonQTask.post(_fail, ([2],))
+    after = M.MonQTask.post(pprint.pformat, ([3],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', batch_size=3)
+    assert len(tasks) == 3, tasks
+    with patch.dict(tg.config, {'monq.raise_errors': 'false'}):
+        M.MonQTask.run_batch(tasks, nocapture=True)
+    ThreadLocalORMSession.close_all()
+    ok, bad, after = [M.MonQTask.query.get(_id=t._id) for t in (ok, bad, after)]
+    assert ok.state == 'complete', ok.state
+    assert '[1]' in ok.result, ok.result
+    assert bad.state == 'error', bad.state
+    assert 'boom' in bad.result, bad.result
+    assert after.state == 'complete', after.state
+    assert all(t.time_start and t.time_stop for t in (ok, bad, after))
+
+
+@with_setup(setUp)
+def test_run_batch_clears_credentials():
+    tasks = [M.MonQTask.post(pprint.pformat, ([i],)) for i in range(2)]
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', batch_size=2)
+    with patch('allura.model.monq_model.Credentials') as Credentials:
+        M.MonQTask.run_batch(tasks, nocapture=True)
+    assert Credentials.get.return_value.clear.call_count == 2
+
+
+@with_setup(setUp)
+def test_post_coalesce():
+    task = M.MonQTask.post(len, ([1, 2],), coalesce_key='k')
+    same = M.MonQTask.post(len, ([2, 3],), coalesce_key='k')
+    other = M.MonQTask.post(len, ([4],), coalesce_key='other')
+    plain = M.MonQTask.post(len, ([5],))
+    assert same._id == task._id
+    assert other._id != task._id
+    assert plain._id != task._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=task._id)
+    assert sorted(task.args[0]) == [1, 2, 3], task.args
+    assert task.coalesced == 1
+    assert M.MonQTask.coalesce_stats() == {'__builtin__.len': 1}
+
+    # busy tasks can't be merged into anymore
+    M.MonQTask.get(only=['__builtin__.len'])
+    ThreadLocalORMSession.flush_all()
+    assert M.MonQTask.post(len, ([1],), coalesce_key='k')._id != task._id
+
+
+@with_setup(setUp)
+def test_post_coalesce_keeps_order():
+    add = M.MonQTask.post(len, ([1],), coalesce_key='k')
+    delete = M.MonQTask.post(pprint.pformat, ([1],), coalesce_key='k')
+    readd = M.MonQTask.post(len, ([1],), coalesce_key='k')
+    # merged into the newest task for the key only
+    assert readd._id not in (add._id, delete._id)
+    again = M.MonQTask.post(len, ([2],), coalesce_key='k')
+    assert again._id == readd._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = [M.MonQTask.get(only=['__builtin__.len', 'pprint.pformat'])
+             for i in range(3)]
+    assert [t._id for t in tasks] == [add._id, delete._id, readd._id], tasks
+    assert tasks[0].args[0] == [1], tasks[0].args
+    assert sorted(tasks[2].args[0]) == [1, 2], tasks[2].args
+
+
+@with_setup(setUp)
+def test_post_coalesce_context():
+    task = M.MonQTask.post(len, ([1],), coalesce_key='k')
+    # a stored context with a key the new task's context doesn't have
+    M.MonQTask._collection().update(
+        {'_id': task._id}, {'$set': {'context.extra': 1}})
+    assert M.MonQTask.post(len, ([2],), coalesce_key='k')._id != task._id
+
+
+@with_setup(setUp)
+def test_post_coalesce_max_items():
+    with patch.object(M.MonQTask, 'coalesce_max_items', 3):
+        task = M.MonQTask.post(len, ([1],), coalesce_key='k')
+        full = M.MonQTask.post(len, ([2, 3, 4],), coalesce_key='k')
+        assert full._id != task._id
+        assert M.MonQTask.post(len, ([5],), coalesce_key='k')._id != full._id
+
+
+@with_setup(setUp)
+def test_only_wildcards():
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    M.MonQTask.post(len, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    assert M.MonQTask.ready_count() == 2
+    assert M.MonQTask.ready_count(['pprint.*']) == 1
+    assert M.MonQTask.ready_count(['pprint.*', '__builtin__.len']) == 2
+    assert M.MonQTask.ready_count(['pprint']) == 0
+    assert M.MonQTask.ready_count(['!pprint.*']) == 1
+    assert M.MonQTask.ready_count(['*', '!__builtin__.len']) == 1
+    assert task_name_matches('pprint.pformat', ['!__builtin__.*'])
+    assert not task_name_matches('__builtin__.len', ['!__builtin__.*'])
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.get(only=['pprint.*'])
+    assert task.task_name == 'pprint.pformat', task
@@ -24,6 +24,8 @@
 from ming.orm import ThreadLocalORMSession
 import mock
 import bson
+import pymongo
+import tg
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
@@ -213,6 +215,35 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_deliver_bulk(self):
+        self._subscribe()
+        self._subscribe(user=M.User.query.get(username='test-user-2'))
+        M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        # delivering again doesn't queue it twice
+        M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        ThreadLocalORMSession.close_all()
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid1'])
+            assert not mbox.queue_empty
+
+    def test_deliver_falls_back_per_mailbox(self):
+        self._subscribe()
+        self._subscribe(user=M.User.query.get(username='test-user-2'))
+        query_cls = type(M.Mailbox.query)
+        update = query_cls.update
+
+        def fail_multi(self, spec, fields, **kw):
+            if kw.get('multi'):
+                raise Exception('too big')
+            return update(self, spec, fields, **kw)
+        with mock.patch.object(query_cls, 'update', fail_multi):
+            M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        ThreadLocalORMSession.close_all()
+        for mbox in M.Mailbox.query.find():
+            assert_equal(mbox.queue, ['nid1'])
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -368,6 +399,62 @@ def _test_message(self):
         u = M.User.by_username('test-admin')
         assert str(u._id) in msg.kwargs['fromaddr'], msg.kwargs['fromaddr']
 
+    def test_message_batched(self):
+        self._subscribe()
+        thd = M.Thread.query.get(ref_id=self.pg.index_id())
+        thd.post('This is a very cool message')
+        thd.post('This is another cool message')
+        M.MonQTask.run_ready()
+        ThreadLocalORMSession.flush_all()
+        with h.push_config(tg.config, **{'notifications.fire_batch_size': '10'}):
+            M.Mailbox.fire_ready()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert_equal(M.MonQTask.query.find(dict(
+            task_name='allura.tasks.mail_tasks.sendmail', state='ready')).count(), 0)
+        task = M.MonQTask.query.get(
+            task_name='allura.tasks.mail_tasks.sendmail_batch', state='ready')
+        assert task is not None
+        messages = task.args[0]
+        assert_equal(len(messages), 2)
+        u = M.User.by_username('test-admin')
+        for msg in messages:
+            assert 'Home@wiki.test.p' in msg['reply_to']
+            assert str(u._id) in msg['fromaddr'], msg['fromaddr']
+        assert_equal(M.Mailbox.query.find(dict(
+            type='direct', queue_empty=False)).count(), 0)
+
+    @mock.patch('allura.tasks.mail_tasks.sendmail_batch')
+    def test_fire_batch_error(self, sendmail_batch):
+        def fire(now, notifications, messages):
+            messages.append(dict(message_id='ok'))
+        failing = mock.Mock(_id=bson.ObjectId(), queue=[])
+        failing.fire.side_effect = ValueError
+        ok = mock.Mock(_id=bson.ObjectId(), queue=[])
+        ok.fire.side_effect = fire
+        # the mailboxes are already claimed, so the rest of the batch is
+        # fired and sent before the error is raised
+        with self.assertRaises(ValueError):
+            M.Mailbox._fire_direct_batches(None, [failing, ok], 10)
+        ok.fire.assert_called_once_with(None, {}, [dict(message_id='ok')])
+        sendmail_batch.post.assert_called_once_with([dict(message_id='ok')])
+
+    @mock.patch('allura.tasks.mail_tasks.sendmail_batch')
+    def test_fire_batch_too_large(self, sendmail_batch):
+        def post(messages):
+            if len(messages) > 1:
+                raise pymongo.errors.InvalidDocument('BSON document too large (123 bytes)')
+        sendmail_batch.post.side_effect = post
+        messages = [dict(message_id=str(i)) for i in range(3)]
+
+        def fire(now, notifications, batch_messages):
+            batch_messages.extend(messages)
+        mbox = mock.Mock(_id=bson.ObjectId(), queue=[])
+        mbox.fire.side_effect = fire
+        M.Mailbox._fire_direct_batches(None, [mbox], 10)
+        assert_equal(sendmail_batch.post.call_args_list[-3:], [
+            mock.call([messages[0]]), mock.call([messages[1]]), mock.call([messages[2]])])
+
     def _clear_subscriptions(self):
         M.Mailbox.query.remove({})
         ThreadLocalORMSession.flush_all()
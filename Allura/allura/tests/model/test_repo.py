@@ -22,8 +22,10 @@
 import mock
 from nose.tools import assert_equal
 from pylons import tmpl_context as c
+import bson
 from bson import ObjectId
-from ming.orm import session
+from ming.orm import session, ThreadLocalORMSession
+from ming.orm.base import state
 from tg import config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
@@ -96,6 +98,20 @@ def test_repair_commit_run(self):
         self.assertEqual(len(run.commit_ids), len(run.commit_times))
         self.assertEqual(run.parent_commit_ids, [])
 
+    def test_refresh_children_bulk(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        children = dict(
+            (ci._id, sorted(ci.child_ids))
+            for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids})))
+        M.repository.CommitDoc.m.update_partial(
+            dict(_id={'$in': commit_ids}), {'$set': dict(child_ids=[])}, multi=True)
+        batches = list(M.repo_refresh.commit_doc_batches(commit_ids, batch_size=2))
+        self.assertEqual([ci._id for cis in batches for ci in cis], commit_ids)
+        for cis in batches:
+            M.repo_refresh.refresh_children_bulk(cis)
+        for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids})):
+            self.assertEqual(sorted(ci.child_ids), children[ci._id])
+
 
 class RepoTestBase(unittest.TestCase):
     def setUp(self):
@@ -400,7 +416,7 @@ def test_loop(self):
 
 class TestModelCache(unittest.TestCase):
     def setUp(self):
-        self.cache = M.repository.ModelCache()
+        self.cache = M.repository.ModelCache(shared=False)
 
     def test_normalize_query(self):
         self.assertEqual(self.cache._normalize_query(
@@ -684,6 +700,81 @@ def test_pruning_instance_flush(self, session):
         session.return_value.expunge.assert_called_once_with(tree1)
 
 
+class TestSharedModelCache(unittest.TestCase):
+    def setUp(self):
+        self.shared = M.repository.SharedModelCache(1000)
+
+    def _trees(self, _id, *tree_ids):
+        return M.repository.TreesDoc.make(dict(_id=_id, tree_ids=list(tree_ids)))
+
+    def test_get_set(self):
+        trees = self._trees('foo', 'a', 'b')
+        self.shared.set(M.repository.TreesDoc, trees)
+        val = self.shared.get(M.repository.TreesDoc, 'foo')
+        self.assertEqual(val, trees)
+        self.assertIsNot(val, trees)
+        self.assertEqual(self.shared.get(M.repository.TreesDoc, 'bar'), None)
+        stats = self.shared.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['size'], len(bson.BSON.encode(trees)))
+
+    def test_eviction(self):
+        trees = [self._trees('id%d' % i, 'x' * 250) for i in range(3)]
+        for t in trees:
+            self.shared.set(M.repository.TreesDoc, t)
+        self.shared.get(M.repository.TreesDoc, 'id0')
+        self.shared.set(M.repository.TreesDoc, self._trees('id3', 'x' * 250))
+        self.assertEqual(self.shared.get(M.repository.TreesDoc, 'id1'), None)
+        self.assertEqual(self.shared.get(M.repository.TreesDoc, 'id0'), trees[0])
+        self.assertLessEqual(self.shared.size, 1000)
+        self.assertEqual(self.shared.evictions, 1)
+
+    @mock.patch.object(M.repository.TreesDoc.m, 'get')
+    def test_model_caches_share(self, tr_get):
+        tr_get.return_value = self._trees('foo', 'a')
+        for i in range(2):
+            cache = M.repository.ModelCache(shared=self.shared)
+            val = cache.get(M.repository.TreesDoc, {'_id': 'foo'})
+            self.assertEqual(val.tree_ids, ['a'])
+        tr_get.assert_called_once_with(_id='foo')
+        # other queries always go to mongo
+        cache.get(M.repository.TreesDoc, {'_id': 'foo', 'tree_ids': 'a'})
+        self.assertEqual(tr_get.call_count, 2)
+
+    @mock.patch.object(M.repository.TreesDoc.m, 'find')
+    def test_batch_load(self, tr_find):
+        self.shared.set(M.repository.TreesDoc, self._trees('id1', 'a'))
+        tr_find.return_value = [self._trees('id2', 'b')]
+        cache = M.repository.ModelCache(shared=self.shared)
+        cache.batch_load(M.repository.TreesDoc, {'_id': {'$in': ['id1', 'id2']}})
+        tr_find.assert_called_once_with({'_id': {'$in': ['id2']}})
+        self.assertEqual(sorted(cache.instance_ids(M.repository.TreesDoc)), ['id1', 'id2'])
+        self.assertEqual(self.shared.get(M.repository.TreesDoc, 'id2').tree_ids, ['b'])
+
+    def test_mapped_class(self):
+        setup_basic_test()
+        tree = M.repository.Tree(_id='tree1', tree_ids=[dict(name='a', id='tree2')],
+                                 blob_ids=[], other_ids=[])
+        session(tree).flush(tree)
+        session(tree).expunge(tree)
+        M.repository.ModelCache(shared=self.shared).get(
+            M.repository.Tree, {'_id': 'tree1'})
+        self.assertEqual(self.shared.stats()['misses'], 1)
+        cache = M.repository.ModelCache(shared=self.shared)
+        val = cache.get(M.repository.Tree, {'_id': 'tree1'})
+        self.assertEqual(self.shared.stats()['hits'], 1)
+        self.assertEqual(val.tree_ids[0]['id'], 'tree2')
+        self.assertEqual(session(val), None)
+        self.assertEqual(state(val).status, state(val).clean)
+        # flushing mustn't write the cached copy back
+        M.repository.Tree.query.remove({'_id': 'tree1'})
+        cache._try_flush(val)
+        ThreadLocalORMSession.flush_all()
+        self.assertEqual(M.repository.Tree.query.get(_id='tree1'), None)
+
+
 class TestMergeRequest(object):
     def setUp(self):
         setup_basic_test()
@@ -26,7 +26,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -358,6 +358,25 @@ def test_suspicious_tasks(self):
         assert task1.state == 'complete'
 
 
+# taskd unit tests
+def test_worker_pool_from_config():
+    pools = taskd.WorkerPool.from_config({
+        'taskd.pools': 'repo, default',
+        'taskd.pool.repo.only': 'allura.tasks.repo_tasks.*, allura.tasks.mail_tasks.sendmail',
+        'taskd.pool.repo.max': '4',
+        'taskd.pool.default.min': '2',
+        'taskd.pool.default.tasks_per_worker': '5',
+    })
+    repo, default = pools
+    assert_equal(repo.only, ['allura.tasks.repo_tasks.*', 'allura.tasks.mail_tasks.sendmail'])
+    assert_equal((repo.min_workers, repo.max_workers), (1, 4))
+    # the default pool leaves the tasks of the other pools alone
+    assert_equal(default.only, ['!allura.tasks.repo_tasks.*', '!allura.tasks.mail_tasks.sendmail'])
+    assert_equal((default.min_workers, default.max_workers), (2, 2))
+    assert_equal([repo.wanted(n) for n in (0, 10, 11, 100)], [1, 1, 2, 4])
+    assert_equal(default.wanted(100), 2)
+
+
 # taskd_cleanup unit tests
 def test_status_log_retries():
     cmd = taskd_cleanup.TaskdCleanupCommand('taskd_command')
@@ -471,7 +490,8 @@ def on_post(chunk, **kw):
         cmd = show_models.ReindexCommand('reindex')
         cmd.options, args = cmd.parser.parse_args([])
         cmd._post_add_artifacts(range(5))
-        kw = {'update_solr': cmd.options.solr, 'update_refs': cmd.options.refs}
+        kw = {'update_solr': cmd.options.solr, 'update_refs': cmd.options.refs,
+              'atomic_updates': False}
         expected = [
             call([0, 1, 2, 3, 4], **kw),
             call([0, 1], **kw),
@@ -380,6 +380,20 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+@td.with_wiki
+def test_wiki_artifact_links_prefetched():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        with patch.object(M.Shortlink, 'lookup') as lookup, \
+                patch.object(M.Shortlink, 'from_links', wraps=M.Shortlink.from_links) as from_links:
+            text = g.markdown.convert(
+                'See [test:wiki:Home], [Go home](test:wiki:Home) and [wiki:NoSuchPage]')
+        assert_equal(lookup.call_count, 0)
+        assert_equal(from_links.call_count, 1)
+    assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
+    assert '<a class="" href="/p/test/wiki/Home/">Go home</a>' in text, text
+    assert '<span>[wiki:NoSuchPage]</span>' in text, text
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -721,6 +735,14 @@ def test_valid_cache(self):
             html = self.md.cached_convert(self.post, 'text')
             self.assertTrue(convert_func.called)
 
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='-0.01')
+    def test_get_cached(self):
+        self.assertIsNone(self.md.get_cached(self.post, 'text'))
+        self.md.cached_convert(self.post, 'text')
+        self.assertEqual(self.md.get_cached(self.post, 'text'), self.expected_html)
+        self.post.text = u'new, different source text'
+        self.assertIsNone(self.md.get_cached(self.post, 'text'))
+
     @patch.dict('allura.lib.app_globals.config', {})
     def test_no_threshold_defined(self):
         html = self.md.cached_convert(self.post, 'text')
@@ -745,6 +767,19 @@ def test_render_time_below_threshold(self):
         self.assertIsNone(self.post.text_cache.html)
         self.assertIsNone(self.post.text_cache.render_time)
 
+    @patch.dict('allura.lib.app_globals.config', {})
+    def test_fill_cache(self):
+        self.assertTrue(self.md.fill_cache(self.post, 'text'))
+        self.assertEqual(self.post.text_cache.html, self.expected_html)
+        self.assertEqual(hashlib.md5(self.post.text).hexdigest(),
+                         self.post.text_cache.md5)
+        with patch.object(self.md, 'convert') as convert_func:
+            self.assertFalse(self.md.fill_cache(self.post, 'text'))
+            self.assertFalse(convert_func.called)
+            self.post.text = u"text [[macro]] pass"
+            self.assertFalse(self.md.fill_cache(self.post, 'text'))
+            self.assertFalse(convert_func.called)
+
     @patch.dict('allura.lib.app_globals.config', {})
     def test_all_expected_keys_exist_in_cache(self):
         self.md.cached_convert(self.post, 'text')
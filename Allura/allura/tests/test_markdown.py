@@ -146,3 +146,24 @@ def test_convert(self, lookup, get_comment_slug):
             extensions=[mde.CommitMessageExtension(app), 'nl2br'],
             output_format='html4')
         self.assertEqual(md.convert(text), expected_html)
+
+
+class TestRelativeLinkRewriter(unittest.TestCase):
+
+    def test_rewrite_and_sanitize(self):
+        html = ('<p><a href="Home">home</a> <a title="x" href="http://example.com/a b">ext</a>'
+                '<br><img src="pic.png" alt="pic"><script>alert(1)</script>'
+                '<a href="/p/test/">abs</a> <a href="#top">top</a></p>')
+        with mock.patch.dict(mde.config, {'nofollow_exempt_domains': ''}):
+            out = mde.RelativeLinkRewriter().run(html)
+        self.assertEqual(
+            out,
+            '<p><a href="../Home">home</a> '
+            '<a href="http://example.com/a%20b" rel="nofollow" title="x">ext</a>'
+            '<br/><img alt="pic" src="../pic.png"/>&lt;script&gt;alert(1)&lt;/script&gt;'
+            '<a href="/p/test/">abs</a> <a href="#top">top</a></p>')
+
+    def test_make_absolute(self):
+        with mock.patch.dict(mde.config, {'base_url': 'http://localhost/', 'nofollow_exempt_domains': 'localhost'}):
+            out = mde.RelativeLinkRewriter(make_absolute=True).run('<a href="/p/test/">abs</a>')
+        self.assertEqual(out, '<a href="http://localhost/p/test/">abs</a>')
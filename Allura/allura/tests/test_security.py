@@ -15,8 +15,9 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from bson import ObjectId
 from pylons import tmpl_context as c
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_not_equal
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
@@ -190,3 +191,94 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_acl_decision_cache(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        user = M.User.by_username('test-user')
+        cred = Credentials.get()
+        cred.clear()
+        assert has_access(page, 'read', user)()
+        hits, misses = cred.acl_stats['hits'], cred.acl_stats['misses']
+        assert misses
+        assert has_access(page, 'read', user)()
+        assert_equal(cred.acl_stats['misses'], misses)
+        assert cred.acl_stats['hits'] > hits
+
+        # a changed ACL is compiled and checked again, parents included
+        wiki.acl.insert(0, M.ACE.deny(
+            M.ProjectRole.by_name('*anonymous')._id, 'read'))
+        wiki.acl.insert(0, M.ACE.deny(
+            M.ProjectRole.by_name('*authenticated')._id, 'read'))
+        assert not has_access(page, 'read', user)()
+        assert not has_access(wiki, 'read', user)()
+
+    def test_compiled_acl(self):
+        from allura.lib.security import CompiledACL
+        role1, role2 = ObjectId(), ObjectId()
+        acl = CompiledACL([
+            M.ACE.allow(role1, 'read'),
+            M.ACE.deny(role2, 'read'),
+            M.ACE.allow(role2, '*'),
+            M.DENY_ALL])
+        assert_equal(acl.access(role1, 'read'), M.ACE.ALLOW)
+        assert_equal(acl.access(role1, 'post'), M.ACE.DENY)
+        assert_equal(acl.access(role2, 'read'), M.ACE.DENY)
+        assert_equal(acl.access(role2, 'post'), M.ACE.ALLOW)
+        assert_equal(acl.denies, set([(role2, 'read'), (None, '*')]))
+        assert_equal(CompiledACL([]).access(role1, 'read'), None)
+
+    def test_compiled_acl_cache(self):
+        cred = Credentials.get()
+        cred.clear()
+        role = ObjectId()
+        acl = [M.ACE.allow(role, 'read')]
+        version, compiled = cred.compiled_acl(acl)
+        assert_equal(cred.compiled_acl(acl), (version, compiled))
+        # an equal but distinct acl is compiled on its own
+        assert_not_equal(cred.compiled_acl(list(acl))[0], version)
+        acl.append(M.DENY_ALL)
+        new_version, compiled = cred.compiled_acl(acl)
+        assert_not_equal(new_version, version)
+        assert_equal(compiled.access(role, 'post'), M.ACE.DENY)
+        # entries replaced in place are noticed too
+        acl[0] = M.ACE.deny(role, 'read')
+        version, compiled = cred.compiled_acl(acl)
+        assert_not_equal(version, new_version)
+        assert_equal(compiled.access(role, 'read'), M.ACE.DENY)
+
+    @td.with_wiki
+    def test_shared_role_cache(self):
+        from allura.lib.security import shared_role_cache
+        user = M.User.by_username('test-user')
+        project = c.project.root_project
+        shared = shared_role_cache()
+        Credentials.get().clear()
+        roles = Credentials.get().user_roles(user._id, project._id).reaching_ids
+        hits = shared.stats()['hits']
+
+        # a new request doesn't need to query the roles again
+        cred = Credentials()
+        assert_equal(cred.user_roles(user._id, project._id).reaching_ids, roles)
+        assert shared.stats()['hits'] > hits
+
+        # until they change
+        stamp = cred.role_stamp(project._id)
+        dev = M.ProjectRole.by_name('Developer')
+        _add_to_group(user, dev)
+        cred = Credentials()
+        assert cred.role_stamp(project._id) != stamp
+        assert dev._id in cred.user_roles(user._id, project._id).reaching_ids
+
+    @td.with_wiki
+    def test_role_stamp_survives_stale_project_save(self):
+        user = M.User.by_username('test-user')
+        # the project is loaded before its roles change, as in another process
+        project = c.project.root_project
+        _add_to_group(user, M.ProjectRole.by_name('Developer'))
+        stamp = Credentials().role_stamp(project._id)
+        assert stamp is not None
+        project.short_description = u'saved after the roles changed'
+        ThreadLocalODMSession.flush_all()
+        assert_equal(Credentials().role_stamp(project._id), stamp)
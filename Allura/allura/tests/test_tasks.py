@@ -18,6 +18,7 @@
 #       under the License.
 
 import operator
+import hashlib
 import shutil
 import sys
 import unittest
@@ -29,7 +30,7 @@
 from pylons import tmpl_context as c, app_globals as g
 from datadiff.tools import assert_equal
 from nose.tools import assert_in
-from ming.orm import FieldProperty, Mapper
+from ming.orm import FieldProperty, Mapper, session
 from ming.orm import ThreadLocalORMSession
 from testfixtures import LogCapture
 
@@ -163,6 +164,9 @@ def test_add_artifacts(self):
                 5 == new_shortlinks, 'Shortlinks not created'
             assert old_solr_size + \
                 5 == new_solr_size, "Solr additions didn't happen"
+            # each chunk is dropped from the identity map once it's sent
+            assert all(session(r) is None for r in arefs)
+            assert all(session(a) is None for a in artifacts)
             M.main_orm_session.flush()
             M.main_orm_session.clear()
             t3 = _TestArtifact.query.get(_shorthand_id='t3')
@@ -170,6 +174,57 @@ def test_add_artifacts(self):
             assert_equal(find_slinks.call_args_list,
                          [mock.call(a.index().get('text')) for a in artifacts])
 
+    @td.with_wiki
+    def test_render_markdown(self):
+        from forgewiki import model as WM
+        with h.push_context('test', 'wiki', neighborhood='Projects'):
+            page = WM.Page.upsert(title='Render me')
+            page.text = u'**bold**'
+            page.commit()
+            ThreadLocalORMSession.flush_all()
+        assert_equal(page.text_cache.html, None)
+        index_tasks.render_markdown([page.index_id()])
+        ThreadLocalORMSession.close_all()
+        page = WM.Page.query.get(_id=page._id)
+        assert_in('<strong>bold</strong>', page.text_cache.html)
+        assert_equal(page.text_cache.md5, hashlib.md5(u'**bold**').hexdigest())
+        # a valid cache isn't rendered again
+        with mock.patch('allura.lib.app_globals.ForgeMarkdown.convert') as convert:
+            index_tasks.render_markdown([page.index_id()])
+        assert_equal(convert.call_count, 0)
+
+    @td.with_wiki
+    def test_render_markdown_after_edit(self):
+        from forgewiki import model as WM
+        task_name = 'allura.tasks.index_tasks.render_markdown'
+        with h.push_config(tg.config, **{'markdown_cache.prerender': 'true'}), \
+                h.push_context('test', 'wiki', neighborhood='Projects'):
+            page = WM.Page.upsert(title='Render me')
+            page.text = u'**bold**'
+            page.commit()
+            ThreadLocalORMSession.flush_all()
+            task = M.MonQTask.query.get(task_name=task_name, state='ready')
+            assert task is not None
+            assert_equal(task.args[0], [page.index_id()])
+            M.MonQTask.query.remove({})
+            # changes to anything but the markdown don't render it again
+            page.labels = ['foo']
+            ThreadLocalORMSession.flush_all()
+            assert_equal(M.MonQTask.query.find(dict(task_name=task_name)).count(), 0)
+
+    @td.with_wiki
+    @mock.patch('allura.model.session._markdown_changed')
+    def test_render_markdown_after_edit_disabled(self, markdown_changed):
+        from forgewiki import model as WM
+        with h.push_config(tg.config, **{'markdown_cache.prerender': 'false'}), \
+                h.push_context('test', 'wiki', neighborhood='Projects'):
+            page = WM.Page.upsert(title='Render me')
+            page.text = u'**bold**'
+            page.commit()
+            ThreadLocalORMSession.flush_all()
+        # flushed objects aren't even checked
+        assert_equal(markdown_changed.call_count, 0)
+
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
     def test_del_artifacts(self, solr):
@@ -180,15 +235,17 @@ def test_del_artifacts(self, solr):
         arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
         ref_ids = [r._id for r in arefs]
         M.artifact_orm_session.flush()
+        added = []
+        solr.add_pipelined.side_effect = lambda chunks: [added.extend(c) for c in chunks]
         index_tasks.add_artifacts(ref_ids)
         M.main_orm_session.flush()
         M.main_orm_session.clear()
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks + 5 == new_shortlinks, 'Shortlinks not created'
-        assert solr.add.call_count == 1
+        assert solr.add_pipelined.call_count == 1
         sort_key = operator.itemgetter('id')
         assert_equal(
-            sorted(solr.add.call_args[0][0], key=sort_key),
+            sorted(added, key=sort_key),
             sorted([ref.artifact.solarize() for ref in arefs],
                    key=sort_key))
         index_tasks.del_artifacts(ref_ids)
@@ -210,6 +267,31 @@ def setUp(self):
     # since usage is generally through the task, and not using mail_util
     # directly
 
+    def test_sendmail_batch(self):
+        c.user = M.User.by_username('test-admin')
+        messages = [dict(
+            fromaddr=str(c.user._id),
+            destinations=[str(c.user._id)],
+            text=u'Message %d' % i,
+            reply_to=g.noreply,
+            subject=u'Subject %d' % i,
+            message_id=h.gen_message_id()) for i in range(3)]
+
+        def sendmail(addrs, fromaddr, reply_to, subject, *args, **kw):
+            if subject == u'Subject 0':
+                raise IOError('connection reset')
+        client = mock.Mock()
+        client.sendmail.side_effect = sendmail
+        with mock.patch.object(mail_tasks, '_thread_smtp_client', return_value=client):
+            mail_tasks.sendmail_batch(messages)
+        # one call per email format; the failed message stops after its first
+        assert_equal(client.sendmail.call_count, 7)
+        subjects = sorted(set(args[3] for args, kw in client.sendmail.call_args_list))
+        assert_equal(subjects, [u'Subject 0', u'Subject 1', u'Subject 2'])
+        for args, kw in client.sendmail.call_args_list:
+            if args[0]:
+                assert_equal(args[0], [c.user.get_pref('email_address')])
+
     def test_send_email_ascii_with_user_lookup(self):
         c.user = M.User.by_username('test-admin')
         with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
@@ -21,12 +21,13 @@
 import time
 import unittest
 import datetime as dt
+import pymongo
 from ming.odm import session
 from os import path
 
 from bson import ObjectId
 from webob import Request
-from mock import Mock, patch
+from mock import Mock, patch, call
 from nose.tools import (
     assert_equal,
     assert_not_equal,
@@ -102,6 +103,35 @@ def test_chunked_list(self):
         self.assertEqual([el for sublist in chunks for el in sublist], l)
 
 
+class TestPostTaskSplit(unittest.TestCase):
+
+    def _too_large(self, items):
+        if len(items) > 1 or items == ['huge']:
+            raise pymongo.errors.InvalidDocument(
+                'BSON document too large (16906035 bytes)')
+
+    def test_splits_until_small_enough(self):
+        task = Mock()
+        task.post.side_effect = self._too_large
+        utils.post_task_split(task, range(3))
+        self.assertEqual(task.post.call_args_list, [
+            call(range(3)), call([0]), call([1, 2]), call([1]), call([2])])
+
+    def test_single_item_too_large(self):
+        task = Mock()
+        task.post.side_effect = self._too_large
+        with assert_raises(pymongo.errors.InvalidDocument):
+            utils.post_task_split(task, ['huge'])
+        self.assertEqual(task.post.call_count, 1)
+
+    def test_other_error(self):
+        task = Mock()
+        task.post.side_effect = pymongo.errors.InvalidDocument('key must be a string')
+        with assert_raises(pymongo.errors.InvalidDocument):
+            utils.post_task_split(task, range(3))
+        self.assertEqual(task.post.call_count, 1)
+
+
 class TestAntispam(unittest.TestCase):
 
     def setUp(self):
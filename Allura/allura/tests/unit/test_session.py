@@ -138,7 +138,8 @@ def test_flush_skips_update(self, index_tasks, ref_fa, shortlink_fa):
         ref_fa.side_effect = lambda obj: mock.Mock(_id=obj._id)
         self.extension.objects_modified = modified
         self.extension.after_flush()
-        index_tasks.add_artifacts.post.assert_called_once_with([0, 2, 3])
+        index_tasks.add_artifacts.post.assert_called_once_with(
+            [0, 2, 3], coalesce_key='session')
 
     @mock.patch('allura.model.session.index_tasks')
     def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
@@ -26,6 +26,7 @@
 from alluratest.controller import setup_basic_test
 from allura.lib.solr import Solr, escape_solr_arg
 from allura.lib.search import search_app, SearchIndexable
+from allura.lib.search import solr_field_hashes, changed_solr_fields
 
 
 class TestSolr(unittest.TestCase):
@@ -58,6 +59,26 @@ def test_add(self, pysolr):
                            commitWithin='10000', somekw='value')] * 2
         pysolr.Solr().add.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_pipelined(self, pysolr):
+        servers = ['server1', 'server2']
+        solr = Solr(servers, commit=False, commitWithin='10000')
+        on_done = mock.Mock()
+        solr.add_pipelined(iter([['a'], [], ['b', 'c']]), on_done=on_done)
+        calls = [mock.call(['a'], commit=False, commitWithin='10000'),
+                 mock.call(['b', 'c'], commit=False, commitWithin='10000')]
+        # one thread per server, so calls from the two may interleave
+        assert_equal(sorted(pysolr.Solr().add.call_args_list), sorted(calls * 2))
+        assert_equal(on_done.call_args_list[-1], mock.call(2))
+
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_pipelined_error(self, pysolr):
+        solr = Solr(['server1'])
+        pysolr.Solr().add.side_effect = ValueError('down')
+        with td.raises(ValueError):
+            solr.add_pipelined(iter([['a'], ['b']]))
+        assert_equal(pysolr.Solr().add.call_count, 1)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_delete(self, pysolr):
         servers = ['server1', 'server2']
@@ -140,6 +161,44 @@ def test_solarize_html_in_text(self):
         self.obj.index = lambda: dict(text='&lt;script&gt;a(1)&lt;/script&gt;')
         assert_equal(self.obj.solarize(), dict(text='<script>a(1)</script>'))
 
+    @mock.patch('allura.lib.search.g')
+    def test_solarize_uses_markdown_cache(self, g):
+        self.obj.text = '# Header'
+        self.obj.text_cache = mock.Mock()
+        self.obj.index = lambda: dict(text=self.obj.text)
+        g.markdown.get_cached.return_value = Markup('<h1>Cached</h1>')
+        assert_equal(self.obj.solarize(), dict(text='Cached'))
+        g.markdown.get_cached.assert_called_once_with(self.obj, 'text')
+        assert not g.markdown.convert.called
+
+        g.markdown.get_cached.return_value = None
+        g.markdown.convert.return_value = '<h1>Header</h1>'
+        assert_equal(self.obj.solarize(), dict(text='Header'))
+        g.markdown.convert.assert_called_once_with('# Header')
+
+
+def test_changed_solr_fields():
+    old = dict(id='a', text='long text', status_s='open', milestone_s='1.0',
+               labels_t='x')
+    old_hashes = solr_field_hashes(old)
+    assert 'id' not in old_hashes
+
+    new = dict(old, status_s='closed', milestone_s='2.0')
+    assert_equal(sorted(changed_solr_fields(old_hashes, solr_field_hashes(new), new)),
+                 ['milestone_s', 'status_s'])
+    assert_equal(changed_solr_fields(old_hashes, old_hashes, old), [])
+    # no previous hashes, changed text, fields added/removed or emptied
+    assert_equal(changed_solr_fields(None, old_hashes, old), None)
+    new = dict(old, text='other text')
+    assert_equal(changed_solr_fields(old_hashes, solr_field_hashes(new), new), None)
+    new = dict(old, votes_i=1)
+    assert_equal(changed_solr_fields(old_hashes, solr_field_hashes(new), new), None)
+    new = dict(old, labels_t='')
+    assert_equal(changed_solr_fields(old_hashes, solr_field_hashes(new), new), None)
+    # copyField sources can't be updated atomically
+    new = dict(old, labels_t='x y')
+    assert_equal(changed_solr_fields(old_hashes, solr_field_hashes(new), new), None)
+
 
 class TestSearch_app(unittest.TestCase):
 
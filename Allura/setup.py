@@ -147,6 +147,7 @@
     create-trove-categories = allura.command:CreateTroveCategoriesCommand
     set-neighborhood-features = allura.command:SetNeighborhoodFeaturesCommand
     reclone-repo = allura.command.reclone_repo:RecloneRepoCommand
+    render-markdown = allura.command.render_markdown:RenderMarkdownCommand
 
     [easy_widgets.resources]
     ew_resources=allura.config.resources:register_ew_resources
@@ -397,10 +397,12 @@ def _check_security(self):
         require_access(self.forum, 'read')
 
     @expose('json:')
-    def index(self, limit=None, page=0, **kw):
+    def index(self, limit=None, page=0, after=None, **kw):
         limit, page, start = g.handle_paging(limit, int(page))
+        after = self.topic.parse_posts_cursor(after)
         json_data = {}
-        json_data['topic'] = self.topic.__json__(limit=limit, page=page)
+        json_data['topic'] = self.topic.__json__(
+            limit=limit, page=page, after=after)
         json_data['count'] = self.topic.query_posts(status='ok').count()
         json_data['page'] = page
         json_data['limit'] = limit
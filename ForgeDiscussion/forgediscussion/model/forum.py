@@ -186,7 +186,6 @@ def post(self, subject, text, message_id=None, parent_id=None, **kw):
             text, message_id=message_id, parent_id=parent_id, **kw)
         if not self.first_post_id:
             self.first_post_id = post._id
-            self.num_replies = 1
         h.log_action(log, 'posted').info('')
         return post
 
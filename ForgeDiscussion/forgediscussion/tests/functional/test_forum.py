@@ -378,6 +378,24 @@ def test_forum_index(self):
         self.app.get('/discussion/testforum/')
         self.app.get('/discussion/testforum/childforum/')
 
+    def _post_pending_topic(self, subject):
+        r = self.app.get('/discussion/create_topic/')
+        f = r.html.find(
+            'form', {'action': '/p/test/discussion/save_new_topic'})
+        params = dict()
+        inputs = f.findAll('input')
+        for field in inputs:
+            if field.has_key('name'):  # nopep8 - beautifulsoup3 actually uses has_key
+                params[field['name']] = field.get('value') or ''
+        params[f.find('textarea')['name']] = '1st post in %s' % subject
+        params[f.find('select')['name']] = 'testforum'
+        params[f.find('input', {'style': 'width: 90%'})['name']] = subject
+        r = self.app.post('/discussion/save_new_topic', params=params,
+                          extra_environ=dict(username='*anonymous'),
+                          status=302)
+        assert r.location.startswith(
+            'http://localhost/p/test/discussion/testforum/thread/'), r.location
+
     def test_threads_with_zero_posts(self):
         # Make sure that threads with zero posts (b/c all posts have been
         # deleted or marked as spam) don't show in the UI.
@@ -387,24 +405,6 @@ def test_threads_with_zero_posts(self):
 
         self._set_anon_allowed()
 
-        def _post_pending():
-            r = self.app.get('/discussion/create_topic/')
-            f = r.html.find(
-                'form', {'action': '/p/test/discussion/save_new_topic'})
-            params = dict()
-            inputs = f.findAll('input')
-            for field in inputs:
-                if field.has_key('name'):  # nopep8 - beautifulsoup3 actually uses has_key
-                    params[field['name']] = field.get('value') or ''
-            params[f.find('textarea')['name']] = '1st post in Zero Posts thread'
-            params[f.find('select')['name']] = 'testforum'
-            params[f.find('input', {'style': 'width: 90%'})['name']] = 'Test Zero Posts'
-            r = self.app.post('/discussion/save_new_topic', params=params,
-                              extra_environ=dict(username='*anonymous'),
-                              status=302)
-            assert r.location.startswith(
-                'http://localhost/p/test/discussion/testforum/thread/'), r.location
-
         def _check():
             r = self.app.get('/discussion/')
             assert 'Test Zero Posts' not in r
@@ -412,7 +412,7 @@ def _check():
             assert 'Test Zero Posts' not in r
 
         # test posts marked as spam
-        _post_pending()
+        self._post_pending_topic('Test Zero Posts')
         r = self.app.get('/discussion/testforum/moderate?status=pending')
         post_id = r.html.find('input', {'name': 'post-0._id'})['value']
         r = self.app.post('/discussion/testforum/moderate/save_moderation', params={
@@ -422,7 +422,7 @@ def _check():
         _check()
 
         # test posts deleted
-        _post_pending()
+        self._post_pending_topic('Test Zero Posts')
         r = self.app.get('/discussion/testforum/moderate?status=pending')
         post_id = r.html.find('input', {'name': 'post-0._id'})['value']
         r = self.app.post('/discussion/testforum/moderate/save_moderation', params={
@@ -431,6 +431,30 @@ def _check():
             'delete': 'Delete Marked'})
         _check()
 
+    def test_moderated_topic_counters(self):
+        self._set_anon_allowed()
+
+        def _moderate(subject, action):
+            thread = FM.ForumThread.query.get(subject=subject)
+            assert_equal(thread.num_replies, 0)
+            self.app.post('/discussion/testforum/moderate/save_moderation', params={
+                'post-0._id': thread.first_post_id,
+                'post-0.checked': 'on',
+                action: action})
+            ThreadLocalORMSession.close_all()
+            return FM.ForumThread.query.get(subject=subject)
+
+        self._post_pending_topic('Approved topic')
+        thread = _moderate('Approved topic', 'approve')
+        assert_equal(thread.num_replies, 1)
+        forum = FM.Forum.query.get(shortname='testforum')
+        assert_equal(forum.num_topics, FM.ForumThread.query.find(
+            dict(discussion_id=forum._id)).count())
+
+        self._post_pending_topic('Spam topic')
+        thread = _moderate('Spam topic', 'spam')
+        assert_equal(thread.num_replies, 0)
+
     def test_user_filter(self):
         username = 'test_username1'
         r = self.app.get(
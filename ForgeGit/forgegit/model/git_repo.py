@@ -16,10 +16,14 @@
 #       under the License.
 
 import os
+import re
 import shutil
 import string
 import logging
 import tempfile
+import threading
+import subprocess
+import Queue
 from datetime import datetime
 from contextlib import contextmanager
 from time import time
@@ -29,13 +33,14 @@
 import gitdb
 from pylons import tmpl_context as c
 from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming.base import Object
 from ming.orm import Mapper, session
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
+from allura.lib.utils import chunked_list
 from allura.model.repository import topological_sort, prefix_paths_union
 from allura import model as M
 
@@ -255,20 +260,63 @@ def all_commit_ids(self):
     def new_commits(self, all_commits=False):
         graph = {}
 
+        # walk the graph a generation at a time, so that the commits already
+        # in mongo can be found with one query per generation
         to_visit = [self._git.commit(rev=hd.object_id) for hd in self.heads]
         while to_visit:
-            obj = to_visit.pop()
-            if obj.hexsha in graph:
-                continue
-            if not all_commits:
-                # Look up the object
-                if M.repository.Commit.query.find(dict(_id=obj.hexsha)).count():
-                    graph[obj.hexsha] = set()  # mark as parentless
+            generation = {}
+            for obj in to_visit:
+                if obj.hexsha not in graph:
+                    generation[obj.hexsha] = obj
+            if all_commits:
+                existing = set()
+            else:
+                existing = self._existing_commit_ids(generation.keys())
+            to_visit = []
+            for oid, obj in generation.iteritems():
+                if oid in existing:
+                    graph[oid] = set()  # mark as parentless
                     continue
-            graph[obj.hexsha] = set(p.hexsha for p in obj.parents)
-            to_visit += obj.parents
+                graph[oid] = set(p.hexsha for p in obj.parents)
+                to_visit += obj.parents
         return list(topological_sort(graph))
 
+    def _existing_commit_ids(self, oids):
+        '''Return the subset of `oids` that are already saved as commits'''
+        from allura.model.repository import CommitDoc
+        existing = set()
+        for chunk in chunked_list(list(oids), M.repository.QSIZE):
+            existing.update(ci['_id'] for ci in CommitDoc.m.collection.find(
+                {'_id': {'$in': chunk}}, fields=['_id']))
+        return existing
+
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        '''Bulk version of :meth:`refresh_commit_info`.
+
+        Commit and tree objects are read and parsed from a single
+        ``git cat-file --batch`` process in a background thread, while the
+        resulting docs are written to mongo in batches, one insert per
+        batch.  Set ``scm.git.bulk_refresh = false`` to refresh one commit
+        at a time instead.
+        '''
+        if not asbool(tg.config.get('scm.git.bulk_refresh', True)):
+            return super(GitImplementation, self).refresh_commits_info(oids, seen, lazy)
+        from allura.model.repository import CommitDoc, TreeDoc
+        if lazy:
+            # same as refresh_commit_info: don't touch existing commits
+            oids = list(oids)
+            existing = self._existing_commit_ids(oids)
+            oids = [oid for oid in oids if oid not in existing]
+        batch_size = asint(tg.config.get('scm.git.bulk_refresh_batch', 500))
+        count = 0
+        for commit_docs, tree_docs in _pipelined(
+                _bulk_commit_docs(self._repo.full_fs_path, oids, seen, lazy, batch_size)):
+            # trees first, so a commit is never saved without its trees
+            _bulk_save(TreeDoc.m.collection, tree_docs, lazy)
+            _bulk_save(CommitDoc.m.collection, commit_docs, lazy)
+            count += len(commit_docs)
+            log.info('Refresh commit info %d: %s', count, commit_docs[-1]['_id'])
+
     def refresh_commit_info(self, oid, seen, lazy=True):
         from allura.model.repository import CommitDoc
         ci_doc = CommitDoc.m.get(_id=oid)
@@ -618,6 +666,50 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def last_commit_ids(self, commit, paths):
+        '''
+        Return a mapping {path: commit_id} of the _id of the last
+        commit to touch each path, starting from the given commit.
+
+        Reads a single ``git log --name-only`` stream limited to `paths`,
+        assigning each commit to the remaining paths it changed, and stops
+        as soon as every path has been found.
+        '''
+        if not paths:
+            return {}
+
+        def get_ids(result, deadline):
+            remaining = set(paths)
+            proc = self._git.git.log(
+                commit._id, '--', *[p.encode('utf-8') for p in remaining],
+                pretty='format:%x01%H',
+                name_only=True,
+                z=True,
+                as_process=True)
+            # a stalled git would block the read below past the deadline and
+            # hold its lcd pool thread, so kill it once the deadline passes
+            watchdog = threading.Timer(max(deadline - time(), 0), _kill, [proc])
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                for commit_id, changes in _iter_name_only_log(proc.stdout):
+                    if time() >= deadline:
+                        log.error('last_commit_ids timeout for %s on %s',
+                                  commit._id, ', '.join(remaining))
+                        break
+                    # merge commits list no files, so they never match
+                    changed = prefix_paths_union(remaining, changes)
+                    for path in changed:
+                        result[path] = commit_id
+                    remaining -= changed
+                    if not remaining:
+                        break
+            finally:
+                watchdog.cancel()
+                _kill(proc)
+                proc.wait()
+        return M.repository.run_lcd_job(get_ids)
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
@@ -759,6 +851,230 @@ def merge_request_commits(self, mr):
                 id_only=False))
 
 
+class GitCatFile(object):
+
+    '''Reads raw objects from a repository through one long-running
+    ``git cat-file --batch`` process, instead of one git command per object'''
+
+    def __init__(self, path):
+        self.proc = subprocess.Popen(
+            [git.Git.GIT_PYTHON_GIT_EXECUTABLE, 'cat-file', '--batch'],
+            cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def get(self, oid):
+        '''Return (type, data) for object `oid`'''
+        self.proc.stdin.write(oid + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(oid)
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)  # trailing newline
+        return header[1], data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+_signature_re = re.compile(r'^(.*) <(.*?)> (-?\d+)')
+_signature_only_email_re = re.compile(r'^<(.*?)> (-?\d+)')
+
+
+def _parse_signature(value):
+    m = _signature_re.match(value)
+    if m:
+        name, email, timestamp = m.groups()
+    else:
+        # same as GitPython does for a missing name
+        m = _signature_only_email_re.match(value)
+        if m:
+            name, timestamp = m.groups()
+        else:
+            log.warning('Could not parse commit signature %r', value)
+            name, timestamp = '', 0
+        email = ''
+    return Object(
+        name=h.really_unicode(name),
+        email=h.really_unicode(email),
+        date=datetime.utcfromtimestamp(int(timestamp)))
+
+
+def parse_commit(data):
+    '''Parse a raw git commit object into the fields of a CommitDoc'''
+    headers, _, message = data.partition('\n\n')
+    doc = dict(parent_ids=[], child_ids=[])
+    encoding = None
+    for line in headers.split('\n'):
+        if line.startswith(' '):
+            continue  # continuation of a multi-line header, like gpgsig
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            doc['tree_id'] = value
+        elif key == 'parent':
+            doc['parent_ids'].append(value)
+        elif key == 'author':
+            doc['authored'] = _parse_signature(value)
+        elif key == 'committer':
+            doc['committed'] = _parse_signature(value)
+        elif key == 'encoding':
+            encoding = value
+    if encoding:
+        try:
+            message = message.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            pass
+    doc['message'] = h.really_unicode(message)
+    return doc
+
+
+def parse_tree(data):
+    '''Parse a raw git tree object into a list of (type, name, hexsha)'''
+    entries = []
+    i = 0
+    while i < len(data):
+        space = data.index(' ', i)
+        nul = data.index('\0', space)
+        mode = data[i:space]
+        if mode == '40000':
+            type = 'tree'
+        elif mode == '160000':
+            type = 'submodule'
+        else:
+            type = 'blob'
+        entries.append((type, data[space + 1:nul], data[nul + 1:nul + 21].encode('hex')))
+        i = nul + 21
+    return entries
+
+
+def _kill(proc):
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:  # already exited
+            pass
+
+
+def _iter_name_only_log(stream, chunk_size=4096):
+    '''Yield (commit_id, set of changed paths) from the output of
+    ``git log --name-only -z --pretty=format:%x01%H``'''
+    buffer = ''
+    while True:
+        chars = stream.read(chunk_size)
+        buffer += chars
+        records = buffer.split('\x01')
+        # the last record may be incomplete, until the stream ends
+        buffer = records.pop() if chars else ''
+        for record in records:
+            if not record:
+                continue
+            commit_id, _, names = record.partition('\n')
+            yield commit_id.strip('\0'), set(
+                h.really_unicode(name) for name in names.split('\0') if name)
+        if not chars:
+            break
+
+
+def _bulk_commit_docs(path, oids, seen, lazy, batch_size):
+    '''Yield batches of (commit docs, tree docs) for commits `oids`'''
+    cat_file = GitCatFile(path)
+    try:
+        commit_docs, tree_docs = [], []
+        for oid in oids:
+            type, data = cat_file.get(oid)
+            commit = parse_commit(data)
+            commit['_id'] = oid
+            commit_docs.append(commit)
+            to_visit = [commit['tree_id']]
+            while to_visit:
+                tree_id = to_visit.pop()
+                if lazy and tree_id in seen:
+                    continue
+                seen.add(tree_id)
+                doc = dict(_id=tree_id, tree_ids=[], blob_ids=[], other_ids=[])
+                for type, name, entry_id in parse_tree(cat_file.get(tree_id)[1]):
+                    if type == 'submodule':
+                        continue
+                    entry = dict(name=h.really_unicode(name), id=entry_id)
+                    if type == 'tree':
+                        to_visit.append(entry_id)
+                        doc['tree_ids'].append(entry)
+                    else:
+                        doc['blob_ids'].append(entry)
+                tree_docs.append(doc)
+            if len(commit_docs) + len(tree_docs) >= batch_size:
+                yield commit_docs, tree_docs
+                commit_docs, tree_docs = [], []
+        if commit_docs or tree_docs:
+            yield commit_docs, tree_docs
+    finally:
+        cat_file.close()
+
+
+def _pipelined(iterable, maxsize=4):
+    '''Run `iterable` in a background thread, buffering up to `maxsize` items
+    ahead of the consumer'''
+    queue = Queue.Queue(maxsize=maxsize)
+    done = object()
+    error = []
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                queue.put(item)
+        except Exception:
+            log.exception('Error reading git objects')
+            error.append(True)
+        finally:
+            queue.put(done)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        # unblock the producer if it's waiting on a full queue
+        while producer.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+    if error:
+        raise RuntimeError('Error reading git objects, see log')
+
+
+def _bulk_save(collection, docs, lazy):
+    '''Write `docs` to `collection`.  If `lazy`, all docs go out in a single
+    insert and already existing docs are left alone, else each one is
+    upserted (keeping its repo_ids)'''
+    if not docs:
+        return
+    if lazy:
+        docs = [dict(doc, repo_ids=[]) if 'parent_ids' in doc else doc
+                for doc in docs]
+        try:
+            collection.insert(docs, continue_on_error=True)
+        except DuplicateKeyError:
+            # another refresh got to some of these first, which is fine
+            pass
+        return
+    for doc in docs:
+        fields = dict((k, v) for k, v in doc.iteritems() if k != '_id')
+        update = {'$set': fields}
+        if 'parent_ids' in doc:
+            update['$setOnInsert'] = {'repo_ids': []}
+        collection.update({'_id': doc['_id']}, update, upsert=True)
+
+
 class _OpenedGitBlob(object):
     CHUNK_SIZE = 4096
 
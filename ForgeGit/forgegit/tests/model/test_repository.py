@@ -372,6 +372,41 @@ def test_commit(self):
         self.assertEqual(new_tree.blob_ids, orig_tree.blob_ids)
         self.assertEqual(new_tree.other_ids, orig_tree.other_ids)
 
+    def test_refresh_commits_info_bulk(self):
+        # bulk refresh (used in setUp) and per-commit refresh agree
+        commit_ids = list(self.repo.all_commit_ids())
+        bulk_commits = dict((ci._id, ci) for ci in M.repository.CommitDoc.m.find())
+        bulk_trees = dict((t._id, t) for t in M.repository.TreeDoc.m.find())
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.git.bulk_refresh': 'false'}):
+            self.repo.refresh_commits_info(commit_ids, set())
+        commits = dict((ci._id, ci) for ci in M.repository.CommitDoc.m.find())
+        trees = dict((t._id, t) for t in M.repository.TreeDoc.m.find())
+        assert_equal(sorted(commits), sorted(bulk_commits))
+        assert_equal(sorted(trees), sorted(bulk_trees))
+        for oid, ci in commits.iteritems():
+            for field in ('tree_id', 'committed', 'authored', 'message', 'parent_ids'):
+                assert_equal(ci[field], bulk_commits[oid][field])
+        for oid, tree in trees.iteritems():
+            assert_equal(tree.tree_ids, bulk_trees[oid].tree_ids)
+            assert_equal(tree.blob_ids, bulk_trees[oid].blob_ids)
+
+    def test_new_commits(self):
+        all_commits = self.repo._impl.new_commits(all_commits=True)
+        assert_equal(sorted(all_commits), sorted(self.repo.all_commit_ids()))
+        assert_equal(self.repo._impl.new_commits(), [])
+        # forget the newest commits: only they are new, and the walk stops
+        # at the first commit already saved
+        head = '1e146e67985dcd71c74de79613719bef7bddca4a'
+        M.repository.CommitDoc.m.remove({'_id': head})
+        with mock.patch.object(self.repo._impl, '_existing_commit_ids',
+                               wraps=self.repo._impl._existing_commit_ids) as existing:
+            new = self.repo._impl.new_commits()
+        assert_in(head, new)
+        assert_less(len(new), len(all_commits))
+        assert_less(existing.call_count, len(all_commits))
+
     def test_refresh(self):
         # test results of things that ran during setUp
         notification = M.Notification.query.find({'subject': '[test:src-git] 5 new commits to Git'}).first()
@@ -944,6 +979,22 @@ def test_cached_tags(self):
             assert_equal(rev.cached_tags, tags)
 
 
+class TestParseCommit(unittest.TestCase):
+
+    def test_malformed_signature(self):
+        doc = GM.git_repo.parse_commit(
+            'tree abc\n'
+            'author Jon <jon@example.com> 1400000000 +0000\n'
+            'committer garbage\n'
+            '\n'
+            'msg\n')
+        self.assertEqual(doc['authored'].name, 'Jon')
+        self.assertEqual(doc['authored'].email, 'jon@example.com')
+        self.assertEqual(doc['committed'].name, '')
+        self.assertEqual(doc['committed'].email, '')
+        self.assertEqual(doc['committed'].date, datetime.datetime.utcfromtimestamp(0))
+
+
 class TestGitImplementation(unittest.TestCase):
 
     def test_branches(self):
@@ -986,13 +1037,19 @@ def test_last_commit_ids(self):
             'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
         })
 
-    def test_last_commit_ids_threaded(self):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1):
-            self.test_last_commit_ids()
+    def test_last_commit_ids_single_log(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        with mock.patch.object(impl._git.git, 'log', wraps=impl._git.git.log) as git_log:
+            impl.last_commit_ids(
+                mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt'])
+        assert_equal(git_log.call_count, 1)
 
     @mock.patch('forgegit.model.git_repo.GitImplementation._git', new_callable=mock.PropertyMock)
     def test_last_commit_ids_threaded_error(self, _git):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_timeout=2):
+        with h.push_config(tg.config, lcd_timeout=2):
             repo_dir = pkg_resources.resource_filename(
                 'forgegit', 'tests/data/testrename.git')
             repo = mock.Mock(full_fs_path=repo_dir)
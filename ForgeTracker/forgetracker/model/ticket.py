@@ -20,19 +20,22 @@
 import json
 import difflib
 from datetime import datetime, timedelta
+from collections import defaultdict
 from bson import ObjectId
 import os
+import time
+from threading import Lock
 
 import pymongo
-from pymongo.errors import OperationFailure
+from pymongo.errors import OperationFailure, DuplicateKeyError
 from pylons import tmpl_context as c, app_globals as g
 from pprint import pformat
-from paste.deploy.converters import aslist, asbool
+from paste.deploy.converters import aslist, asbool, asint
 import jinja2
 
 from ming import schema
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, MapperExtension, session
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -63,7 +66,7 @@
 )
 from allura.model.timeline import ActivityObject
 from allura.model.notification import MailFooter
-from allura.model.types import MarkdownCache, EVERYONE
+from allura.model.types import MarkdownCache, EVERYONE, ALL_PERMISSIONS
 
 from allura.lib import security
 from allura.lib.search import search_artifact, SearchError
@@ -85,7 +88,45 @@ def get_default_for_solr_type(solr_type):
 
 config = utils.ConfigProxy(
     common_suffix='forgemail.domain',
-    new_solr='solr.use_new_types')
+    new_solr='solr.use_new_types',
+    user_bin_counts_ttl='forgetracker.user_bin_counts_ttl',
+    bin_counts_debounce='forgetracker.bin_counts_debounce',
+    bin_counts_max_delay='forgetracker.bin_counts_max_delay')
+
+
+class UserBinCounts(object):
+
+    '''Per-process cache of the hits of $USER bins, which can't be counted
+    once for everybody.  Entries expire after their ttl, or when the counts
+    of their tracker are invalidated.'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._data = {}  # (app_config_id, user_id, summary) -> (hits, expire)
+
+    def get(self, key):
+        with self._lock:
+            hits, expire = self._data.get(key, (None, None))
+            if expire is not None and expire <= time.time():
+                del self._data[key]
+                return None
+            return hits
+
+    def set(self, key, hits, ttl):
+        now = time.time()
+        with self._lock:
+            if len(self._data) > 10000:
+                for k, (_, expire) in self._data.items():
+                    if expire <= now:
+                        del self._data[k]
+            self._data[key] = (hits, now + ttl)
+
+    def invalidate(self, app_config_id):
+        with self._lock:
+            for k in [k for k in self._data if k[0] == app_config_id]:
+                del self._data[k]
+
+user_bin_counts = UserBinCounts()
 
 
 class Globals(MappedClass):
@@ -107,12 +148,17 @@ class __mongometa__:
     milestone_names = FieldProperty(str, if_missing='')
     custom_fields = FieldProperty([{str: None}])
     _bin_counts = FieldProperty(schema.Deprecated)  # {str:int})
-    _bin_counts_data = FieldProperty([dict(summary=str, hits=int)])
+    _bin_counts_data = FieldProperty(
+        [dict(summary=str, hits=int, user_terms=str)])
     _bin_counts_expire = FieldProperty(datetime)
     _bin_counts_invalidated = FieldProperty(datetime)
+    _bin_counts_edited = FieldProperty(datetime)
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
     _milestone_counts_expire = FieldProperty(schema.Deprecated)  # datetime)
+    # whether the MilestoneCount docs for this tracker are up to date
+    _milestone_counts_built = FieldProperty(bool, if_missing=False)
+    _milestone_counts_invalidated = FieldProperty(datetime, if_missing=None)
     show_in_search = FieldProperty({str: bool}, if_missing={'ticket_num': True,
                                                             'summary': True,
                                                             '_milestone': True,
@@ -186,20 +232,32 @@ def get_custom_field_solr_type(self, field_name):
         return None
 
     def update_bin_counts(self):
-        # Refresh bin counts
+        # Refresh bin counts, with a single facet.query per saved search
         self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
+        bins = Bin.query.find(dict(app_config_id=self.app_config_id)).all()
+        queries = {}
+        for i, b in enumerate(bins):
             if b.terms and '$USER' in b.terms:
-                # skip queries with $USER variable, hits will be inconsistent
-                # for them
+                # hits differ for each user, so they're counted on demand
+                # (see user_bin_count)
                 continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+            if b.terms:
+                queries['bin%d' % i] = b.terms
+        counts = {}
+        if queries:
+            r = search_artifact(Ticket, '*:*', rows=0, short_timeout=False,
+                                facet_queries=queries)
+            if r is not None:
+                counts = r.facets.get('facet_queries', {})
+        for i, b in enumerate(bins):
+            d = dict(summary=b.summary, hits=counts.get('bin%d' % i, 0))
+            if b.terms and '$USER' in b.terms:
+                d['user_terms'] = b.terms
+            self._bin_counts_data.append(d)
         self._bin_counts_expire = \
             datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
+        user_bin_counts.invalidate(self.app_config_id)
 
     def bin_count(self, name):
         # not sure why we expire bin counts after an hour even if unchanged
@@ -208,32 +266,192 @@ def bin_count(self, name):
             self.invalidate_bin_counts()
         for d in self._bin_counts_data:
             if d['summary'] == name:
+                if d.get('user_terms'):
+                    return self.user_bin_count(d)
                 return d
         return dict(summary=name, hits=0)
 
+    def user_bin_count(self, d):
+        '''Count the hits of a bin whose terms use $USER for the current
+        user.  Counts are cached per process for
+        ``forgetracker.user_bin_counts_ttl`` seconds.'''
+        if c.user is None or c.user.is_anonymous():
+            return dict(summary=d['summary'], hits=0)
+        key = (self.app_config_id, c.user._id, d['summary'])
+        hits = user_bin_counts.get(key)
+        if hits is None:
+            try:
+                r = search_artifact(Ticket, d['user_terms'], rows=0,
+                                    short_timeout=True)
+            except SearchError:
+                log.info('Ticket bin %s search failed for user %s',
+                         d['summary'], c.user.username, exc_info=True)
+                return dict(summary=d['summary'], hits=0)
+            hits = r is not None and r.hits or 0
+            ttl = asint(config.get('user_bin_counts_ttl', 300))
+            user_bin_counts.set(key, hits, ttl)
+        return dict(summary=d['summary'], hits=hits)
+
     def milestone_count(self, name):
         fld_name, m_name = name.split(':', 1)
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {
-            'custom_fields.%s' % fld_name: m_name,
-            'app_config_id': self.app_config_id,
-            'deleted': False
-        }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
-        secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
-        if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
-            d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
-        return d
+        return self.milestone_counts(fld_name, m_name).get(name, d)
+
+    def milestone_counts(self, fld_name=None, m_name=None):
+        '''Return {'field:milestone': dict(name, hits, closed)} counting the
+        tickets the current user can read, for every milestone or just the
+        given field and/or milestone.
+
+        Public tickets are counted from the :class:`MilestoneCount` docs;
+        only private tickets are checked for access here.
+        '''
+        counts = {}
+        if self._milestone_counts_built:
+            query = dict(app_config_id=self.app_config_id)
+            if fld_name:
+                query['field'] = fld_name
+            if m_name:
+                query['milestone'] = m_name
+            # read the docs directly, since ORM instances of them may be stale
+            for mc in MilestoneCount.collection().find(query):
+                name = '%s:%s' % (mc['field'], mc['milestone'])
+                counts[name] = dict(name=name, hits=mc['hits'], closed=mc['closed'])
+        else:
+            # count them here until the task has rebuilt the docs
+            self.invalidate_milestone_counts()
+            for (f, m), d in self._count_public_milestones().iteritems():
+                if fld_name in (None, f) and m_name in (None, m):
+                    name = '%s:%s' % (f, m)
+                    counts[name] = dict(name=name, **d)
+
+        fields = [fld.name for fld in self.milestone_fields
+                  if fld_name in (None, fld.name)]
+        if not fields:
+            return counts
+        secured_query = dict(
+            app_config_id=self.app_config_id,
+            deleted=False,
+            acl={'$ne': []})
+        secured_query['$or'] = [
+            {'custom_fields.%s' % f: m_name or {'$nin': [None, '']}}
+            for f in fields]
+        closed_names = self.set_of_closed_status_names
+        for t in Ticket.query.find(secured_query):
+            if not security.has_access(t, 'read'):
+                continue
+            for f in fields:
+                m = t.custom_fields.get(f)
+                if not m or (m_name and m != m_name):
+                    continue
+                name = '%s:%s' % (f, m)
+                d = counts.setdefault(name, dict(name=name, hits=0, closed=0))
+                d['hits'] += 1
+                if t.status in closed_names:
+                    d['closed'] += 1
+        return counts
+
+    def _count_public_milestones(self):
+        '''Return {(field, milestone): dict(hits, closed)} for the public
+        tickets, with one pass over this tracker's tickets'''
+        fields = [fld.name for fld in self.milestone_fields]
+        closed_names = self.set_of_closed_status_names
+        counts = defaultdict(lambda: dict(hits=0, closed=0))
+        if fields:
+            tickets = session(Ticket).impl.db[Ticket.__mongometa__.name].find(
+                dict(app_config_id=self.app_config_id, deleted=False, acl=[]),
+                fields=['custom_fields', 'status'])
+            for t in tickets:
+                custom_fields = t.get('custom_fields') or {}
+                for f in fields:
+                    m = custom_fields.get(f)
+                    if m:
+                        counts[f, m]['hits'] += 1
+                        if t.get('status') in closed_names:
+                            counts[f, m]['closed'] += 1
+        return counts
+
+    def update_milestone_counts(self, attempts=3):
+        '''Recount the public tickets in every milestone into
+        :class:`MilestoneCount` docs.  Saving tickets keeps them up to date
+        all along, so once they're recounted they can be trusted.  Run by the
+        update_milestone_counts task.
+
+        Tickets saved while they are being counted make a pass fail, and
+        another one is made, up to `attempts` in all.  If the tickets still
+        kept changing, the counts are left to be rebuilt later.
+        '''
+        for i in range(attempts):
+            if self._recount_milestones():
+                self._milestone_counts_built = True
+                break
+            log.info('Tickets of %s changed while counting milestones, attempt #%s',
+                     self.app_config_id, i + 1)
+        self._milestone_counts_invalidated = None
+        session(self).flush(self)
+
+    def _read_milestone_counts(self):
+        return dict(
+            ((mc['field'], mc['milestone']), (mc.get('hits', 0), mc.get('closed', 0)))
+            for mc in MilestoneCount.collection().find(
+                dict(app_config_id=self.app_config_id)))
+
+    def _recount_milestones(self):
+        '''Make one pass of :meth:`update_milestone_counts`, and return
+        whether it wasn't disturbed by tickets being saved.
+
+        :class:`MilestoneCountExtension` changes the docs before a ticket is
+        written, so a ticket saved after the docs are first read here (and
+        possibly counted in its new state) shows up as a changed doc.  Each
+        doc is only replaced if it still holds the counts read before
+        counting, so a ticket saved after that isn't lost either.
+        '''
+        collection = MilestoneCount.collection()
+        before = self._read_milestone_counts()
+        counts = self._count_public_milestones()
+        if self._read_milestone_counts() != before:
+            return False
+        undisturbed = True
+        for f, m in set(before) | set(counts):
+            spec = dict(app_config_id=self.app_config_id, field=f, milestone=m)
+            d = counts.get((f, m))
+            if (f, m) not in before:
+                try:
+                    collection.insert(dict(spec, **d))
+                except DuplicateKeyError:
+                    # a ticket was saved into it meanwhile
+                    undisturbed = False
+                continue
+            spec.update(hits=before[f, m][0], closed=before[f, m][1])
+            if d is None:
+                found = collection.find_and_modify(spec, remove=True)
+            else:
+                found = collection.find_and_modify(spec, {'$set': d})
+            undisturbed = undisturbed and found is not None
+        return undisturbed
+
+    def invalidate_milestone_counts(self):
+        '''Have milestone counts rebuilt, e.g. when closed statuses change'''
+        self._milestone_counts_built = False
+        # like invalidate_bin_counts, only queue one rebuild at a time, unless
+        # it seems to have failed
+        invalidation_expiry = datetime.utcnow() - timedelta(minutes=5)
+        if self._milestone_counts_invalidated is not None and \
+           self._milestone_counts_invalidated > invalidation_expiry:
+            return
+        self._milestone_counts_invalidated = datetime.utcnow()
+        from forgetracker import tasks  # prevent circular import
+        tasks.update_milestone_counts.post(self.app_config_id)
 
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
+        # Each edit pushes back the refresh (see bin_counts_refresh_delay),
+        # so a burst of edits only results in one recount.  Set it directly
+        # rather than save the whole globals doc on every edit.
+        Globals.query.update({'_id': self._id},
+                             {'$set': {'_bin_counts_edited': datetime.utcnow()}})
+        user_bin_counts.invalidate(self.app_config_id)
         # To prevent multiple calls to this method from piling on redundant
         # tasks, we set _bin_counts_invalidated when we post the task, and
         # the task clears it when it's done.  However, in the off chance
@@ -245,7 +463,31 @@ def invalidate_bin_counts(self):
             return
         self._bin_counts_invalidated = datetime.utcnow()
         from forgetracker import tasks  # prevent circular import
-        tasks.update_bin_counts.post(self.app_config_id, delay=5)
+        tasks.update_bin_counts.post(
+            self.app_config_id,
+            delay=asint(config.get('bin_counts_debounce', 5)))
+
+    def bin_counts_refresh_delay(self):
+        '''Seconds the bin count refresh should still wait for edits to
+        settle, or 0 if it should run now.
+
+        The refresh runs once no edit has been made for
+        ``forgetracker.bin_counts_debounce`` seconds, but is never put off
+        for more than ``forgetracker.bin_counts_max_delay`` seconds after
+        it was queued.
+        '''
+        now = datetime.utcnow()
+        debounce = asint(config.get('bin_counts_debounce', 5))
+        max_delay = asint(config.get('bin_counts_max_delay', 60))
+        if self._bin_counts_edited is None or \
+           self._bin_counts_invalidated is None:
+            return 0
+        if self._bin_counts_invalidated + timedelta(seconds=max_delay) <= now:
+            return 0
+        ready = self._bin_counts_edited + timedelta(seconds=debounce)
+        if ready <= now:
+            return 0
+        return max(1, int((ready - now).total_seconds() + 0.5))
 
     def sortable_custom_fields_shown_in_search(self):
         def solr_type(field_name):
@@ -606,11 +848,133 @@ def __json__(self):
         )
 
 
+class MilestoneCount(MappedClass):
+
+    '''Number of public, non-deleted tickets in a milestone, and how many of
+    them are closed.  Built by :meth:`Globals.update_milestone_counts` and
+    kept up to date as tickets are saved by :class:`MilestoneCountExtension`.
+    '''
+
+    class __mongometa__:
+        name = 'milestone_count'
+        session = project_orm_session
+        unique_indexes = [('app_config_id', 'field', 'milestone')]
+
+    _id = FieldProperty(schema.ObjectId)
+    app_config_id = FieldProperty(schema.ObjectId)
+    field = FieldProperty(str)
+    milestone = FieldProperty(str)
+    hits = FieldProperty(int, if_missing=0)
+    closed = FieldProperty(int, if_missing=0)
+
+    @classmethod
+    def collection(cls):
+        return session(cls).impl.db[cls.__mongometa__.name]
+
+    @classmethod
+    def counted_in(cls, gbl, doc):
+        '''Return {(app_config_id, field, milestone): closed} for the
+        milestones of tracker `gbl` a ticket doc counts towards'''
+        if not doc or doc.get('deleted') or doc.get('acl'):
+            return {}
+        closed = int(doc.get('status') in gbl.set_of_closed_status_names)
+        custom_fields = doc.get('custom_fields') or {}
+        return dict(
+            ((gbl.app_config_id, fld.name, custom_fields[fld.name]), closed)
+            for fld in gbl.milestone_fields
+            if custom_fields.get(fld.name))
+
+    @classmethod
+    def snapshot(cls, doc):
+        '''Return a copy of the parts of a ticket doc :meth:`counted_in`
+        looks at, or None'''
+        if doc is None:
+            return None
+        return dict(
+            deleted=doc.get('deleted'),
+            acl=list(doc.get('acl') or []),
+            status=doc.get('status'),
+            custom_fields=dict(doc.get('custom_fields') or {}))
+
+    @classmethod
+    def delta(cls, gbl, old_doc, new_doc):
+        '''Return {(app_config_id, field, milestone): (hits, closed)} changes
+        for a ticket doc of tracker `gbl` going from `old_doc` to `new_doc`'''
+        delta = defaultdict(lambda: [0, 0])
+        for key, closed in cls.counted_in(gbl, old_doc).iteritems():
+            delta[key][0] -= 1
+            delta[key][1] -= closed
+        for key, closed in cls.counted_in(gbl, new_doc).iteritems():
+            delta[key][0] += 1
+            delta[key][1] += closed
+        return dict((k, tuple(v)) for k, v in delta.iteritems() if any(v))
+
+    @classmethod
+    def apply(cls, delta):
+        for (app_config_id, field, milestone), (hits, closed) in delta.iteritems():
+            cls.collection().update(
+                dict(app_config_id=app_config_id, field=field, milestone=milestone),
+                {'$inc': dict(hits=hits, closed=closed)},
+                upsert=True)
+
+
+class MilestoneCountExtension(MapperExtension):
+
+    '''Update :class:`MilestoneCount` docs when tickets are saved.
+
+    The docs are changed just before the ticket is written, which
+    :meth:`Globals._recount_milestones` relies on.  Ming doesn't refresh
+    ``original_document`` after a flush, so the ticket as last written is
+    kept on it to tell what the next flush changes.
+    '''
+
+    def before_insert(self, obj, st, sess):
+        self._update(obj, None, st.document)
+
+    def before_update(self, obj, st, sess):
+        self._update(obj, self._saved(obj, st), st.document)
+
+    def before_delete(self, obj, st, sess):
+        self._update(obj, self._saved(obj, st), None)
+
+    def _saved(self, obj, st):
+        return obj.__dict__.get('_milestone_count_saved', st.original_document)
+
+    def _update(self, obj, old_doc, new_doc):
+        gbl = self._globals(obj)
+        if gbl is not None:
+            delta = MilestoneCount.delta(gbl, old_doc, new_doc)
+            if delta:
+                MilestoneCount.apply(delta)
+        obj._milestone_count_saved = MilestoneCount.snapshot(new_doc)
+
+    def _globals(self, obj):
+        # the tracker's globals are usually loaded once for the request
+        app = getattr(c, 'app', None)
+        if getattr(getattr(app, 'config', None), '_id', None) == obj.app_config_id \
+                and isinstance(getattr(app, 'globals', None), Globals):
+            return app.globals
+        return Globals.query.get(app_config_id=obj.app_config_id)
+
+
+class ReadRolesExtension(MapperExtension):
+
+    '''Keep :attr:`Ticket.read_roles` and :attr:`Ticket.read_denied_roles`
+    in sync with the ticket's ACL'''
+
+    def before_insert(self, obj, st, sess):
+        acl = st.document.get('acl') or []
+        st.document['read_roles'] = Ticket.read_roles_for_acl(acl)
+        st.document['read_denied_roles'] = Ticket.read_denied_roles_for_acl(acl)
+    before_update = before_insert
+
+
 class Ticket(VersionedArtifact, ActivityObject, VotableArtifact):
 
     class __mongometa__:
         name = 'ticket'
         history_class = TicketHistory
+        extensions = [ReadRolesExtension, MilestoneCountExtension]
         indexes = [
             'ticket_num',
             ('app_config_id', 'custom_fields._milestone'),
@@ -633,6 +997,11 @@ class __mongometa__:
     milestone = FieldProperty(str, if_missing='')
     status = FieldProperty(str, if_missing='')
     custom_fields = FieldProperty({str: None})
+    # ids of the roles this ticket's ACL lets read it; EVERYONE (None) stands
+    # for the roles left to the tracker's permissions.  See read_roles_for_acl
+    read_roles = FieldProperty([schema.ObjectId])
+    # ids of the roles this ticket's ACL denies reading it outright
+    read_denied_roles = FieldProperty([schema.ObjectId])
 
     reported_by = RelationProperty(User, via='reported_by_id')
 
@@ -652,6 +1021,42 @@ def activity_extras(self):
         d.update(summary=self.summary)
         return d
 
+    @staticmethod
+    def read_roles_for_acl(acl):
+        '''Return the ids of the roles which the given ticket ACL allows to
+        read the ticket, in the same way :func:`allura.lib.security.has_access`
+        walks an ACL.  If some roles aren't decided by the ACL, access falls
+        through to the tracker, which is recorded as EVERYONE.
+
+        has_access first denies users with any role denied 'read' anywhere in
+        the ACL, which :meth:`read_denied_roles_for_acl` records instead.
+        '''
+        allowed = []
+        decided = set()
+        for ace in acl:
+            if ace.permission not in ('read', ALL_PERMISSIONS):
+                continue
+            if ace.role_id == EVERYONE:
+                # decides for all the remaining roles
+                if ace.access == ACE.ALLOW:
+                    allowed.append(EVERYONE)
+                return allowed
+            if ace.role_id in decided:
+                continue
+            decided.add(ace.role_id)
+            if ace.access == ACE.ALLOW:
+                allowed.append(ace.role_id)
+        allowed.append(EVERYONE)
+        return allowed
+
+    @staticmethod
+    def read_denied_roles_for_acl(acl):
+        '''Return the ids of the roles explicitly denied 'read' by the given
+        ticket ACL, which :func:`allura.lib.security.has_access` checks
+        before walking it'''
+        return [ace.role_id for ace in acl
+                if ace.access == ACE.DENY and ace.permission == 'read']
+
     @classmethod
     def new(cls):
         '''Create a new ticket, safely (ensuring a unique ticket_num'''
@@ -707,12 +1112,16 @@ def index(self):
 
         result['reported_by_s'] = self.reported_by.username if self.reported_by else None
         result['assigned_to_s'] = self.assigned_to.username if self.assigned_to else None
+        return result
+
+    solr_text_has_fields = True
 
+    def solr_text(self, doc):
         # Tracker uses search with default solr parser. It would match only on
         # `text`, so we're appending all other field values into `text`, to
         # match on it too.
-        result['text'] += pformat(result.values())
-        return result
+        text = super(Ticket, self).solr_text(doc)
+        return text + pformat(doc.values())
 
     @classmethod
     def attachment_class(cls):
@@ -1152,11 +1561,19 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
         """
         Query tickets, filtering for 'read' permission, sorting and paginating the result.
 
+        Permissions are checked in the query itself (see read_roles_query), so
+        pages are full and the count is exact.
+
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(
-            dict(query, app_config_id=app_config._id, deleted=deleted))
+        read_query = cls.read_roles_query(app_config, user)
+        if '$or' in query and '$or' in read_query:
+            query = {'$and': [query, read_query]}
+        else:
+            query = dict(query, **read_query)
+        q = cls.query.find(dict(
+            query, app_config_id=app_config._id, deleted=deleted))
         q = q.sort('ticket_num', pymongo.DESCENDING)
         if sort:
             field, direction = sort.split()
@@ -1168,19 +1585,43 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             q = q.sort(field, direction)
         q = q.skip(start)
         q = q.limit(limit)
-        tickets = []
         count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
-            else:
-                count = count - 1
+        tickets = q.all()
 
         return dict(
             tickets=tickets,
             count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
             **kw)
 
+    @classmethod
+    def read_roles_query(cls, app_config, user):
+        '''Return the mongo query restricting tickets of the given tracker
+        to the ones `user` can read, matching the role ids reaching the user
+        against :attr:`read_roles` and :attr:`read_denied_roles`.
+
+        Tickets saved before these fields were introduced (see migration 032)
+        are only matched if their ACL is empty, i.e. they are left to the
+        tracker's permissions.'''
+        project = app_config.project.root_project
+        if security.has_access(project, 'admin', user):
+            # admins can read every ticket, whatever its ACL
+            return {}
+        cred = security.Credentials.get()
+        role_ids = list(cred.user_roles(
+            user_id=user._id, project_id=project._id).reaching_ids)
+        # has_access denies outright if any of the user's roles is denied
+        query = dict(read_denied_roles={'$nin': role_ids})
+        if security.has_access(app_config, 'read', user, project):
+            role_ids.append(EVERYONE)
+            query['$or'] = [
+                {'read_roles': {'$exists': True, '$in': role_ids}},
+                {'read_roles': {'$exists': False}, 'acl': []}]
+        else:
+            # the field must exist, since $in with None would match tickets
+            # saved before it was introduced
+            query['read_roles'] = {'$exists': True, '$in': role_ids}
+        return query
+
     @classmethod
     def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_deleted=False,
                      filter=None, **kw):
@@ -32,7 +32,20 @@ def update_bin_counts(app_config_id):
     app_config = M.AppConfig.query.get(_id=app_config_id)
     app = app_config.project.app_instance(app_config)
     with h.push_config(c, app=app):
-        app.globals.update_bin_counts()
+        delay = app.globals.bin_counts_refresh_delay()
+        if delay:
+            # tickets are still being edited, wait for them to settle
+            update_bin_counts.post(app_config_id, delay=delay)
+        else:
+            app.globals.update_bin_counts()
+
+
+@task
+def update_milestone_counts(app_config_id):
+    app_config = M.AppConfig.query.get(_id=app_config_id)
+    app = app_config.project.app_instance(app_config)
+    with h.push_config(c, app=app):
+        app.globals.update_milestone_counts()
 
 
 @task
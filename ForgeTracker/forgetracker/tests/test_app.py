@@ -20,6 +20,7 @@
 import operator
 import os
 
+import mock
 from nose.tools import assert_equal, assert_true
 from pylons import tmpl_context as c
 from cgi import FieldStorage
@@ -29,6 +30,7 @@
 from allura import model as M
 from allura.tests import decorators as td
 from forgetracker import model as TM
+from forgetracker import tracker_main
 from forgetracker.tests.functional.test_root import TrackerTestController
 
 
@@ -102,3 +104,20 @@ def test_export_with_attachments(self):
         )
         assert_equal(tickets[1]['discussion_thread']['posts'][0]['attachments'][0]['path'], file_path)
         os.path.exists(file_path)
+
+    def test_export_in_batches(self):
+        temp_dir = tempfile.mkdtemp()
+        f = tempfile.TemporaryFile()
+        with mock.patch.object(tracker_main, 'EXPORT_BATCH_SIZE', 1):
+            self.tracker.bulk_export(f, temp_dir, True)
+        f.seek(0)
+        tracker = json.loads(f.read())
+        tickets = sorted(tracker['tickets'],
+                         key=operator.itemgetter('summary'))
+        assert_equal([t['summary'] for t in tickets], ['bar', 'foo'])
+        posts_foo = tickets[1]['discussion_thread']['posts']
+        assert_equal(len(posts_foo), 1)
+        assert_equal(posts_foo[0]['text'], 'silly comment')
+        file_path = os.path.join(temp_dir, posts_foo[0]['attachments'][0]['path'])
+        with open(file_path) as fp:
+            assert_equal(fp.read(), 'test file1\n')
@@ -20,10 +20,11 @@
 import mock
 from nose.tools import assert_equal
 from pylons import tmpl_context as c
+from ming.orm import state
 from ming.orm.ormsession import ThreadLocalORMSession
 
 import forgetracker
-from forgetracker.model import Globals
+from forgetracker.model import Globals, Ticket, MilestoneCount
 from forgetracker.tests.unit import TrackerTestWithModel
 from allura.lib import helpers as h
 
@@ -98,6 +99,18 @@ def test_invalidate_bin_counts(self, mock_dt, mock_task):
         assert mock_task.post.called
         assert_equal(gbl._bin_counts_invalidated, now)
 
+    @mock.patch('forgetracker.tasks.update_bin_counts')
+    def test_invalidate_bin_counts_edited(self, mock_task):
+        gbl = c.app.globals
+        gbl._bin_counts_invalidated = datetime.utcnow()
+        ThreadLocalORMSession.flush_all()
+        gbl.invalidate_bin_counts()
+        assert not mock_task.post.called
+        # recorded without saving the whole globals doc again
+        assert_equal(state(gbl).status, state(gbl).clean)
+        assert_equal(Globals.query.find(dict(
+            _id=gbl._id, _bin_counts_edited={'$ne': None})).count(), 1)
+
     @mock.patch('forgetracker.model.ticket.Bin')
     @mock.patch('forgetracker.model.ticket.search_artifact')
     @mock.patch('forgetracker.model.ticket.datetime')
@@ -106,19 +119,151 @@ def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
         mock_dt.utcnow.return_value = now
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
-        mock_bin.query.find.return_value = [
-            mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+        mock_bin.query.find.return_value.all.return_value = [
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER'),
+            mock.Mock(summary='baz', terms='qux')]
+        mock_search.return_value.facets = {
+            'facet_queries': {'bin0': 5, 'bin2': 3}}
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
-        mock_search.assert_called_with(
-            forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False)
-        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+        mock_search.assert_called_once_with(
+            forgetracker.model.Ticket, '*:*', rows=0, short_timeout=False,
+            facet_queries={'bin0': 'bar', 'bin2': 'qux'})
+        assert_equal(gbl._bin_counts_data, [
+            {'summary': 'foo', 'hits': 5},
+            {'summary': 'mine', 'hits': 0, 'user_terms': 'assigned_to:$USER'},
+            {'summary': 'baz', 'hits': 3}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    def test_user_bin_count(self, mock_search):
+        gbl = Globals()
+        gbl._bin_counts_expire = datetime.utcnow() + timedelta(minutes=5)
+        gbl._bin_counts_data = [
+            {'summary': 'mine', 'hits': 0, 'user_terms': 'assigned_to:$USER'}]
+        mock_search.return_value.hits = 4
+        assert_equal(gbl.bin_count('mine'), {'summary': 'mine', 'hits': 4})
+        mock_search.assert_called_once_with(
+            forgetracker.model.Ticket, 'assigned_to:$USER', rows=0,
+            short_timeout=True)
+
+        # cached for this user
+        mock_search.return_value.hits = 6
+        assert_equal(gbl.bin_count('mine')['hits'], 4)
+        assert_equal(mock_search.call_count, 1)
+
+        # until the tracker's counts are invalidated
+        with mock.patch('forgetracker.tasks.update_bin_counts'):
+            gbl.invalidate_bin_counts()
+        assert_equal(gbl.bin_count('mine')['hits'], 6)
+
+    @mock.patch('forgetracker.model.ticket.datetime')
+    def test_bin_counts_refresh_delay(self, mock_dt):
+        now = datetime.utcnow().replace(microsecond=0)
+        mock_dt.utcnow.return_value = now
+        gbl = Globals()
+        assert_equal(gbl.bin_counts_refresh_delay(), 0)
+
+        # edited just now, wait for edits to settle
+        gbl._bin_counts_invalidated = now - timedelta(seconds=10)
+        gbl._bin_counts_edited = now - timedelta(seconds=2)
+        assert_equal(gbl.bin_counts_refresh_delay(), 3)
+
+        # no recent edits
+        gbl._bin_counts_edited = now - timedelta(seconds=5)
+        assert_equal(gbl.bin_counts_refresh_delay(), 0)
+
+        # edits keep coming, but don't put it off forever
+        gbl._bin_counts_invalidated = now - timedelta(seconds=60)
+        gbl._bin_counts_edited = now
+        assert_equal(gbl.bin_counts_refresh_delay(), 0)
+
+    def test_milestone_counts(self):
+        gbl = c.app.globals
+        Ticket(summary='t1', ticket_num=1, custom_fields=dict(_milestone='1.0'))
+        Ticket(summary='t2', ticket_num=2, status='closed',
+               custom_fields=dict(_milestone='1.0'))
+        ThreadLocalORMSession.flush_all()
+        # counted on the fly until the task has built the counts
+        with mock.patch('forgetracker.tasks.update_milestone_counts') as task:
+            assert_equal(gbl.milestone_count('_milestone:1.0'),
+                         dict(name='_milestone:1.0', hits=2, closed=1))
+            assert_equal(gbl.milestone_count('_milestone:1.0')['hits'], 2)
+        task.post.assert_called_once_with(gbl.app_config_id)
+        assert not gbl._milestone_counts_built
+        gbl.update_milestone_counts()
+        assert gbl._milestone_counts_built
+        assert_equal(gbl.milestone_count('_milestone:1.0'),
+                     dict(name='_milestone:1.0', hits=2, closed=1))
+
+        # saving tickets keeps the counts up to date
+        t3 = Ticket(summary='t3', ticket_num=3,
+                    custom_fields=dict(_milestone='2.0'))
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_count('_milestone:2.0')['hits'], 1)
+        t3.custom_fields['_milestone'] = '1.0'
+        t3.status = 'closed'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_counts(), {
+            '_milestone:1.0': dict(name='_milestone:1.0', hits=3, closed=2),
+            '_milestone:2.0': dict(name='_milestone:2.0', hits=0, closed=0),
+        })
+        # a loaded ticket saved twice is only counted once
+        ThreadLocalORMSession.close_all()
+        gbl = Globals.query.get(app_config_id=gbl.app_config_id)
+        t3 = Ticket.query.get(_id=t3._id)
+        t3.status = 'open'
+        ThreadLocalORMSession.flush_all()
+        t3.summary = 't3 reopened'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_count('_milestone:1.0'),
+                     dict(name='_milestone:1.0', hits=3, closed=1))
+        t3.deleted = True
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_count('_milestone:1.0')['hits'], 2)
+        mc = MilestoneCount.query.get(app_config_id=gbl.app_config_id,
+                                      field='_milestone', milestone='1.0')
+        assert_equal((mc.hits, mc.closed), (2, 1))
+
+        # rebuilding again updates the docs in place and drops stale ones
+        t3.deleted = False
+        t3.custom_fields['_milestone'] = '3.0'
+        ThreadLocalORMSession.flush_all()
+        gbl.update_milestone_counts()
+        assert_equal(gbl.milestone_counts(), {
+            '_milestone:1.0': dict(name='_milestone:1.0', hits=2, closed=1),
+            '_milestone:3.0': dict(name='_milestone:3.0', hits=1, closed=0),
+        })
+
+    def test_milestone_counts_saved_while_rebuilding(self):
+        gbl = c.app.globals
+        Ticket(summary='t1', ticket_num=1, custom_fields=dict(_milestone='1.0'))
+        ThreadLocalORMSession.flush_all()
+        count = gbl._count_public_milestones
+
+        def count_and_save():
+            counts = count()
+            if not Ticket.query.get(app_config_id=gbl.app_config_id, ticket_num=2):
+                Ticket(summary='t2', ticket_num=2,
+                       custom_fields=dict(_milestone='1.0'))
+                ThreadLocalORMSession.flush_all()
+            return counts
+        with mock.patch.object(gbl, '_count_public_milestones', count_and_save):
+            gbl.update_milestone_counts()
+        assert gbl._milestone_counts_built
+        assert_equal(gbl.milestone_count('_milestone:1.0')['hits'], 2)
+
+        # tickets that keep changing leave the counts to be rebuilt later
+        with mock.patch.object(gbl, '_recount_milestones', return_value=False):
+            gbl._milestone_counts_built = False
+            gbl.update_milestone_counts()
+        assert not gbl._milestone_counts_built
+        assert_equal(gbl._milestone_counts_invalidated, None)
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
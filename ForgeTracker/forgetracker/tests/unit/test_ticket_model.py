@@ -20,6 +20,7 @@
 import urllib2
 
 import mock
+import tg
 from ming.orm.ormsession import ThreadLocalORMSession
 from ming.orm import session
 from ming import schema
@@ -35,6 +36,7 @@
 from forgetracker.import_support import ResettableStream
 from allura.model import Feed, Post, User
 from allura.lib import helpers as h
+from allura.tasks import index_tasks
 from allura.tests import decorators as td
 
 
@@ -328,6 +330,57 @@ def test_attach_with_resettable_stream(self):
         assert_equal(len(ticket.attachments), 1)
         assert_equal(ticket.attachments[0].filename, 'test_ticket_model.py')
 
+    def test_paged_query_permissions(self):
+        from allura.model import ProjectRole
+        from allura.lib.security import Credentials
+        from allura.websetup import bootstrap
+
+        admin = c.user
+        creator = bootstrap.create_user('Not a Project Admin')
+        observer = bootstrap.create_user('Random Non-Project User')
+        for i in range(1, 4):
+            Ticket(summary='public %d' % i, ticket_num=i)
+        t = Ticket(summary='private', ticket_num=4, reported_by_id=creator._id)
+        t.private = True
+        ThreadLocalORMSession.flush_all()
+        Credentials.get().clear()
+        role_developer = ProjectRole.by_name('Developer')._id
+        role_creator = ProjectRole.by_user(creator)._id
+        assert_equal(Ticket.query.get(ticket_num=1).read_roles, [None])
+        assert_equal(t.read_roles, [role_developer, role_creator])
+
+        # private tickets are left out by the query, so pages are full
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=2)
+        assert_equal(r['count'], 3)
+        assert_equal([t.ticket_num for t in r['tickets']], [3, 2])
+        r = Ticket.paged_query(c.app.config, creator, {}, limit=2)
+        assert_equal(r['count'], 4)
+        assert_equal([t.ticket_num for t in r['tickets']], [4, 3])
+        r = Ticket.paged_query(c.app.config, admin, {}, limit=10)
+        assert_equal(r['count'], 4)
+
+        # like has_access, a role denied anywhere in the ACL is denied
+        # outright, even if other roles would be left to the tracker
+        from allura.model import ACE
+        role_auth = ProjectRole.by_name('*authenticated')._id
+        t = Ticket.query.get(ticket_num=3)
+        t.acl = [ACE.deny(role_auth, 'read')]
+        ThreadLocalORMSession.flush_all()
+        assert_equal(t.read_roles, [None])
+        assert_equal(t.read_denied_roles, [role_auth])
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=10)
+        assert_equal([tk.ticket_num for tk in r['tickets']], [2, 1])
+
+        # tickets saved before read_roles was stored are still found, unless
+        # they have an ACL of their own
+        Ticket.query.update({'ticket_num': {'$in': [1, 4]}},
+                            {'$unset': {'read_roles': 1, 'read_denied_roles': 1}},
+                            multi=True)
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=10)
+        assert_equal([tk.ticket_num for tk in r['tickets']], [2, 1])
+        r = Ticket.paged_query(c.app.config, creator, {}, limit=10)
+        assert_equal([tk.ticket_num for tk in r['tickets']], [2, 1])
+
     def test_json_parents(self):
         ticket = Ticket.new()
         json_keys = ticket.__json__().keys()
@@ -364,3 +417,39 @@ def test_index(self):
         assert_equal(idx['labels_t'], 'mylabel other')
         assert_equal(idx['reported_by_s'], 'test-user')
         assert_equal(idx['assigned_to_s'], None)  # must exist at least
+
+    def test_solr_text_has_field_values(self):
+        t = Ticket(ticket_num=2, summary="ticket2", description="**desc**",
+                   status="open")
+        idx = t.index()
+        assert_equal(idx['text'], '**desc**')
+        text = t.solr_text(idx)
+        assert text.startswith('desc')
+        assert_in("'open'", text)
+
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_status_change_is_a_partial_solr_update(self, solr):
+        full_docs = []
+        solr.add_pipelined.side_effect = lambda chunks: full_docs.extend(
+            doc for chunk in chunks for doc in chunk)
+        t = Ticket(ticket_num=2, summary="ticket2", description="desc",
+                   status="open")
+        ThreadLocalORMSession.flush_all()
+        with h.push_config(tg.config, **{'solr.atomic_updates': 'true'}):
+            index_tasks.add_artifacts([t.index_id()])
+            ThreadLocalORMSession.flush_all()
+            assert_equal(len(full_docs), 1)
+            assert_false(solr.add.called)
+
+            t.status = 'closed'
+            ThreadLocalORMSession.flush_all()
+            index_tasks.add_artifacts([t.index_id()])
+        assert_equal(len(full_docs), 1)
+        docs, = solr.add.call_args[0]
+        field_updates = solr.add.call_args[1]['fieldUpdates']
+        assert_equal(len(docs), 1)
+        assert_equal(docs[0]['status_s'], 'closed')
+        assert_in("'closed'", docs[0]['text'])
+        assert_equal(field_updates['status_s'], 'set')
+        assert_equal(field_updates['text'], 'set')
+        assert 'summary_t' not in docs[0]
@@ -23,6 +23,8 @@
 from webob import exc
 import json
 import os
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 # Non-stdlib imports
 import pkg_resources
@@ -83,6 +85,11 @@
 
 log = logging.getLogger(__name__)
 
+# bulk_export reads this many tickets at a time, and copies their
+# attachments with this many threads
+EXPORT_BATCH_SIZE = 100
+EXPORT_ATTACHMENT_THREADS = 4
+
 search_validators = dict(
     q=validators.UnicodeString(if_empty=None),
     history=validators.StringBool(if_empty=False),
@@ -478,21 +485,42 @@ def uninstall(self, project):
 
     def bulk_export(self, f, export_path='', with_attachments=False):
         f.write('{"tickets": [')
-        tickets = list(TM.Ticket.query.find(dict(
-            app_config_id=self.config._id,
-            # backwards compat for old tickets that don't have it set
-            deleted={'$ne': True},
-        )))
         if with_attachments:
             GenericClass = utils.JSONForExport
-            self.export_attachments(tickets, export_path)
+            pool = ThreadPool(EXPORT_ATTACHMENT_THREADS)
         else:
             GenericClass = jsonify.GenericJSON
-
-        for i, ticket in enumerate(tickets):
-            if i > 0:
-                f.write(',')
-            json.dump(ticket, f, cls=GenericClass, indent=2)
+            pool = None
+        pending = []
+        try:
+            # tickets are read and written a batch at a time, and dropped
+            # from the session afterwards, so a big tracker doesn't have to
+            # fit in memory
+            query = dict(
+                app_config_id=self.config._id,
+                # backwards compat for old tickets that don't have it set
+                deleted={'$ne': True},
+            )
+            first = True
+            for tickets in utils.chunked_find(TM.Ticket, query, EXPORT_BATCH_SIZE):
+                loaded = self._prefetch_export(tickets)
+                if with_attachments:
+                    # copy this batch's attachments while its json is written,
+                    # but don't let more than one batch pile up
+                    self._wait_export(pending)
+                    pending = self.export_attachments(tickets, export_path, pool)
+                for ticket in tickets:
+                    if not first:
+                        f.write(',')
+                    first = False
+                    f.write(json.dumps(ticket, cls=GenericClass))
+                for obj in loaded:
+                    session(obj).expunge(obj)
+            self._wait_export(pending)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         f.write('],\n"tracker_config":')
         json.dump(self.config, f, cls=GenericClass, indent=2)
         f.write(',\n"milestones":')
@@ -512,10 +540,60 @@ def bulk_export(self, f, export_path='', with_attachments=False):
         json.dump(bins, f, cls=GenericClass, indent=2)
         f.write('}')
 
-    def export_attachments(self, tickets, export_path):
+    def _prefetch_export(self, tickets):
+        """Load the discussion threads, posts and attachments of a batch of
+        tickets with a query each, instead of a few queries per ticket.
+
+        Returns all the objects loaded, so they can be expunged once the
+        batch is exported.
+        """
+        tickets_by_ref = dict((t.index_id(), t) for t in tickets)
+        threads = M.Thread.query.find(dict(
+            ref_id={'$in': tickets_by_ref.keys()})).all()
+        by_ref = defaultdict(list)
+        for thread in threads:
+            by_ref[thread.ref_id].append(thread)
+        for ref_id, ref_threads in by_ref.iteritems():
+            # leave duplicate threads to be merged by get_discussion_thread
+            if len(ref_threads) == 1:
+                tickets_by_ref[ref_id].__dict__['discussion_thread'] = ref_threads[0]
+        # query_posts() will get these same objects from the identity map
+        posts = M.Post.query.find(dict(
+            thread_id={'$in': [t._id for t in threads]},
+            status='ok',
+            deleted=False,
+        )).all()
+        ticket_atts = TM.TicketAttachment.query.find(dict(
+            app_config_id=self.config._id,
+            artifact_id={'$in': [t._id for t in tickets]},
+            type='attachment',
+        )).all()
+        post_atts = M.Post.attachment_class().query.find(dict(
+            post_id={'$in': [p._id for p in posts]},
+            type='attachment',
+        )).all()
+        for objs, atts, key in [(tickets, ticket_atts, 'artifact_id'),
+                                (posts, post_atts, 'post_id')]:
+            by_id = defaultdict(list)
+            for attachment in atts:
+                by_id[getattr(attachment, key)].append(attachment)
+            for obj in objs:
+                obj.__dict__['attachments'] = utils.unique_attachments(by_id[obj._id])
+        return list(tickets) + threads + posts + ticket_atts + post_atts
+
+    def _wait_export(self, pending):
+        for result in pending:
+            result.get()
+
+    def export_attachments(self, tickets, export_path, pool=None):
+        """Save the attachments of tickets and their comments under
+        `export_path`.  If a `pool` is given, the files are copied by its
+        threads, and the list of their async results is returned.
+        """
+        jobs = []
         for ticket in tickets:
             attachment_path = self.get_attachment_export_path(export_path, str(ticket._id))
-            self.save_attachments(attachment_path, ticket.attachments)
+            jobs.append((attachment_path, ticket.attachments))
 
             for post in ticket.discussion_thread.query_posts(status='ok'):
                 post_path = os.path.join(
@@ -523,7 +601,16 @@ def export_attachments(self, tickets, export_path):
                     ticket.discussion_thread._id,
                     post.slug
                 )
-                self.save_attachments(post_path, post.attachments)
+                jobs.append((post_path, post.attachments))
+        if pool is None:
+            for path, attachments in jobs:
+                self.save_attachments(path, attachments)
+            return []
+        # post dirs are nested in ticket dirs, so make them before the
+        # threads race to
+        for path, attachments in jobs:
+            self.make_dir_for_attachments(path)
+        return [pool.apply_async(self.save_attachments, job) for job in jobs]
 
     @property
     def bins(self):
@@ -532,11 +619,12 @@ def bins(self):
     @property
     def milestones(self):
         milestones = []
+        counts = self.globals.milestone_counts('_milestone')
         for fld in self.globals.milestone_fields:
             if fld.name == '_milestone':
                 for m in fld.milestones:
-                    d = self.globals.milestone_count(
-                        '%s:%s' % (fld.name, m.name))
+                    name = '%s:%s' % (fld.name, m.name)
+                    d = counts.get(name, dict(hits=0, closed=0))
                     milestones.append(dict(
                         name=m.name,
                         due_date=m.get('due_date'),
@@ -677,12 +765,12 @@ def bin_counts(self, *args, **kw):
     @expose('json:')
     def milestone_counts(self, *args, **kw):
         milestone_counts = []
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             for m in getattr(fld, "milestones", []):
                 if m.complete:
                     continue
-                count = c.app.globals.milestone_count(
-                    '%s:%s' % (fld.name, m.name))['hits']
+                count = counts.get('%s:%s' % (fld.name, m.name), {}).get('hits', 0)
                 name = h.text.truncate(m.name, 72)
                 milestone_counts.append({'name': name, 'count': count})
         return {'milestone_counts': milestone_counts}
@@ -816,6 +904,7 @@ def update_milestones(self, field_name=None, milestones=None, **kw):
                         update_counts = True
         if update_counts:
             c.app.globals.invalidate_bin_counts()
+            c.app.globals.invalidate_milestone_counts()
         redirect('milestones')
 
     @with_trailing_slash
@@ -1798,6 +1887,7 @@ def set_custom_fields(self, **post_data):
                                 milestone['name']
 
         self.app.globals.custom_fields = custom_fields
+        self.app.globals.invalidate_milestone_counts()
         flash('Fields updated')
         redirect(request.referer)
 
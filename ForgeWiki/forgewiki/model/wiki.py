@@ -243,6 +243,9 @@ def html_text(self):
         """A markdown processed version of the page text"""
         return g.markdown_wiki.cached_convert(self, 'text')
 
+    def fill_markdown_cache(self):
+        g.markdown_wiki.fill_cache(self, 'text')
+
     def authors(self):
         """All the users that have edited this page"""
         def uniq(users):
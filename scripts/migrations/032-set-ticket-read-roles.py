@@ -0,0 +1,38 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import logging
+
+from allura.lib import utils
+from forgetracker import model as TM
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    '''Store Ticket.read_roles and read_denied_roles, used to filter tickets
+    by permission in Ticket.paged_query'''
+    for chunk in utils.chunked_find(TM.Ticket, {'read_denied_roles': {'$exists': False}}):
+        for t in chunk:
+            TM.Ticket.query.update(
+                {'_id': t._id},
+                {'$set': {'read_roles': TM.Ticket.read_roles_for_acl(t.acl),
+                          'read_denied_roles': TM.Ticket.read_denied_roles_for_acl(t.acl)}})
+        log.info('Processed %d tickets', len(chunk))
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,8 @@
 
 
 def main(opts):
+    if opts.ingest:
+        return ingest(opts)
     if opts.type == 'git':
         repo = git.Repo(opts.repo_path, odbt=git.GitCmdObjectDB)
         cid = opts.cid
@@ -76,6 +78,44 @@ def main(opts):
     print 'Average time per run: %s' % (total / opts.count)
 
 
+def ingest(opts):
+    '''Time reading & parsing every commit and tree in a git repo, as done
+    by repo refresh, both one commit at a time via GitPython and in bulk via
+    a single `git cat-file --batch` process.  Mongo writes are not included.'''
+    if opts.type != 'git':
+        raise ValueError('--ingest is only supported for git')
+    repo = git.Repo(opts.repo_path, odbt=git.GitCmdObjectDB)
+    commit_ids = repo.git.rev_list('--all', max_count=opts.count).split()
+    for name, impl in [('gitpython', ingest_gitpython), ('cat-file', ingest_cat_file)]:
+        start = datetime.now()
+        impl(repo, commit_ids, opts.repo_path)
+        elapsed = (datetime.now() - start).total_seconds()
+        print '%-10s %6d commits in %8.2fs: %8.1f commits/s' % (
+            name, len(commit_ids), elapsed, len(commit_ids) / elapsed)
+
+
+def ingest_gitpython(repo, commit_ids, *args):
+    seen = set()
+
+    def walk(tree):
+        if tree.binsha in seen:
+            return
+        seen.add(tree.binsha)
+        for o in tree:
+            if o.type == 'tree':
+                walk(o)
+    for oid in commit_ids:
+        ci = repo.rev_parse(oid)
+        ci.message, ci.author.name, ci.committer.name, ci.parents
+        walk(ci.tree)
+
+
+def ingest_cat_file(repo, commit_ids, repo_path):
+    from forgegit.model.git_repo import _bulk_commit_docs
+    for batch in _bulk_commit_docs(repo_path, commit_ids, set(), True, 500):
+        pass
+
+
 def impl_git_tree(repo, cid, path, names, *args):
     data = {}
     for name in names:
@@ -150,6 +190,10 @@ def parse_opts():
     parser.add_argument(
         '--full-tree', action='store_true', default=False, dest='full_tree',
         help='Time full tree listing instead of just the single node')
+    parser.add_argument(
+        '--ingest', action='store_true', default=False, dest='ingest',
+        help='Time reading and parsing up to --count commits (and their trees) '
+             'for repo refresh, in commits per second')
     return parser.parse_args()
 
 if __name__ == '__main__':
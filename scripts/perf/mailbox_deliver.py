@@ -0,0 +1,102 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time Mailbox.deliver of one notification against the number of subscribers
+to a tool, comparing the single multi-document update with the former
+update-per-mailbox loop.  Run against a real MongoDB, e.g.:
+
+    paster script development.ini ../scripts/perf/mailbox_deliver.py -- -s 100 1000 10000
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import bson
+from pylons import tmpl_context as c
+from ming.orm import session, ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+
+
+def deliver_per_mailbox(nid, artifact_index_ids, topic):
+    '''Mailbox.deliver as it used to be, for comparison'''
+    d = {
+        'project_id': c.project._id,
+        'app_config_id': c.app.config._id,
+        'artifact_index_id': {'$in': artifact_index_ids + [None]},
+        'topic': {'$in': [None, topic]}
+    }
+    for mbox in M.Mailbox.query.find(d).all():
+        mbox.query.update(
+            {'$push': dict(queue=nid),
+             '$set': dict(last_modified=datetime.utcnow(),
+                          queue_empty=False),
+             })
+        session(mbox).expunge(mbox)
+
+
+def make_mailboxes(n):
+    coll = session(M.Mailbox).impl.db[M.Mailbox.__mongometa__.name]
+    coll.remove({'app_config_id': c.app.config._id})
+    for i in xrange(0, n, 1000):
+        coll.insert([dict(
+            user_id=bson.ObjectId(),
+            project_id=c.project._id,
+            app_config_id=c.app.config._id,
+            artifact_index_id=None,
+            topic=None,
+            type='direct',
+            frequency=dict(n=1, unit='day'),
+            queue=[],
+            queue_empty=True,
+        ) for j in xrange(i, min(i + 1000, n))])
+
+
+def main(opts):
+    impls = [('multi', M.Mailbox.deliver), ('per-mailbox', deliver_per_mailbox)]
+    with h.push_context(opts.project, opts.tool, neighborhood=opts.neighborhood):
+        for n in opts.subscribers:
+            make_mailboxes(n)
+            for name, deliver in impls:
+                start = time.time()
+                for i in range(opts.count):
+                    deliver('bench-%s-%d' % (name, i), [], 'metadata')
+                    ThreadLocalORMSession.close_all()
+                elapsed = (time.time() - start) / opts.count
+                print '%-12s subscribers: %6d  per notification: %8.4fs' % (
+                    name, n, elapsed)
+        make_mailboxes(0)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--subscribers', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='Numbers of subscribers to time delivery for')
+    parser.add_argument('-n', '--count', type=int, default=5,
+                        help='Notifications delivered per run')
+    parser.add_argument('--project', default='test')
+    parser.add_argument('--tool', default='wiki')
+    parser.add_argument('--neighborhood', default='Projects')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -43,6 +43,11 @@
 user    0m12.749s
 sys     0m1.112s
 
+With --postprocess, each text is converted without the html post-processing,
+and the old two pass sanitize + BeautifulSoup link rewriting is timed against
+the single pass RelativeLinkRewriter on the result.  --wiki=PROJECT/MOUNT uses
+the pages of a wiki (in the Projects neighborhood) instead of the default blog post's comments.
+
 """
 
 import argparse
@@ -68,6 +73,28 @@ def get_artifact():
         slug='2013/09/watch-breaking-bad-season-5-episode-16-felina-live-streaming')
 
 
+def wiki_context(opts):
+    '''Return a context manager for the --wiki, if any'''
+    from allura.lib import helpers as h
+    if not opts.wiki:
+        return h.null_contextmanager()
+    shortname, mount_point = opts.wiki.split('/')
+    return h.push_context(shortname, mount_point, neighborhood='Projects')
+
+
+def get_texts(opts):
+    '''Return [(id, text)] of the wiki pages or blog post comments to convert'''
+    from pylons import tmpl_context as c
+    if opts.wiki:
+        from forgewiki import model as WM
+        with wiki_context(opts):
+            pages = WM.Page.query.find(dict(
+                app_config_id=c.app.config._id, deleted=False))
+            return [(p.title, p.text) for p in pages]
+    artifact = get_artifact()
+    return [(p._id, p.text) for p in artifact.discussion_thread.posts]
+
+
 def main(opts):
     import markdown
     if opts.re2 and RE2_INSTALLED:
@@ -79,15 +106,60 @@ def main(opts):
         'forge': lambda: g.markdown,
     }
     md = converters[opts.converter]()
-    artifact = get_artifact()
-    return render(artifact, md, opts)
+    texts = get_texts(opts)
+    if opts.postprocess:
+        return postprocess(texts, opts)
+    with wiki_context(opts):
+        return render(texts, md, opts)
+
+
+def two_pass(html):
+    '''Sanitize and rewrite links the way ForgeExtension used to, with a
+    second parse of the html by BeautifulSoup'''
+    from bs4 import BeautifulSoup
+    from allura.lib import markdown_extensions as mde
+    soup = BeautifulSoup(mde.HTMLSanitizer().run(html), 'html5lib')
+    rewriter = mde.RelativeLinkRewriter()
+    for tag, attr in [('a', 'href'), ('img', 'src')]:
+        for link in soup.findAll(tag):
+            attrs = dict(((None, k), v) for k, v in link.attrs.items())
+            rewriter._rewrite(attrs, attr)
+            for (ns, k), v in attrs.items():
+                link[k] = v
+    return unicode(soup.body)[len('<body>'):-len('</body>')]
+
+
+def postprocess(texts, opts):
+    from allura.lib import markdown_extensions as mde
+    md = g.forge_markdown(wiki=bool(opts.wiki))
+    del md.postprocessors['sanitize_html']
+    del md.postprocessors['add_custom_class']
+    del md.postprocessors['mark_safe']
+    fused = mde.RelativeLinkRewriter()
+    print "%4s %14s %14s %10s %5s %s" % ('', 'Two pass (s)', 'One pass (s)', 'Text Size', 'Same', 'Id')
+    totals = [0, 0]
+    for i, (_id, text) in enumerate(texts):
+        with wiki_context(opts):
+            html = md.convert(DUMMYTEXT or text)
+        start = time.time()
+        out1 = two_pass(html)
+        elapsed1 = time.time() - start
+        start = time.time()
+        out2 = fused.run(html)
+        elapsed2 = time.time() - start
+        totals[0] += elapsed1
+        totals[1] += elapsed2
+        print "%4s %1.12f %1.12f %10s %5s %s" % (
+            i + 1, elapsed1, elapsed2, len(html), out1 == out2, _id)
+    print "Total time: two pass %s, one pass %s" % tuple(totals)
+    return out2
 
 
-def render(artifact, md, opts):
+def render(texts, md, opts):
     start = begin = time.time()
     print "%4s %20s %10s %s" % ('', 'Conversion Time (s)', 'Text Size', 'Post._id')
-    for i, p in enumerate(artifact.discussion_thread.posts):
-        text = DUMMYTEXT or p.text
+    for i, (_id, text) in enumerate(texts):
+        text = DUMMYTEXT or text
         if opts.n and i + 1 not in opts.n:
             print 'Skipping post %s' % str(i + 1)
             continue
@@ -97,7 +169,7 @@ def render(artifact, md, opts):
         else:
             output = md.convert(text)
         elapsed = time.time() - start
-        print "%4s %1.18f %10s %s" % (i + 1, elapsed, len(text), p._id)
+        print "%4s %1.18f %10s %s" % (i + 1, elapsed, len(text), _id)
         if opts.output:
             print 'Input:', text[:min(300, len(text))]
             print 'Output:', output[:min(MAX_OUTPUT, len(output))]
@@ -119,6 +191,10 @@ def parse_options():
                         help='Run with re and re2, and compare results')
     parser.add_argument('-n', '--n', nargs='+', type=int,
                         help='Only convert nth post(s) in thread')
+    parser.add_argument('--postprocess', action='store_true',
+                        help='Time the html post-processing, one pass vs two')
+    parser.add_argument('--wiki', metavar='PROJECT/MOUNT',
+                        help='Convert the pages of this wiki')
     return parser.parse_args()
 
 
@@ -0,0 +1,98 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Measure how long a posted task waits before an idle worker picks it up,
+comparing the fixed-interval poll loop with the ``monq.wakeup`` channel.
+
+Needs a real MongoDB (tailable cursors aren't supported by mim).  Example:
+
+    paster script development.ini ../scripts/perf/monq_latency.py -- --mode=both -n 20
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from pylons import tmpl_context as c
+from tg import config
+
+from allura import model as M
+
+
+def noop():
+    pass
+
+
+TASK_NAME = '%s.%s' % (noop.__module__, noop.__name__)
+
+
+def worker(waitfunc, n, latencies):
+    for i in range(n):
+        task = M.MonQTask.get(process='monq_latency', waitfunc=waitfunc,
+                              only=[TASK_NAME])
+        latencies.append(time.time() - task.kwargs['posted'])
+        task.state = 'complete'
+        M.task_orm_session.flush(task)
+        M.task_orm_session.close()
+
+
+def run(mode, opts):
+    config['monq.wakeup'] = str(mode == 'wakeup')
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+    if mode == 'wakeup':
+        wakeup = M.MonQWakeup(only=[TASK_NAME])
+        waitfunc = lambda: wakeup.wait(opts.poll_interval)
+    else:
+        waitfunc = lambda: time.sleep(opts.poll_interval)
+    latencies = []
+    t = threading.Thread(target=worker, args=(waitfunc, opts.n, latencies))
+    t.start()
+    for i in range(opts.n):
+        # spread posts out so the worker is idle and waiting for each one
+        time.sleep(random.uniform(0, opts.max_gap))
+        M.MonQTask.post(noop, kwargs=dict(posted=time.time()))
+    t.join()
+    latencies.sort()
+    print '%-8s tasks: %4d  mean: %8.4fs  median: %8.4fs  max: %8.4fs' % (
+        mode, len(latencies), sum(latencies) / len(latencies),
+        latencies[len(latencies) // 2], latencies[-1])
+
+
+def main(opts):
+    c.project = c.app = c.user = None
+    modes = ['poll', 'wakeup'] if opts.mode == 'both' else [opts.mode]
+    for mode in modes:
+        run(mode, opts)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['poll', 'wakeup', 'both'],
+                        default='both')
+    parser.add_argument('-n', type=int, default=20,
+                        help='Number of tasks to post')
+    parser.add_argument('--poll-interval', type=float, default=10,
+                        help='Seconds to sleep (poll) or max wait (wakeup)')
+    parser.add_argument('--max-gap', type=float, default=3,
+                        help='Max random delay between posting tasks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())